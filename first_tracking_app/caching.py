@@ -0,0 +1 @@
+../installer/caching.py
\ No newline at end of file
@@ -13,6 +13,7 @@ class AirportTrackerApp(TrackerApp):
         pass
 
     @staticmethod
+    @database.operation
     def airport_selected(session, airport_name, date_spinner) -> str:
         try:
             airport = database.get_object(session, database.Airport, name=airport_name)
@@ -23,6 +24,7 @@ class AirportTrackerApp(TrackerApp):
             return database.handle_error(e, session)
 
     @staticmethod
+    @database.operation
     def check_forecast_clicked(session, date, airport_name, output_box) -> str:
         try:
             if date and airport_name and '' not in [date, airport_name]:
@@ -35,6 +37,7 @@ class AirportTrackerApp(TrackerApp):
             return database.handle_error(e, session)
 
     @staticmethod
+    @database.operation
     def add_joined_clicked(session, parent_keys: Dict[str, str], parent_type, child_list: List[str], child_type,
                            manager: ScreenManager) -> str:
         """
@@ -64,6 +67,7 @@ class AirportTrackerApp(TrackerApp):
             new_screen.ids.longitude.text = parent_keys['longitude']
 
     @staticmethod
+    @database.operation
     def handle_confirmation_screen(session, child_type, keys: Dict[str, str], other_values: Dict[str, str],
                                    sql_type, manager: ScreenManager, popup: MDDialog,
                                    previous_name: str) -> str:
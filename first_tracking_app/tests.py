@@ -1,9 +1,11 @@
+import tempfile
 import unittest
 from datetime import date, timedelta
-from unittest import TestCase
+from unittest import TestCase, mock
 
 from kivy.uix.label import Label
 from kivy.uix.spinner import Spinner
+from sqlalchemy import event, insert
 
 from database import *
 
@@ -30,6 +32,36 @@ class DatabaseTests(TestCase):
         self.assertIn(city, get_nearby(session, 6, 6, City))
         self.assertIn(city, get_nearby(session, 4, 4, City))
 
+    def test_nearby_added_elsewhere(self):
+        with tempfile.TemporaryDirectory() as directory:
+            url = f'sqlite:///{directory}/shared.db'
+            here, elsewhere = Database(url), Database(url)  # As if in two apps
+            here.ensure_tables_exist()
+            session, other_session = here.create_session(), elsewhere.create_session()
+            self.assertFalse(get_is_nearby(session, 5, 5, Airport))
+            create_object(other_session, Airport, name='gorge', ICAO_code='JIMM', latitude=5, longitude=5)
+            self.assertFalse(get_is_nearby(session, 5, 5, Airport), 'The index should be reused while it is fresh')
+            with mock.patch('database.SHARED_DATA_MAX_AGE', 0):
+                self.assertTrue(get_is_nearby(session, 5, 5, Airport))
+            session.close()
+            other_session.close()
+            here.engine.dispose()
+            elsewhere.engine.dispose()
+
+    def test_radius_and_nearest(self):
+        session = create_in_memory_session()
+        self.assertEqual([], get_nearest(session, 0, 0, Airport))
+        lincoln = create_object(session, Airport, name='Lincoln', ICAO_code='KLNK', latitude=40.85, longitude=-96.76)
+        eppley = create_object(session, Airport, name='Eppley', ICAO_code='KOMA', latitude=41.30, longitude=-95.89)
+        tampa = create_object(session, Airport, name='Tampa', ICAO_code='KTPA', latitude=27.98, longitude=-82.53)
+        fiji = create_object(session, Airport, name='Nadi', ICAO_code='NFFN', latitude=-17.76, longitude=177.44)
+        self.assertEqual([lincoln], get_within_radius(session, 40.8, -96.7, Airport, 50))
+        self.assertEqual([lincoln, eppley], get_within_radius(session, 40.8, -96.7, Airport, 100))
+        self.assertEqual([eppley, lincoln, tampa], get_nearest(session, 41.2, -95.9, Airport, 3))
+        self.assertEqual([fiji], get_nearest(session, -17, -179.5, Airport))
+        self.assertTrue(get_is_nearby(session, -17, -179.5, Airport, 4))
+        self.assertEqual(4, len(get_nearest(session, 0, 0, Airport, 10)))
+
     def test_exists(self):
         session = create_in_memory_session()
         airport = create_object(session, Airport, name='gorge', ICAO_code='JIMM', latitude=5, longitude=5)
@@ -38,14 +70,308 @@ class DatabaseTests(TestCase):
         self.assertEqual(city, get_object(session, City, name='gorge'))
         self.assertIn(airport, get_objects(session, Airport, ICAO_code='JIMM'))
 
+    def test_reviews_with_operators(self):
+        session = create_in_memory_session()
+        operator = create_object(session, Operator, name='Joey Airways', rate_my_pilot_score=4.5)
+        operator.reviews.extend([Review(review=3), Review(review=5)])
+        session.commit()
+        statements = []
+        event.listen(session.get_bind(), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+        reviews = get_reviews_with_operators(session)
+        self.assertEqual(1, len(statements))
+        self.assertEqual([(3, 'Joey Airways', 4.5), (5, 'Joey Airways', 4.5)],
+                         sorted((review.review, review.operator_name, review.rate_my_pilot_score)
+                                for review in reviews))
+
+    def test_projections(self):
+        session = create_in_memory_session()
+        for name, valid in [('Lincoln', True), ('Omaha', False), ('Tampa', False)]:
+            create_object(session, City, name=name, geographic_identity='', latitude=0, longitude=0, valid=valid)
+        for day in [3, 1, 2, 1, 3]:
+            create_object(session, Forecast, date=date(2022, 4, day))
+        self.assertEqual(['Lincoln', 'Omaha', 'Tampa'], get_values(session, City.name))
+        self.assertEqual(['Omaha', 'Tampa'], get_values(session, City.name, valid=False))
+        self.assertEqual([date(2022, 4, 1), date(2022, 4, 2), date(2022, 4, 3)],
+                         get_values(session, Forecast.date, distinct=True))
+        self.assertEqual([date(2022, 4, 2)], get_values(session, Forecast.date, distinct=True, limit=1, offset=1))
+        omaha = get_object(session, City, name='Omaha')
+        self.assertEqual({omaha.city_id: 'Omaha'}, get_values_by_id(session, City.name, [omaha.city_id, 1000]))
+
+    def test_get_page(self):
+        session = create_in_memory_session()
+        for code in ['KOMA', 'KLNK', 'KLAX', 'NFFN']:
+            create_object(session, Airport, name=code, ICAO_code=code, latitude=0, longitude=0)
+        create_object(session, Airport, name='KLNK', ICAO_code='ZLNK', latitude=0, longitude=0)
+        self.assertEqual(['KLAX', 'KLNK'], get_page(session, Airport.name, limit=2), 'Values should be distinct')
+        self.assertEqual(['KLAX', 'KLNK'], get_page(session, Airport.ICAO_code, limit=2))
+        self.assertEqual(['KOMA', 'NFFN'], get_page(session, Airport.ICAO_code, after='KLNK', limit=2))
+        self.assertEqual(['KLAX', 'KLNK'], get_page(session, Airport.ICAO_code, 'KL'))
+        self.assertEqual(['KLNK'], get_page(session, Airport.ICAO_code, 'KL', after='KLAX'))
+        self.assertEqual([], get_page(session, Airport.ICAO_code, 'KLO'))
+        self.assertEqual([], get_page(session, Airport.name, 'K', valid=True))
+
+    def test_upgrade_schema(self):
+        database = Database(Database.construct_in_memory_url())
+        database.ensure_tables_exist()
+        with database.engine.begin() as connection:  # As made by an older installer
+            for table in Persisted.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.drop(connection)
+        session = database.create_session()
+        airport = create_object(session, Airport, name='Lincoln', ICAO_code='KLNK', latitude=0, longitude=0)
+        for temperature in [10, 20]:
+            create_object(session, Forecast, airport_id=airport.airport_id, date=date(2022, 4, 18),
+                          temperature=temperature)
+        for _ in range(2):
+            create_object(session, Airplane, name='The Bee', range=5000)
+        session.close()
+        self.assertRaises(DuplicateRowsError, database.upgrade_schema)
+
+        delete_object(session, Airplane, airplane_id=2)
+        session.commit()
+        self.assertIn('ix_forecast_airport_id_date', database.upgrade_schema())
+        self.assertEqual([20], get_values(session, Forecast.temperature), 'Only the latest forecast should be kept')
+        self.assertEqual([], database.upgrade_schema())
+        self.assertRaises(IntegrityError, create_object, session, Airport, name='Lincoln', ICAO_code='KLNK',
+                          latitude=0, longitude=0)
+
+    def test_query_profiler(self):
+        database = Database(Database.construct_in_memory_url(), profile_queries=False)
+        database.ensure_tables_exist()
+        session = database.create_session()
+        profiler = QueryProfiler(database.engine, slow_seconds=0, repeated_count=3)
+
+        @profiled
+        def get_names(ids):
+            return [get_values(session, Airport.name, airport_id=airport_id) for airport_id in ids]
+
+        get_names([1])
+        self.assertEqual({}, profiler.operations, 'Nothing should be counted while disabled')
+        profiler.enable()
+        try:
+            with self.assertLogs('profiling', 'WARNING') as logs:
+                get_names([1, 2, 3, 4])
+                with profile_operation('lookup'):
+                    session.query(Airport.name).filter(Airport.airport_id.in_([1, 2, 3])).all()
+        finally:
+            profiler.disable()
+        stats = profiler.operations[get_names.__qualname__]
+        self.assertEqual((1, 4, 4), (stats.calls, stats.statements, stats.most_statements))
+        self.assertEqual([4], list(stats.repeated.values()))
+        self.assertEqual(1, profiler.operations['lookup'].statements)
+        self.assertTrue(any('N+1' in line for line in logs.output))
+        self.assertEqual(5, len(profiler.slow_statements))
+        self.assertIn('lookup', profiler.summary())
+        get_names([1])
+        self.assertEqual(1, stats.calls, 'Nothing should be counted once disabled')
+        self.assertEqual(get_statement_shape('SELECT a FROM b WHERE c IN (?, ?,\n ?)'),
+                         get_statement_shape('SELECT a  FROM b WHERE c IN (?, ?)'))
+
+    def test_session_lifecycle(self):
+        database = get_database(Database.construct_in_memory_url(), pool_recycle=60)
+        self.assertIs(database, get_database(Database.construct_in_memory_url()))
+        self.assertEqual(60, database.engine.pool._recycle)
+        self.assertTrue(database.engine.pool._pre_ping)
+        database.ensure_tables_exist()
+        with database.session_scope() as session:
+            session.add(Airplane(name='The Bee', range=5000))
+        with self.assertRaises(IntegrityError):
+            with database.session_scope() as session:
+                session.add(Airplane(name='The Bee', range=6000))
+        session = database.create_session()
+        self.assertEqual([5000], get_values(session, Airplane.range))
+
+        @operation
+        def rename(session, name):
+            get_object(session, Airplane, name='The Bee').name = name
+            session.flush()
+
+        @operation
+        def get_range(session):
+            return get_object(session, Airplane, name='The Bee').range
+
+        self.assertTrue(session.in_transaction())
+        rename(session, 'The Queen')
+        self.assertTrue(session.in_transaction(), 'Flushed changes should stay for the caller to commit')
+        session.rollback()
+        self.assertEqual(5000, get_range(session))
+        self.assertFalse(session.in_transaction(), 'The connection should be released after a read')
+
+    def test_derived_data_built_during_change(self):
+        session = create_in_memory_session()
+        builds = []
+
+        def build(inner_session):
+            builds.append(len(builds))
+            if len(builds) == 1:  # As if another thread flushed an airport meanwhile
+                invalidate_derived_data(inner_session, [Airport])
+            return builds[-1]
+
+        self.assertEqual(0, get_derived_data(session, 'test', build, [Airport]))
+        self.assertEqual(1, get_derived_data(session, 'test', build, [Airport]), 'The stale data should not be kept')
+        self.assertEqual(1, get_derived_data(session, 'test', build, [Airport]))
+
+    def test_derived_data_expires(self):
+        session = create_in_memory_session()
+        builds = []
+
+        def build(_session):
+            builds.append(None)
+            return len(builds)
+
+        self.assertEqual(1, get_derived_data(session, 'test', build, [Airport], max_age=60))
+        self.assertEqual(1, get_derived_data(session, 'test', build, [Airport], max_age=60))
+        self.assertEqual(2, get_derived_data(session, 'test', build, [Airport], max_age=0),
+                         'Data older than max_age may miss changes made by other clients')
+
+    def test_change_log(self):
+        session = create_in_memory_session()
+        version = get_change_version(session)
+        operator = create_object(session, Operator, name='Joey Airways', rate_my_pilot_score=4.5)
+        self.assertEqual({operator.operator_id}, get_changed_ids(session, Operator, version))
+        self.assertEqual(set(), get_changed_ids(session, Review, version))
+        self.assertIsNone(get_changed_ids(session, Operator, None), 'Nothing has been queried yet')
+
+        version = get_change_version(session)
+        self.assertEqual(set(), get_changed_ids(session, Operator, version))
+        operator.name = 'Joey Air'
+        self.assertEqual({operator.operator_id}, get_changed_ids(session, Operator, version),
+                         'Pending edits should be flushed first')
+        session.commit()
+
+        version = get_change_version(session)
+        session.query(Operator).update({Operator.rate_my_pilot_score: 5})
+        self.assertIsNone(get_changed_ids(session, Operator, version), 'Bulk updates could have changed any row')
+        self.assertEqual(set(), get_changed_ids(session, Review, version))
+
+    def test_ingest_forecasts(self):
+        session = create_in_memory_session()
+        airport = create_object(session, Airport, name='Lincoln Airport', ICAO_code='KLNK', latitude=40.85,
+                                longitude=-96.76)
+        city = create_object(session, City, name='Lincoln', geographic_identity='Nebraska', latitude=40.8,
+                             longitude=-96.7)
+        start = 1650240000  # 2022-04-18 00:00 UTC
+
+        def make_record(temperature):
+            return {'timezone_offset': -18000,
+                    'daily': [{'dt': start + 86400 * day + 61200,
+                               'temp': {'max': temperature + 5, 'min': temperature - 5},
+                               'pop': 0.1, 'wind_speed': 2.5, 'visibility': 10000,
+                               'weather': [{'main': 'Clear', 'description': 'clear sky'}]} for day in range(8)]}
+
+        self.assertEqual(16, ingest_forecasts(session, [({'airport_id': airport.airport_id}, make_record(10)),
+                                                        ({'city_id': city.city_id}, make_record(20))], batch_size=5))
+        self.assertEqual(16, session.query(Forecast).count())
+        forecast = get_object(session, Forecast, airport_id=airport.airport_id, date=date(2022, 4, 18))
+        self.assertEqual(10, forecast.temperature)
+        self.assertEqual(10, forecast.visibility)
+        self.assertEqual(9, forecast.wind_speed)
+        self.assertEqual(20, get_object(session, Forecast, city_id=city.city_id, date=date(2022, 4, 25)).temperature)
+        ingest_forecasts(session, [({'airport_id': airport.airport_id}, make_record(30))])
+        self.assertEqual(16, session.query(Forecast).count(), 'Forecasts for the same day should be replaced')
+        session.refresh(forecast)
+        self.assertEqual(30, forecast.temperature)
+
+    def test_parse_daily_forecasts_visibility(self):
+        start = 1650258000  # 2022-04-18 00:00 in UTC-5
+        weather = [{'main': 'Clear', 'description': 'clear sky'}]
+        record = {'timezone_offset': -18000,
+                  'current': {'dt': start + 36000, 'temp': 12, 'visibility': 10000, 'weather': weather},
+                  'hourly': [{'dt': start + 3600 * hour, 'temp': 12, 'visibility': 6000 if hour == 30 else 10000,
+                              'pop': 0, 'weather': weather} for hour in range(10, 58)],
+                  'daily': [{'dt': start + 86400 * day + 43200, 'temp': {'max': 15, 'min': 5}, 'pop': 0,
+                             'wind_speed': 2.5, 'weather': weather} for day in range(8)]}  # No visibility, as sent
+        forecasts = parse_daily_forecasts(record)
+        self.assertEqual(date(2022, 4, 18), forecasts[0]['date'])
+        self.assertEqual([10, 6, 10, None], [forecast['visibility'] for forecast in forecasts[:4]],
+                         'Days past the hourly forecasts have no visibility')
+
+    def test_distance_matrix(self):
+        lincoln, omaha, tampa = (40.8, -96.7), (41.3, -95.89), (27.98, -82.53)
+        self.assertEqual(0, get_haversine_distance(lincoln, lincoln))
+        self.assertAlmostEqual(87.8, get_haversine_distance(lincoln, omaha), 1)
+        matrix = get_distance_matrix([lincoln, omaha, tampa])
+        self.assertEqual((3, 3), matrix.shape)
+        self.assertAlmostEqual(get_haversine_distance(omaha, tampa), matrix[1, 2])
+        self.assertAlmostEqual(matrix[1, 2], matrix[2, 1])
+        row = get_distance_matrix([lincoln], [omaha, tampa])
+        self.assertEqual((1, 2), row.shape)
+        self.assertAlmostEqual(matrix[0, 2], row[0, 1])
+
 
 try:
     # noinspection PyUnresolvedReferences
-    from tracker_app import TrackerApp
+    from tracker_app import TrackerApp, SearchSpinner
 
 
     class TrackerTests(TestCase):
 
+        def test_populate_spinner(self):
+            session = create_in_memory_session()
+            spinner = Spinner()
+            for name in ['Dave', 'Cheryl']:
+                TrackerApp.create_object(session, Operator, {'name': name}, {'rate_my_pilot_score': '5'})
+            TrackerApp.populate_spinner(session, Operator, spinner, True)
+            self.assertEqual(['Create New', 'Dave', 'Cheryl'], spinner.values)
+            values = spinner.values
+            statements = []
+            event.listen(session.get_bind(), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+            TrackerApp.populate_spinner(session, Operator, spinner, True)
+            self.assertEqual([], statements, 'Nothing changed, so nothing should be queried')
+            self.assertIs(values, spinner.values)
+
+            get_object(session, Operator, name='Dave').name = 'David'
+            TrackerApp.create_object(session, Operator, {'name': 'Mops'}, {'rate_my_pilot_score': '5'})
+            statements.clear()
+            TrackerApp.populate_spinner(session, Operator, spinner, True)
+            self.assertEqual(['Create New', 'David', 'Cheryl', 'Mops'], spinner.values)
+            self.assertEqual(1, len(statements))
+            self.assertIn(' IN ', statements[0], 'Only the changed operators should be queried')
+
+            delete_object(session, Operator, name='Cheryl')
+            session.commit()
+            TrackerApp.populate_spinner(session, Operator, spinner, True)
+            self.assertEqual(['Create New', 'David', 'Mops'], spinner.values)
+
+            session.connection().execute(insert(Operator.__table__).values(name='Zed', rate_my_pilot_score=5))
+            session.commit()  # As if by another app, so this process doesn't log the change
+            with mock.patch('database.SHARED_DATA_MAX_AGE', 0):
+                TrackerApp.populate_spinner(session, Operator, spinner, True)
+            self.assertEqual(['Create New', 'David', 'Mops', 'Zed'], spinner.values)
+
+        def test_populate_forecast_spinner(self):
+            session = create_in_memory_session()
+            spinner = Spinner()
+            for day in [2, 1, 2]:
+                create_object(session, Forecast, date=date(2022, 4, day))
+            statements = []
+            event.listen(session.get_bind(), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+            TrackerApp.populate_spinner(session, Forecast, spinner)
+            self.assertEqual(['2022-04-01', '2022-04-02'], spinner.values)
+            self.assertEqual(1, len(statements))
+            self.assertIn('DISTINCT forecast.date', statements[0], 'Forecasts shouldn\'t be loaded just for dates')
+
+        def test_search_spinner(self):
+            session = create_in_memory_session()
+            spinner = SearchSpinner(text='Select')
+            for index in range(PAGE_SIZE + 5):
+                create_object(session, Airport, name=f'Airport {index:03}', ICAO_code=f'A{index:03}', latitude=0,
+                              longitude=0)
+            create_object(session, Airport, name='Lincoln', ICAO_code='KLNK', latitude=0, longitude=0)
+            self.assertEqual('', TrackerApp.search_spinner(session, Airport.name, spinner))
+            self.assertEqual(PAGE_SIZE + 1, len(spinner.values))
+            self.assertEqual(SearchSpinner.MORE, spinner.values[-1])
+            spinner._dropdown.select(SearchSpinner.MORE)
+            self.assertEqual('Select', spinner.text, 'Loading more shouldn\'t choose anything')
+            self.assertEqual(PAGE_SIZE + 6, len(spinner.values))
+            self.assertEqual('Lincoln', spinner.values[-1])
+
+            TrackerApp.search_spinner(session, Airport.name, spinner, 'Li', True)
+            self.assertEqual(['Create New', 'Lincoln'], spinner.values)
+            create_object(session, Airport, name='Lisbon', ICAO_code='LPPT', latitude=0, longitude=0)
+            TrackerApp.populate_spinner(session, Airport, spinner, True)
+            self.assertEqual(['Create New', 'Lincoln', 'Lisbon'], spinner.values, 'The prefix should be kept')
+
         def test_create_object_empty_dict(self):
             session = create_in_memory_session()
 
@@ -193,10 +519,88 @@ except ImportError:
 
 try:
     # noinspection PyUnresolvedReferences
+    from kivy.uix.textinput import TextInput
+    from kivy.uix.widget import Widget
     from main import OperatorApp
+    from tracker_app import ListHolder, RecycleListHolder, RecycleTwoLineListHolder
 
 
     class OperatorTests(TestCase):
+        class MockMain(OperatorApp):
+            def create_session(self):
+                self.session = create_in_memory_session()
+
+        def test_update_two_line_list(self):
+            _app = OperatorTests.MockMain()  # Using app so that KivyMD doesn't cause exception
+            reviews = RecycleTwoLineListHolder(size=(300, 400))
+            reviews.update_two_line_list({1: ('3', 'Name: Dave', 1), 2: ('5', 'Name: Dave', 2)})
+            first, second = reviews.items[1], reviews.items[2]
+            reviews.on_pressed(1)
+            reviews.on_pressed(2)
+            self.assertEqual([first], reviews.selected_elements, 'Only one row can be selected')
+            self.assertTrue(reviews.data[0]['selected'])
+            reviews.update_two_line_list({2: ('5', 'Name: David', 2), 3: ('4', 'Name: Cheryl', 3)})
+            self.assertEqual({2, 3}, set(reviews.items))
+            self.assertEqual([], reviews.selected_elements, 'Removed rows should be deselected')
+            self.assertIs(second, reviews.items[2], 'Changed rows should be updated in place')
+            self.assertEqual('Name: David', second.secondary_text)
+            self.assertEqual(3, reviews.items[3].id)
+
+            reviews.update_two_line_list({}, removed=[3])
+            self.assertEqual([2], list(reviews.items))
+            self.assertEqual(['5'], [row['text'] for row in reviews.data])
+
+        def test_recycle_two_line_list(self):
+            _app = OperatorTests.MockMain()  # Using app so that KivyMD doesn't cause exception
+            ratings = RecycleTwoLineListHolder(size=(300, 400))
+            ratings.populate_two_line_list({f'New rating: {index}': ('Current Average Rating: 3', index)
+                                            for index in range(5000)})
+            ratings.refresh_views()
+            self.assertEqual(5000, len(ratings.data))
+            self.assertLess(len(ratings.layout_manager.children), 20, 'Only visible rows should be widgets')
+            ratings.on_pressed(4999)
+            self.assertEqual(4999, ratings.selected_elements[0].id)
+
+        def test_recycle_list(self):
+            _app = OperatorTests.MockMain()  # Using app so that KivyMD doesn't cause exception
+            airports_list = RecycleListHolder(size=(300, 400))
+            codes = [f'A{index:04}' for index in range(10000)]
+            airports_list.populate_list(codes)
+            airports_list.refresh_views()
+            self.assertEqual(10000, len(airports_list.data))
+            self.assertLess(len(airports_list.layout_manager.children), 20, 'Only visible rows should be widgets')
+
+            airports_list.on_pressed('A0005')
+            airports_list.on_pressed('A9999')
+            self.assertEqual(['A0005', 'A9999'], airports_list.selected_elements)
+            airports_list.on_pressed('A0005')
+            self.assertEqual(['A9999'], airports_list.selected_elements)
+            airports_list.populate_list(codes)
+            self.assertEqual([], airports_list.selected_elements)
+
+        def test_paged_airport_list(self):
+            app = OperatorTests.MockMain()
+            session = app.session
+            airplane = create_object(session, Airplane, name='The Bee', range=5000)
+            airports = [create_object(session, Airport, name=f'{index}', ICAO_code=f'A{index:03}', latitude=0,
+                                      longitude=0) for index in range(2 * PAGE_SIZE)]
+            create_object(session, Operator, name='Dave', rate_my_pilot_score=5, airplane=airplane,
+                          airports=[airports[0], airports[-1]])
+            airports_list = RecycleListHolder(size=(300, 400))
+            fields = [Widget(), airports_list, TextInput(), TextInput(), Spinner()]
+            self.assertEqual('', OperatorApp.on_operator_spinner_clicked(session, 'Dave', *fields))
+            self.assertEqual(PAGE_SIZE, len(airports_list.data), 'Only the first page should be loaded')
+            self.assertEqual(['A000', f'A{2 * PAGE_SIZE - 1:03}'], airports_list.selected_elements,
+                             'Airports that aren\'t shown should still be selected')
+            airports_list.scroll_y = 0
+            self.assertEqual(2 * PAGE_SIZE, len(airports_list.data))
+            self.assertTrue(airports_list.data[-1]['selected'])
+
+            OperatorApp.search_airports(session, airports_list, 'a01')
+            self.assertEqual([f'A01{digit}' for digit in range(10)], [row['text'] for row in airports_list.data])
+            airports_list.on_pressed('A012')
+            self.assertEqual(3, len(airports_list.selected_elements), 'Searching should keep the selection')
+
         def test_add_review(self):
             session = create_in_memory_session()
             self.assertNotEqual('Review has been successfully added.', OperatorApp.add_review(session, 'Jim', '5'))
@@ -243,14 +647,219 @@ except ImportError:
     pass
 
 try:
+    import json
+    import os
+    import tempfile
+    import threading
+    from concurrent.futures import wait
+    from unittest.mock import patch
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    from urllib.parse import urlsplit, parse_qsl
+
     from main import TravelApp
     import rest
     import csv_handler
+    import routing
+    import validation
     from itineraries import *
+    from pipeline import Stage, StagePipeline, SkippedStage
+    import benchmarks
+
+
+    class StubWeatherServer(ThreadingHTTPServer):
+        """
+        Local stand-in for OpenWeather that answers every request with a forecast for the requested coordinates.
+        """
+
+        def __init__(self):
+            super().__init__(('127.0.0.1', 0), StubWeatherHandler)
+            self.connections = 0
+            self.requests = 0
+            self.lock = threading.Lock()
+            threading.Thread(target=self.serve_forever, daemon=True).start()
+
+        def make_connection(self, root_path='/data/2.5') -> rest.RESTConnection:
+            return rest.RESTConnection('127.0.0.1', self.server_address[1], root_path, scheme='http')
+
+        def close(self):
+            self.shutdown()
+            self.server_close()
+
+
+    class StubWeatherHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep-alive
+
+        def setup(self):
+            super().setup()
+            with self.server.lock:
+                self.server.connections += 1
+
+        def do_GET(self):
+            with self.server.lock:
+                self.server.requests += 1
+            parameters = dict(parse_qsl(urlsplit(self.path).query))
+            if parameters.get('lat') == 'fail':
+                self.send_response(401)
+                body = b'{"message": "Invalid API key"}'
+            elif self.path.startswith('/geo/1.0/direct'):
+                self.send_response(200)
+                body = json.dumps([] if parameters['q'] == 'Nowhere' else
+                                  [{'name': parameters['q'], 'lat': 10, 'lon': 10},
+                                   {'name': parameters['q'], 'lat': 40.8, 'lon': -96.7}]).encode('utf-8')
+            else:
+                self.send_response(200)
+                body = json.dumps({'lat': float(parameters['lat']), 'lon': float(parameters['lon']),
+                                   'timezone_offset': 0,
+                                   'daily': [{'dt': 1650283200 + 86400 * day, 'temp': {'max': 20, 'min': 10},
+                                              'pop': 0, 'wind_speed': 1, 'visibility': 10000,
+                                              'weather': [{'description': 'clear sky'}]} for day in range(8)]
+                                   }).encode('utf-8')
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_args):
+            pass
 
 
     class TravelTests(TestCase):
-        pass
+
+        def test_fetch_all_reuses_connections(self):
+            server = StubWeatherServer()
+            try:
+                with rest.RESTFetcher(server.make_connection(), max_workers=4) as fetcher:
+                    parameter_list = [{'lat': latitude, 'lon': 0} for latitude in range(40)]
+                    parameter_list.append({'lat': 'fail', 'lon': 0})
+                    results = list(fetcher.fetch_all('onecall', parameter_list))
+                self.assertEqual(41, len(results))
+                for parameters, response in results:
+                    if parameters['lat'] == 'fail':
+                        self.assertIsInstance(response, rest.RESTError)
+                        self.assertEqual(401, response.status)
+                    else:
+                        self.assertEqual(parameters['lat'], response['lat'])
+                self.assertEqual(41, server.requests)
+                self.assertLessEqual(server.connections, 5, 'Connections should be pooled, not opened per request')
+            finally:
+                server.close()
+
+        def test_response_cache(self):
+            cache = rest.ResponseCache({'direct': 60, 'onecall': -1}, maximum_size=40)
+            key = cache.make_key('/geo/1.0', 'direct', {'appid': 'first key', 'q': 'Lincoln ', 'lat': '40.8'})
+            self.assertEqual(key, cache.make_key('/geo/1.0', 'direct',
+                                                 {'lat': 40.80, 'q': 'lincoln', 'appid': 'other key'}))
+            self.assertNotEqual(key, cache.make_key('/geo/1.0', 'reverse', {'q': 'lincoln', 'lat': 40.8}))
+            cache.put(key, 'direct', [{'name': 'Lincoln'}])
+            self.assertEqual([{'name': 'Lincoln'}], cache.get(key))
+            cache.put('expired', 'onecall', {'daily': []})
+            self.assertIsNone(cache.get('expired'))
+            cache.put('newer', 'direct', [{'name': 'Omaha'}])
+            cache.put('newest', 'direct', [{'name': 'Tampa'}])
+            self.assertIsNone(cache.get(key), 'The least recently used response should be evicted')
+            self.assertEqual([{'name': 'Tampa'}], cache.get('newest'))
+
+        def test_response_cache_survives_restart(self):
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, 'responses.sqlite')
+                cache = rest.ResponseCache({}, path=path)
+                cache.put('key', 'direct', [{'name': 'Lincoln'}])
+                cache.close()
+                cache = rest.ResponseCache({}, path=path)
+                self.assertEqual([{'name': 'Lincoln'}], cache.get('key'))
+                cache.close()
+
+        def test_fetch_uses_cache(self):
+            server = StubWeatherServer()
+            try:
+                connection = server.make_connection()
+                connection.cache = rest.ResponseCache({'onecall': 60})
+                with rest.RESTFetcher(connection) as fetcher:
+                    first = fetcher.fetch('onecall', {'appid': 'key', 'lat': 40.8, 'lon': -96.7})
+                    self.assertEqual(first, fetcher.fetch('onecall', {'appid': 'key', 'lat': '40.80', 'lon': '-96.7'}))
+                self.assertEqual(1, server.requests)
+            finally:
+                server.close()
+
+        def test_validate_all(self):
+            session = create_in_memory_session()
+            create_object(session, Airport, name='Lincoln', ICAO_code='KLNK', latitude=40.9, longitude=-96.8)
+            create_object(session, Airport, name='Misplaced', ICAO_code='KOMA', latitude=0, longitude=0)
+            create_object(session, Airport, name='Made up', ICAO_code='ZZZZ', latitude=0, longitude=0)
+            create_object(session, Airport, name='Already valid', ICAO_code='ZZZY', latitude=0, longitude=0,
+                          valid=True)
+            create_object(session, City, name='Lincoln', geographic_identity='Nebraska', latitude=40.7, longitude=-96.6)
+            create_object(session, City, name='Springfield', geographic_identity='Ohio', latitude=0, longitude=0)
+            create_object(session, City, name='Nowhere', geographic_identity='Kansas', latitude=0, longitude=0)
+            server = StubWeatherServer()
+            try:
+                with rest.RESTFetcher(server.make_connection('/geo/1.0')) as fetcher:
+                    validated, ambiguities = validation.validate_all(session, csv_handler.AirportReference(
+                        'airports.csv'), fetcher, 'key')
+            finally:
+                server.close()
+            self.assertEqual(2, validated)
+            self.assertEqual({'Misplaced', 'Made up', 'Springfield', 'Nowhere'},
+                             {ambiguity.name for ambiguity in ambiguities})
+            misplaced = [ambiguity for ambiguity in ambiguities if ambiguity.name == 'Misplaced'][0]
+            self.assertEqual('Eppley Airfield', misplaced.official_name)
+            springfield = [ambiguity for ambiguity in ambiguities if ambiguity.name == 'Springfield'][0]
+            self.assertEqual((10, 10), (springfield.official_latitude, springfield.official_longitude))
+            self.assertTrue(get_object(session, Airport, ICAO_code='KLNK').valid)
+            self.assertTrue(get_object(session, City, name='Lincoln').valid)
+            self.assertEqual(4, session.query(Airport).filter_by(valid=False).count() +
+                             session.query(City).filter_by(valid=False).count())
+
+        def test_refresh_forecasts(self):
+            session = create_in_memory_session()
+            for code, latitude in [('KLNK', 40.85), ('KOMA', 41.3), ('KTPA', 27.98)]:
+                create_object(session, Airport, name=code, ICAO_code=code, latitude=latitude, longitude=-90)
+            server = StubWeatherServer()
+            try:
+                with rest.RESTFetcher(server.make_connection(), max_workers=2) as fetcher:
+                    self.assertEqual(24, TravelApp.refresh_forecasts(session, fetcher, 'key'))
+                self.assertEqual(8, session.query(Forecast).filter_by(airport_id=2).count())
+            finally:
+                server.close()
+
+        def test_airport_reference(self):
+            reference = csv_handler.AirportReference('airports.csv')
+            self.assertIsNone(reference._by_code, 'The CSV should only be read on first use')
+            goroka = csv_handler.check_airport(reference, 'AYGA')
+            self.assertEqual('Goroka Airport', goroka['airport_name'])
+            self.assertAlmostEqual(-6.081689835, goroka['latitude'])
+            self.assertIsNone(csv_handler.check_airport(reference, 'ZZZZ'))
+            self.assertEqual('Goroka Airport', csv_handler.check_airport(csv_handler.store_airports('airports.csv'),
+                                                                         'AYGA')['airport_name'])
+            self.assertEqual({'AYGA': goroka, 'ZZZZ': None}, reference.get_many(['AYGA', 'ZZZZ']))
+
+        def test_airport_cache(self):
+            with tempfile.TemporaryDirectory() as directory:
+                csv_file = os.path.join(directory, 'airports.csv')
+                with open(csv_file, 'w') as file:
+                    file.write('ICAO,Name,Country,Latitude,Longitude\n'
+                               'KLNK,Lincoln Airport,United States,40.85,-96.76\n')
+                reference = csv_handler.AirportReference(csv_file)
+                self.assertEqual('Lincoln Airport', reference.get('KLNK')['airport_name'])
+                self.assertIsNotNone(csv_handler.load_airport_cache(csv_file), 'The cache should have been written')
+                with open(csv_file, 'a') as file:
+                    file.write('KOMA,Eppley Airfield,United States,41.30,-95.89\n')
+                self.assertIsNone(csv_handler.load_airport_cache(csv_file), 'The cache should be stale')
+                reference = csv_handler.AirportReference(csv_file)
+                self.assertEqual(40.85, reference.get('KLNK')['latitude'])
+                self.assertEqual('Eppley Airfield', reference.get('KOMA')['airport_name'])
+                self.assertEqual(2, len(csv_handler.load_airport_cache(csv_file)['codes']))
+
+        def test_airport_reference_secondary_lookups(self):
+            reference = csv_handler.AirportReference('airports.csv')
+            names = [airport['airport_name'] for airport in reference.get_by_name_prefix('lincoln')]
+            self.assertIn('Lincoln Airport', names)
+            self.assertTrue(all(name.lower().startswith('lincoln') for name in names))
+            self.assertEqual(1, len(reference.get_by_name_prefix('Lincoln', 1)))
+            self.assertEqual([], reference.get_by_name_prefix('Zzzzz'))
+            papua_new_guinea = reference.get_by_country('Papua New Guinea')
+            self.assertIn(reference.get('AYGA'), papua_new_guinea)
+            self.assertTrue(all(airport['country_name'] == 'Papua New Guinea' for airport in papua_new_guinea))
 
 
     def setup_end_state(session, range=3000, start_location: Tuple[float, float] = (45, 45),
@@ -383,28 +992,361 @@ try:
             self.assertEqual('Lincoln, Nebraska', self.itinerary.children[-1].text, 'The weather shouldn\'t stop the '
                                                                                     'plane from taking off')
 
+        def test_route_graph_reused(self):
+            setup_end_state(self.session)
+            start_city = get_object(self.session, City, city_id=1)
+            graph = routing.get_route_graph(self.session)
+            self.assertIs(graph, routing.get_route_graph(self.session))
+            self.assertEqual({2, 3}, graph.get_departures(start_city.city_id)[start_city.airports[0].airport_id])
+
+        def test_route_graph_invalidated(self):
+            setup_end_state(self.session, 100)
+            start_city = get_object(self.session, City, city_id=1)
+            graph = routing.get_route_graph(self.session)
+            self.assertEqual(set(), graph.get_departures(start_city.city_id)[start_city.airports[0].airport_id])
+            start_city.airports[0].operators[0].airplane.range = 2000
+            graph = routing.get_route_graph(self.session)
+            self.assertEqual({2, 3}, graph.get_departures(start_city.city_id)[start_city.airports[0].airport_id])
+
+        def test_feasibility_table(self):
+            setup_end_state(self.session)
+            start_city = get_object(self.session, City, city_id=1)
+            forecast: Forecast = start_city.airports[0].forecasts[0]
+            table = routing.get_feasibility_table(self.session, forecast.date)
+            self.assertIs(table, routing.get_feasibility_table(self.session, forecast.date))
+            self.assertTrue(table.can_take_off(forecast.airport_id, forecast.date))
+            self.assertFalse(table.can_take_off(forecast.airport_id, forecast.date - timedelta(days=1)),
+                             'There is no forecast for the day before')
+
+            forecast.temperature = None
+            table = routing.get_feasibility_table(self.session, forecast.date)
+            self.assertFalse(table.can_take_off(forecast.airport_id, forecast.date),
+                             'A forecast without temperature shouldn\'t be trusted')
+
+            timestamp = (forecast.date - date(1970, 1, 1)).days * 86400 + 43200
+            ingest_forecasts(self.session, [({'airport_id': forecast.airport_id, 'city_id': forecast.city_id},
+                                             {'timezone_offset': 0, 'daily': [  # No visibility, as the API sends it
+                                                 {'dt': timestamp, 'temp': {'max': 20, 'min': 10}, 'pop': 0,
+                                                  'wind_speed': 1, 'weather': [{'description': 'Clear'}]}]})])
+            self.assertIsNone(forecast.visibility)
+            table = routing.get_feasibility_table(self.session, forecast.date)
+            self.assertTrue(table.can_take_off(forecast.airport_id, forecast.date),
+                            'Ingesting forecasts should refresh the table, and missing visibility shouldn\'t ground')
+
+            next_day = forecast.date + timedelta(days=1)
+            self.assertEqual(next_day, routing.get_feasibility_table(self.session, next_day).start_date)
+            self.assertIsNot(table, routing.get_feasibility_table(self.session, forecast.date),
+                             'Only the latest table should be kept')
+            table = routing.get_feasibility_table(self.session, forecast.date)
+            with mock.patch('routing.SHARED_DATA_MAX_AGE', 0):
+                self.assertIsNot(table, routing.get_feasibility_table(self.session, forecast.date),
+                                 'Forecasts ingested by other clients should show once the table is old')
+
+        def test_generate_itineraries(self):
+            create_city_loop(self.session, 10)
+            city_ids = [city_id for city_id, in self.session.query(City.city_id)]
+            itineraries = list(generate_itineraries(self.session, city_ids, max_workers=2))
+            self.assertEqual(2 * len(city_ids), len(itineraries))
+            snapshot = routing.get_routing_snapshot(self.session, date.today())
+            for city_id, greedy, itinerary in itineraries:
+                expected = routing.plan_itinerary(snapshot, city_id, 0, greedy, chose_city)
+                self.assertEqual([str(snapshot.graph.cities[stop]) for stop in expected], itinerary)
+
+        def request_in_background(self, cancel: bool) -> Tuple[List[str], List[str], list]:
+            with tempfile.TemporaryDirectory() as directory:
+                travel_database = Database(f'sqlite:///{os.path.join(directory, "travel.db")}')
+                travel_database.ensure_tables_exist()
+                session = travel_database.create_session()
+                setup_end_state(session)
+                session.close()
+                lincoln_or_bust, the_scenic_route, finished = ListHolder(), ListHolder(), []
+                with patch('itineraries.Clock') as clock:
+                    request = ItineraryRequest(travel_database.create_session, 'Beginning Town, Republic of Genesis',
+                                               0, lincoln_or_bust, the_scenic_route, finished.append).start()
+                    if cancel:
+                        request.cancel()
+                    wait([request.future], timeout=10)
+                for (publish, *_delay), _ in clock.schedule_once.call_args_list:  # What the main thread would run
+                    publish(0)
+                travel_database.engine.dispose()
+            return ([child.text for child in lincoln_or_bust.children],
+                    [child.text for child in the_scenic_route.children], finished)
+
+        def test_background_request(self):
+            lincoln_or_bust, the_scenic_route, finished = self.request_in_background(False)
+            self.assertEqual([None], finished)
+            self.assertEqual(['Beginning Town, Republic of Genesis', 'Lincoln, Nebraska'], lincoln_or_bust)
+            self.assertEqual('Beginning Town, Republic of Genesis', the_scenic_route[0])
+
+        def test_cancelled_background_request(self):
+            self.assertEqual(([], [], []), self.request_in_background(True),
+                             'A cancelled request shouldn\'t touch the itineraries')
+
         def test_meridians(self):
             create_city_loop(self.session, 18)
             lincoln = get_object(self.session, City, city_id=1)
             generate_itinerary(self.session, lincoln, 0, self.itinerary, True)
-            index = 0
-            for child in self.itinerary.children:
-                if index in [0, 17]:
-                    self.assertEqual('Lincoln, Nebraska', child.text)
-                else:
-                    self.assertEqual(f'{index}, index', child.text)
-                index += 1
-            self.assertEqual(18, index)
-            
+            self.assertEqual(['Lincoln, Nebraska', '1, index', 'Lincoln, Nebraska'],
+                             [child.text for child in self.itinerary.children],
+                             'Flying straight back is the fastest way home')
+            generate_itinerary(self.session, lincoln, 0, self.itinerary, False)
+            self.assertEqual('Lincoln, Nebraska', self.itinerary.children[0].text)
+            self.assertEqual('Lincoln, Nebraska', self.itinerary.children[-1].text)
+
+
+    class ListRefreshTests(TestCase):
+        def setUp(self) -> None:
+            self.app = ItineraryTests.MockMain()  # Using app so that KivyMD doesn't cause exception
+            self.app.root = self.app.build()
+            self.session = self.app.session
+
+        def test_accept_rating(self):
+            operator = create_object(self.session, Operator, name='Joey Airways', rate_my_pilot_score=4)
+            operator.reviews.extend([Review(review=3), Review(review=5)])
+            self.session.commit()
+            TravelApp.populate_unvalidated_ratings(self.session, self.app.root)
+            ratings_list = self.app.root.get_screen('update_ratings').ids.update_rating_list
+            self.assertEqual(2, self.app.root.get_screen('main_menu').to_update)
+            remaining = ratings_list.items[operator.reviews[1].review_id]
+            ratings_list.on_pressed(operator.reviews[0].review_id)
+            self.app.accept_rating_clicked()
+            self.assertEqual(3.5, operator.rate_my_pilot_score)
+            self.assertEqual([remaining], list(ratings_list.items.values()))
+            self.assertEqual(1, self.app.root.get_screen('main_menu').to_update)
+
+        def test_keep_my_data(self):
+            city = create_object(self.session, City, name='Lincoln', geographic_identity='Nebraska', latitude=40.8,
+                                 longitude=-96.7)
+            airport = create_object(self.session, Airport, name='Lincoln Airport', ICAO_code='KLNK', latitude=40.85,
+                                    longitude=-96.76)
+            TravelApp.populate_invalid_locations(self.session, self.app.root)
+            locations_list = self.app.root.get_screen('validate_locations').ids.validate_locations_list
+            city_key, airport_key = ('City', city.city_id), ('Airport', airport.airport_id)
+            self.assertEqual({city_key, airport_key}, set(locations_list.items))
+
+            statements = []
+            event.listen(self.session.get_bind(), 'before_cursor_execute', lambda *args: statements.append(args[2]))
+            self.app.create_popup('City could not be validated.')  # The choice keep_my_data_clicked answers
+            self.app.keep_my_data_clicked(city)
+            self.assertEqual([airport_key], list(locations_list.items))
+            self.assertEqual(1, self.app.root.get_screen('main_menu').to_validate)
+            self.assertTrue(all(' IN ' in statement for statement in statements if statement.startswith('SELECT')),
+                            'Only the city that changed should be queried again')
+
+        def test_validated_all_ambiguities(self):
+            city = create_object(self.session, City, name='Springfield', geographic_identity='Ohio', latitude=0,
+                                 longitude=0)
+            airport = create_object(self.session, Airport, name='Made up', ICAO_code='ZZZZ', latitude=0, longitude=0)
+            TravelApp.populate_invalid_locations(self.session, self.app.root)
+            locations_list = self.app.root.get_screen('validate_locations').ids.validate_locations_list
+            city_key, airport_key = ('City', city.city_id), ('Airport', airport.airport_id)
+            self.app.on_validated_all('0 locations validated. 2 need to be validated by hand.', [
+                validation.Ambiguity(City, city.city_id, 'Springfield', 'The closest Springfield is 1570 km away',
+                                     'Springfield', 10, 10),
+                validation.Ambiguity(Airport, airport.airport_id, 'Made up', 'No airport with ICAO code ZZZZ exists')])
+            self.assertEqual('Official: Springfield (10.0000, 10.0000)', locations_list.items[city_key].secondary_text)
+            self.assertEqual('No airport with ICAO code ZZZZ exists', locations_list.items[airport_key].secondary_text)
+
+            locations_list.on_pressed(city_key)
+            with mock.patch.object(self.app, 'create_choice_popup') as create_choice_popup, \
+                    mock.patch.object(self.app, 'call_geocoding_api_by_name') as call_geocoding_api_by_name:
+                self.app.validate_location_clicked()
+            call_geocoding_api_by_name.assert_not_called()
+            _text, _keep_my_data, use_official_data = create_choice_popup.call_args.args
+            self.app.create_popup('City could not be validated.')  # The choice use_official_data_clicked answers
+            use_official_data(None)
+            self.assertEqual((10, 10, 'Springfield', True), (city.latitude, city.longitude, city.name, city.valid))
+            self.assertEqual([airport_key], list(locations_list.items))
+            self.assertEqual('No airport with ICAO code ZZZZ exists', locations_list.items[airport_key].secondary_text)
+
+
+    class BenchmarkTests(TestCase):
+        def test_hot_paths(self):
+            app = ItineraryTests.MockMain()
+            app.root = app.build()
+            results = benchmarks.benchmark_hot_paths(200, app)
+            self.assertEqual(200, results['rows']['forecasts'])
+            self.assertTrue(all(seconds >= 0 for name, seconds in results.items() if name.endswith('_seconds')))
+            self.assertEqual(results, json.loads(json.dumps(results)), 'Results should be written as they are')
+
+
+    class PipelineTests(TestCase):
+        def run_pipeline(self, stages, ended: Dict[str, threading.Event] = None) -> Tuple[list, dict]:
+            """
+            :param ended: events set as the stages they are keyed by are reported
+            """
+            finished_stages, errors, done = [], {}, threading.Event()
+
+            def on_stage_finished(name, result, _exception):
+                finished_stages.append((name, result))
+                if ended and name in ended:
+                    ended[name].set()
+
+            def on_finished(pipeline_errors):
+                errors.update(pipeline_errors)
+                done.set()
+
+            StagePipeline(stages, on_stage_finished, on_finished).start()
+            self.assertTrue(done.wait(10), 'The pipeline never finished')
+            return finished_stages, errors
+
+        def test_dependent_stages_run_together(self):
+            barrier = threading.Barrier(2, timeout=5)  # Breaks unless both populate stages run at the same time
+
+            def populate(name):
+                barrier.wait()
+                return name
+
+            stages = [Stage('connect', lambda: 'connected'),
+                      Stage('locations', lambda: populate('locations'), ('connect',)),
+                      Stage('reviews', lambda: populate('reviews'), ('connect',))]
+            finished_stages, errors = self.run_pipeline(stages)
+            self.assertEqual({}, errors)
+            self.assertEqual(('connect', 'connected'), finished_stages[0])
+            self.assertEqual({('locations', 'locations'), ('reviews', 'reviews')}, set(finished_stages[1:]))
+
+        def test_failed_stage_skips_dependents(self):
+            weather_ended = threading.Event()
+
+            def fail():
+                self.assertTrue(weather_ended.wait(5))  # The independent stage ends first, as with a wrong password
+                raise ValueError('No connection')
+
+            finished_stages, errors = self.run_pipeline([Stage('connect', fail),
+                                                         Stage('locations', lambda: 'locations', ('connect',)),
+                                                         Stage('weather', lambda: 'weather')],
+                                                        {'weather': weather_ended})
+            self.assertIsInstance(errors['connect'], ValueError)
+            self.assertIsInstance(errors['locations'], SkippedStage)
+            self.assertEqual([('weather', 'weather'), ('connect', None), ('locations', None)], finished_stages)
+
+        def test_unknown_dependency(self):
+            with self.assertRaises(ValueError):
+                StagePipeline([Stage('locations', lambda: None, ('connect',))], lambda *_progress: None)
+
+
+    class RoutingTests(TestCase):
+        start_date = date(2022, 4, 18)
+
+        @staticmethod
+        def make_graph() -> routing.RouteGraph:
+            cities = {1: routing.CityNode(1, 'Start', 'Here', 0, 0),
+                      2: routing.CityNode(2, 'Detour', 'There', 10, 0),
+                      3: routing.CityNode(3, 'Shortcut', 'Somewhere', 0, 5),
+                      4: routing.CityNode(4, 'Lincoln', 'Nebraska', 0, 10),
+                      5: routing.CityNode(5, 'Far', 'Away', 10, 10)}
+            routes = {1: {11: {2, 3}}, 2: {12: {5}}, 3: {13: {4}}, 5: {15: {4}}}
+            return routing.RouteGraph(cities, routes, routing.MAXIMUM_RANGE)
+
+        def test_shortest_route(self):
+            route = routing.find_route_home(self.make_graph(), 1, self.start_date, 0, lambda _airport, _date: True)
+            self.assertEqual([1, 3, 4], route)
+
+        def test_weather_forces_detour(self):
+            def can_take_off(airport_id, flight_date):
+                return not (airport_id == 13 and flight_date == self.start_date + timedelta(days=1))
+
+            self.assertEqual([1, 2, 5, 4], routing.find_route_home(self.make_graph(), 1, self.start_date, 0,
+                                                                   can_take_off))
+            self.assertIsNone(routing.find_route_home(self.make_graph(), 1, self.start_date, 15, can_take_off),
+                              'The detour would end after the journey has to be over')
+            self.assertEqual([1, 3, 4], routing.find_route_home(self.make_graph(), 1, self.start_date, 15,
+                                                                lambda _airport, _date: True))
+
+        def test_stopped_search(self):
+            self.assertIsNone(routing.find_route_home(self.make_graph(), 1, self.start_date, 0,
+                                                      lambda _airport, _date: True, should_stop=lambda: True))
+
+        def test_no_route(self):
+            self.assertIsNone(routing.find_route_home(self.make_graph(), 1, self.start_date, 0,
+                                                      lambda _airport, _date: False))
+
 except ImportError:
     pass
 
 try:
+    import os
+    import tempfile
+    import generator
     import installer
 
 
     class InstallerTests(TestCase):
-        pass
+
+        def test_starter_data(self):
+            session = create_in_memory_session()
+            for _ in range(2):
+                installer.add_starter_data(session)
+                self.assertEqual([5, 2, 4, 2, 3, 3, 7], [session.query(sql_type).count() for sql_type in [
+                    Airport, City, Forecast, Airplane, Operator, AirportCities, OperatorAirport]],
+                                 'Loading again should change nothing')
+            walter = get_object(session, Operator, name='Walter Airlines')
+            self.assertEqual('Bombardier CRJ700LR', walter.airplane.name)
+            self.assertEqual({'KLNK', 'KTPA', 'KDTW'}, {airport.ICAO_code for airport in walter.airports})
+
+        def test_load_files(self):
+            session = create_in_memory_session()
+            with tempfile.TemporaryDirectory() as directory:
+                def write(name, text):
+                    path = os.path.join(directory, name)
+                    with open(path, 'w') as file:
+                        file.write(text)
+                    return path
+
+                airports = write('airports.csv', 'ICAO,Name,Country,Latitude,Longitude\n'
+                                                 'KLNK,Lincoln,United States,40.85,-96.76\n'
+                                                 'komA,Eppley,United States,41.3,-95.89\n'
+                                                 'KTPA,Tampa,United States,27.98,-82.53\n')
+                cities = write('cities.jsonl', '{"name": "Lincoln", "geographic_identity": "Nebraska", '
+                                               '"latitude": 40.8, "longitude": -96.7, "airports": ["KLNK", "KOMA"]}\n')
+                operators = write('operators.csv', 'name,rate_my_pilot_score,airplane,airports\n'
+                                                   'Flightee,5,The Bee,KLNK;KTPA;NONE\n')
+                forecasts = write('forecasts.csv', 'ICAO_code,city,geographic_identity,date,temperature,visibility\n'
+                                                   'KLNK,,,2022-04-18,11,15\n'
+                                                   ',Lincoln,Nebraska,2022-04-18,12,\n'
+                                                   'NONE,,,2022-04-18,13,10\n')
+                for _ in range(2):
+                    self.assertEqual(3, installer.load_airports(session, installer.read_official_airports(airports),
+                                                                chunk_size=2))
+                    installer.load_airplanes(session, [{'name': 'The Bee', 'range': '5000'}])
+                    installer.load_cities(session, installer.read_records(cities))
+                    installer.load_operators(session, installer.read_records(operators), chunk_size=1)
+                    self.assertEqual(2, installer.load_forecasts(session, installer.read_records(forecasts)))
+                self.assertEqual(['KLNK', 'KOMA', 'KTPA'], get_values(session, Airport.ICAO_code))
+                self.assertEqual({'KLNK', 'KOMA'},
+                                 {airport.ICAO_code for airport in get_object(session, City, name='Lincoln').airports})
+                flightee = get_object(session, Operator, name='Flightee')
+                self.assertEqual(['KLNK', 'KTPA'], sorted(airport.ICAO_code for airport in flightee.airports))
+                self.assertEqual('The Bee', flightee.airplane.name)
+                self.assertEqual([11.0, 12.0], sorted(get_values(session, Forecast.temperature)))
+
+        def test_generate(self):
+            sizes = {'cities': 20, 'airports': 30, 'operators': 5, 'airports_per_operator': 3, 'airplanes': 12,
+                     'forecast_days': 3, 'reviews': 40, 'seed': 7, 'start_date': date(2022, 4, 18)}
+            first, second = create_in_memory_session(), create_in_memory_session()
+            self.assertEqual({'airports': 30, 'airplanes': 12, 'cities': 20, 'operators': 5, 'forecasts': 150,
+                              'reviews': 40}, generator.generate(first, **sizes))
+            generator.generate(second, **sizes)
+            for column in [Airport.ICAO_code, Airport.valid, Airplane.range, City.geographic_identity,
+                           Forecast.temperature, Review.review]:
+                self.assertEqual(get_values(first, column), get_values(second, column), 'The same seed should give '
+                                                                                        'the same rows')
+            self.assertEqual(15, first.query(OperatorAirport).count())
+            self.assertEqual(20, first.query(AirportCities).count())
+
+            generator.generate(first, **{**sizes, 'reviews': 0})
+            self.assertEqual([30, 20, 150, 40], [first.query(sql_type).count() for sql_type in [
+                Airport, City, Forecast, Review]], 'Generating again should update the same rows')
+            other = create_in_memory_session()
+            generator.generate(other, **{**sizes, 'seed': 8})
+            self.assertNotEqual(get_values(first, Airport.ICAO_code), get_values(other, Airport.ICAO_code))
+
+        def test_official_airports(self):
+            session = create_in_memory_session()
+            loaded = installer.load_airports(session, installer.read_official_airports())
+            self.assertGreater(loaded, 7000)
+            self.assertEqual(loaded, installer.load_airports(session, installer.read_official_airports()))
+            self.assertEqual(loaded, session.query(Airport).count())
 except ImportError:
     pass
 
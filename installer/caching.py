@@ -0,0 +1,178 @@
+import threading
+from collections import defaultdict
+from itertools import chain
+from time import monotonic
+from typing import Callable, Dict, Hashable, Iterable, NamedTuple, Optional, Set, Tuple
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+
+class DerivedDataCache(object):
+    # The derived data of one engine. Invalidations are numbered, so data built while a dependency changed isn't kept
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries: Dict[Hashable, Tuple[frozenset, object, float]] = {}  # Key -> (dependencies, data, built at)
+        self.version = 0
+        self.invalidated: Dict[type, int] = {}  # Class -> version
+        self.all_invalidated = 0
+
+    def get(self, key: Hashable, max_age: float = None) -> Tuple[Optional[tuple], int]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and max_age is not None and monotonic() - entry[2] >= max_age:
+                entry = None
+            return entry, self.version
+
+    def store(self, key: Hashable, dependencies: frozenset, data, since: int, built_at: float):
+        with self.lock:
+            if max([self.all_invalidated] + [self.invalidated.get(dependency, 0)
+                                             for dependency in dependencies]) <= since:
+                self.entries[key] = (dependencies, data, built_at)
+
+    def invalidate(self, changed_types: Iterable[type] = None):
+        with self.lock:
+            self.version += 1
+            if changed_types is None:
+                self.all_invalidated = self.version
+                self.entries.clear()
+                return
+            changed_types = set(changed_types)
+            for changed_type in changed_types:
+                self.invalidated[changed_type] = self.version
+            for key in [key for key, (dependencies, _, _) in self.entries.items()
+                        if not dependencies.isdisjoint(changed_types)]:
+                del self.entries[key]
+
+
+_engine_states_lock = threading.Lock()
+_derived_data = WeakKeyDictionary()  # Engine -> DerivedDataCache
+
+
+def _get_engine_state(states: WeakKeyDictionary, session: Session, factory: Callable[[], object]):
+    engine = session.get_bind()
+    with _engine_states_lock:
+        if engine not in states:
+            states[engine] = factory()
+        return states[engine]
+
+
+def get_derived_data(session: Session, key: Hashable, builder: Callable[[Session], object],
+                     dependencies: Iterable[type], max_age: float = None,
+                     is_current: Callable[[object], bool] = None):
+    # Reuses the data across sessions on the same engine until a flush or bulk statement changes one of dependencies,
+    # or it is max_age seconds old. is_current tells whether the cached data answers this call, if key only keeps the
+    # latest of a series
+    session.flush()  # Pending edits must reach the invalidation hooks before the cache is consulted
+    cache: DerivedDataCache = _get_engine_state(_derived_data, session, DerivedDataCache)
+    entry, version = cache.get(key, max_age)
+    if entry is not None and (is_current is None or is_current(entry[1])):
+        return entry[1]
+    built_at = monotonic()
+    data = builder(session)
+    cache.store(key, frozenset(dependencies), data, version, built_at)
+    return data
+
+
+def invalidate_derived_data(session: Session, changed_types: Iterable[type] = None):
+    _get_engine_state(_derived_data, session, DerivedDataCache).invalidate(changed_types)
+
+
+class ChangeLog(object):
+    # Primary keys of the rows changed through an engine, by the version they last changed in. Bulk statements and
+    # rollbacks don't say which rows they touch, so they mark whole classes as changed
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        self.changed: Dict[type, Dict[object, int]] = defaultdict(dict)  # Class -> {primary key: version}
+        self.bulk_changed: Dict[type, int] = {}  # Class -> version
+        self.all_changed = 0
+
+    def record(self, instances: Iterable[object]):
+        identities = []
+        for instance in instances:
+            identity = tuple(inspect(instance).mapper.primary_key_from_instance(instance))
+            identities.append((type(instance), identity[0] if len(identity) == 1 else identity))
+        with self.lock:
+            self.version += 1
+            for changed_type, primary_key in identities:
+                self.changed[changed_type][primary_key] = self.version
+
+    def record_bulk(self, changed_types: Iterable[type] = None):
+        with self.lock:
+            self.version += 1
+            if changed_types is None:
+                self.all_changed = self.version
+            else:
+                for changed_type in changed_types:
+                    self.bulk_changed[changed_type] = self.version
+
+    def get_version(self) -> int:
+        with self.lock:
+            return self.version
+
+    def get_changed_ids(self, sql_type: type, since: int) -> Optional[Set]:
+        with self.lock:
+            if max(self.all_changed, self.bulk_changed.get(sql_type, 0)) > since:
+                return None
+            return {primary_key for primary_key, version in self.changed[sql_type].items() if version > since}
+
+
+_change_logs = WeakKeyDictionary()  # Engine -> ChangeLog
+
+
+def _get_change_log(session: Session) -> ChangeLog:
+    return _get_engine_state(_change_logs, session, ChangeLog)
+
+
+class ChangeVersion(NamedTuple):
+    number: int
+    taken_at: float  # From monotonic()
+
+
+def get_change_version(session: Session) -> ChangeVersion:
+    session.flush()
+    return ChangeVersion(_get_change_log(session).get_version(), monotonic())
+
+
+def get_changed_ids(session: Session, sql_type: type, since: Optional[ChangeVersion],
+                    max_age: float = None) -> Optional[Set]:
+    # None if every row has to be queried again
+    session.flush()
+    if since is None or max_age is not None and monotonic() - since.taken_at >= max_age:
+        return None
+    return _get_change_log(session).get_changed_ids(sql_type, since.number)
+
+
+def record_bulk_changes(session: Session, changed_types: Iterable[type] = None):
+    # For changes that skip the flush. None means every class
+    invalidate_derived_data(session, changed_types)
+    _get_change_log(session).record_bulk(changed_types)
+
+
+@event.listens_for(Session, 'after_flush')
+def _on_flush(session, _flush_context):
+    instances = list(chain(session.new, session.dirty, session.deleted))
+    invalidate_derived_data(session, {type(instance) for instance in instances})
+    _get_change_log(session).record(instances)
+    session.info['uncommitted_flush'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+@event.listens_for(Session, 'after_rollback')
+def _on_transaction_end(session):
+    session.info.pop('uncommitted_flush', None)
+
+
+@event.listens_for(Session, 'after_soft_rollback')
+def _on_rollback(session, _previous_transaction):
+    record_bulk_changes(session)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _on_orm_execute(orm_execute_state):
+    if not orm_execute_state.is_select:  # Bulk insert/update/delete statements skip the flush
+        record_bulk_changes(orm_execute_state.session, {mapper.class_ for mapper in orm_execute_state.all_mappers})
@@ -1,20 +1,43 @@
+import functools
+import os
+import threading
 import traceback
-from math import sin, cos, acos, radians
-from typing import Type, Tuple
-
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Float, Date, Boolean
-from sqlalchemy.exc import SQLAlchemyError, StatementError, NoResultFound, DataError
+import datetime
+from contextlib import contextmanager
+from math import sin, cos, acos, asin, sqrt, radians
+from typing import Type, Tuple, Iterable, Sequence, Dict, List, Optional
+
+import numpy
+from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, Float, Date, Boolean, inspect, or_, \
+    Index, select, delete, func, make_url
+from sqlalchemy.exc import SQLAlchemyError, StatementError, NoResultFound, DataError, IntegrityError, DBAPIError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship, Session
 
+# Re-exported for the apps, which import everything from database
+from caching import get_derived_data, invalidate_derived_data, ChangeVersion, get_change_version, get_changed_ids, \
+    record_bulk_changes
+from profiling import QueryProfiler, OperationStats, profile_operation, profiled, get_statement_shape
+
 Persisted = declarative_base()
 
+EARTH_RADIUS = 6371  # Unit: kilometer
+BATCH_SIZE = 1000
+PAGE_SIZE = 50  # Values shown at once by pickers over catalogs too big to load whole
+PROFILE_QUERIES = os.environ.get('PROFILE_QUERIES', '') not in ('', '0')  # Profile every Database by default
+POOL_SIZE = 5  # Connections kept open per engine
+POOL_MAX_OVERFLOW = 10  # Connections opened beyond POOL_SIZE under load, closed once returned
+# Unit: second. Other clients write to the same database, and only this process's changes are tracked, so data cached
+# from tables they write is built or queried again once it is this old
+SHARED_DATA_MAX_AGE = 30
+POOL_RECYCLE = 1800  # Unit: second. Connections are replaced before MySQL's wait_timeout drops them as idle
+
 
 class Airport(Persisted):
     __tablename__ = 'airports'
     airport_id = Column(Integer, primary_key=True)
-    name = Column(String(256), nullable=False)
-    ICAO_code = Column(String(4), nullable=False)
+    name = Column(String(256), nullable=False, index=True)
+    ICAO_code = Column(String(4), nullable=False, index=True, unique=True)
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
     valid = Column(Boolean, default=False)
@@ -32,6 +55,7 @@ class Airport(Persisted):
 
 class City(Persisted):
     __tablename__ = 'cities'
+    __table_args__ = (Index('ix_cities_name_geographic_identity', 'name', 'geographic_identity', unique=True),)
     city_id = Column(Integer, primary_key=True)
     name = Column(String(256), nullable=False)
     geographic_identity = Column(String(256), nullable=False)
@@ -51,6 +75,8 @@ class City(Persisted):
 
 class Forecast(Persisted):
     __tablename__ = 'forecast'
+    __table_args__ = (Index('ix_forecast_airport_id_date', 'airport_id', 'date', unique=True),
+                      Index('ix_forecast_city_id_date', 'city_id', 'date', unique=True))
     forecast_id = Column(Integer, primary_key=True)
     airport_id = Column(Integer, ForeignKey('airports.airport_id', ondelete='CASCADE'))
     city_id = Column(Integer, ForeignKey('cities.city_id', ondelete='CASCADE'))
@@ -73,7 +99,7 @@ class AirportCities(Persisted):
 class Airplane(Persisted):
     __tablename__ = 'airplanes'
     airplane_id = Column(Integer, primary_key=True)
-    name = Column(String(256), nullable=False)
+    name = Column(String(256), nullable=False, index=True, unique=True)
     range = Column(Float, nullable=False)  # Unit: kilometer
     operators = relationship('Operator', back_populates='airplane', uselist=True)
 
@@ -84,7 +110,7 @@ class Airplane(Persisted):
 class Operator(Persisted):
     __tablename__ = 'operators'
     operator_id = Column(Integer, primary_key=True)
-    name = Column(String(256), nullable=False)
+    name = Column(String(256), nullable=False, index=True, unique=True)
     rate_my_pilot_score = Column(Float, nullable=False)
     airplane_id = Column(Integer, ForeignKey('airplanes.airplane_id', ondelete='CASCADE'))
     airports = relationship('Airport', uselist=True, secondary='operator_airports', back_populates='operators')
@@ -105,34 +131,151 @@ class Review(Persisted):
     __tablename__ = 'reviews'
     review_id = Column(Integer, primary_key=True)
     review = Column(Float, nullable=False)
-    operator_id = Column(Integer, ForeignKey('operators.operator_id', ondelete='CASCADE'))
+    operator_id = Column(Integer, ForeignKey('operators.operator_id', ondelete='CASCADE'), index=True)
     operator = relationship('Operator', back_populates='reviews')
 
 
 def get_is_nearby(session: Session, latitude: float, longitude: float, sql_type: Type[Persisted],
                   range: float = 1) -> bool:
-    return session.query(sql_type).filter(sql_type.latitude >= float(latitude) - range,
-                                          sql_type.latitude <= float(latitude) + range,
-                                          sql_type.longitude >= float(longitude) - range,
-                                          sql_type.longitude <= float(longitude) + range).count() > 0
+    return len(get_spatial_index(session, sql_type).get_in_box(float(latitude), float(longitude), range)) > 0
 
 
 def get_nearby(session: Session, latitude: float, longitude: float, sql_type: Type[Persisted],
                range: float = 1) -> list:
-    return session.query(sql_type).filter(sql_type.latitude >= float(latitude) - range,
-                                          sql_type.latitude <= float(latitude) + range,
-                                          sql_type.longitude >= float(longitude) - range,
-                                          sql_type.longitude <= float(longitude) + range).all()
+    return get_objects_by_id(session, sql_type,
+                             get_spatial_index(session, sql_type).get_in_box(float(latitude), float(longitude), range))
+
+
+def get_within_radius(session: Session, latitude: float, longitude: float, sql_type: Type[Persisted],
+                      radius: float) -> list:
+    # Unit of radius: kilometer. Closest first
+    return get_objects_by_id(session, sql_type,
+                             get_spatial_index(session, sql_type).get_within_radius(float(latitude), float(longitude),
+                                                                                    radius))
+
+
+def get_nearest(session: Session, latitude: float, longitude: float, sql_type: Type[Persisted],
+                count: int = 1) -> list:
+    # Closest first
+    return get_objects_by_id(session, sql_type,
+                             get_spatial_index(session, sql_type).get_nearest(float(latitude), float(longitude), count))
+
+
+def get_objects_by_id(session: Session, sql_type: Type[Persisted], ids: Sequence[int]) -> list:
+    # In one query, keeping the order of ids
+    if len(ids) == 0:
+        return []
+    primary_key = inspect(sql_type).primary_key[0]
+    objects = {getattr(element, primary_key.key): element
+               for element in session.query(sql_type).filter(primary_key.in_(ids)).all()}
+    return [objects[element_id] for element_id in ids if element_id in objects]
+
+
+class SpatialIndex(object):
+    # In-memory grid over the locations of one table, in cells of cell_size degrees, so nearby lookups only search
+    # the cells overlapping them instead of scanning the table
+    KILOMETERS_PER_DEGREE = 111.195  # Along a meridian
+    HALF_CIRCUMFERENCE = 20016  # Unit: kilometer. No two points are further apart than this
+
+    def __init__(self, ids: Sequence[int], latitudes: Sequence[float], longitudes: Sequence[float],
+                 cell_size: float = 1):
+        self.cell_size = cell_size
+        self.columns = int(round(360 / cell_size))
+        self.ids = numpy.asarray(ids, dtype=int)
+        self.latitudes = numpy.asarray(latitudes, dtype=float)
+        self.longitudes = numpy.asarray(longitudes, dtype=float)
+        cell_rows = numpy.floor(self.latitudes / cell_size).astype(int)
+        cell_columns = numpy.floor(self.longitudes / cell_size).astype(int) % self.columns
+        order = numpy.lexsort((cell_columns, cell_rows))
+        cells = numpy.stack([cell_rows[order], cell_columns[order]], axis=1)
+        unique_cells, starts = numpy.unique(cells, axis=0, return_index=True)
+        ends = numpy.append(starts[1:], len(order))
+        self.cells = {(int(row), int(column)): order[start:end]
+                      for (row, column), start, end in zip(unique_cells, starts, ends)}
+
+    @staticmethod
+    def build(session: Session, sql_type: Type[Persisted], cell_size: float = 1) -> 'SpatialIndex':
+        rows = session.query(inspect(sql_type).primary_key[0], sql_type.latitude, sql_type.longitude).all()
+        ids, latitudes, longitudes = zip(*rows) if rows else ((), (), ())
+        return SpatialIndex(ids, latitudes, longitudes, cell_size)
+
+    def _get_candidates(self, latitude: float, longitude: float, latitude_span: float,
+                        longitude_span: float) -> numpy.ndarray:
+        first_row = int(numpy.floor((latitude - latitude_span) / self.cell_size))
+        last_row = int(numpy.floor((latitude + latitude_span) / self.cell_size))
+        if longitude_span >= 180:
+            columns = range(self.columns)
+        else:
+            first_column = int(numpy.floor((longitude - longitude_span) / self.cell_size))
+            last_column = int(numpy.floor((longitude + longitude_span) / self.cell_size))
+            columns = {column % self.columns for column in range(first_column, last_column + 1)}
+        found = [self.cells[row, column] for row in range(first_row, last_row + 1) for column in columns
+                 if (row, column) in self.cells]
+        return numpy.concatenate(found) if found else numpy.empty(0, dtype=int)
+
+    def get_in_box(self, latitude: float, longitude: float, span: float) -> list:
+        candidates = self._get_candidates(latitude, longitude, span, span)
+        longitude_offsets = (self.longitudes[candidates] - longitude + 180) % 360 - 180
+        inside = (numpy.abs(self.latitudes[candidates] - latitude) <= span) & (numpy.abs(longitude_offsets) <= span)
+        return self.ids[candidates[inside]].tolist()
+
+    def get_within_radius(self, latitude: float, longitude: float, radius: float) -> list:
+        # Unit of radius: kilometer. Closest first
+        latitude_span = radius / SpatialIndex.KILOMETERS_PER_DEGREE
+        furthest_latitude = abs(latitude) + latitude_span
+        longitude_span = 180 if furthest_latitude >= 90 else latitude_span / cos(radians(furthest_latitude))
+        candidates = self._get_candidates(latitude, longitude, latitude_span, longitude_span)
+        distances = get_distance_matrix([(latitude, longitude)],
+                                        numpy.stack([self.latitudes[candidates], self.longitudes[candidates]],
+                                                    axis=1))[0]
+        inside = distances <= radius
+        return self.ids[candidates[inside][numpy.argsort(distances[inside], kind='stable')]].tolist()
+
+    def get_nearest(self, latitude: float, longitude: float, count: int = 1) -> list:
+        # Closest first
+        radius = self.cell_size * SpatialIndex.KILOMETERS_PER_DEGREE
+        found = self.get_within_radius(latitude, longitude, radius)
+        while len(found) < count and radius < SpatialIndex.HALF_CIRCUMFERENCE:
+            radius *= 2
+            found = self.get_within_radius(latitude, longitude, radius)
+        return found[:count]
+
+
+def get_spatial_index(session: Session, sql_type: Type[Persisted]) -> SpatialIndex:
+    return get_derived_data(session, (SpatialIndex, sql_type), lambda inner_session: SpatialIndex.build(
+        inner_session, sql_type), (sql_type,), SHARED_DATA_MAX_AGE)
 
 
 def get_great_circle_distance(source: Tuple[float, float], destination: Tuple[float, float]):
     lon_1, lat_1, lon_2, lat_2 = map(radians, [source[0], source[1], destination[0], destination[1]])
-    distance = 6371 * (acos(sin(lat_1) * sin(lat_2) + cos(lat_1) * cos(lat_2) * cos(lon_1 - lon_2)))
+    distance = EARTH_RADIUS * (acos(sin(lat_1) * sin(lat_2) + cos(lat_1) * cos(lat_2) * cos(lon_1 - lon_2)))
     return distance
 
 
+def get_haversine_distance(source: Tuple[float, float], destination: Tuple[float, float]) -> float:
+    # Unlike get_great_circle_distance, accurate for nearby points and never outside the domain of asin
+    latitude_1, longitude_1, latitude_2, longitude_2 = map(radians, [source[0], source[1], destination[0],
+                                                                     destination[1]])
+    half_chord = sin((latitude_2 - latitude_1) / 2) ** 2 + \
+        cos(latitude_1) * cos(latitude_2) * sin((longitude_2 - longitude_1) / 2) ** 2
+    return 2 * EARTH_RADIUS * asin(min(1.0, sqrt(half_chord)))
+
+
+def get_distance_matrix(sources: Sequence[Tuple[float, float]],
+                        destinations: Sequence[Tuple[float, float]] = None) -> numpy.ndarray:
+    # Kilometers from each of sources to each of destinations, or between all of the sources if destinations is None
+    sources = numpy.radians(numpy.asarray(sources, dtype=float).reshape(-1, 2))
+    destinations = sources if destinations is None else \
+        numpy.radians(numpy.asarray(destinations, dtype=float).reshape(-1, 2))
+    latitudes_1, longitudes_1 = sources[:, 0, None], sources[:, 1, None]
+    latitudes_2, longitudes_2 = destinations[None, :, 0], destinations[None, :, 1]
+    half_chords = numpy.sin((latitudes_2 - latitudes_1) / 2) ** 2 + \
+        numpy.cos(latitudes_1) * numpy.cos(latitudes_2) * numpy.sin((longitudes_2 - longitudes_1) / 2) ** 2
+    return 2 * EARTH_RADIUS * numpy.arcsin(numpy.sqrt(numpy.clip(half_chords, 0, 1)))
+
+
 def get_exists(session: Session, sql_type: Type[Persisted], **kwargs) -> bool:
-    return session.query(sql_type).filter_by(**kwargs).count() > 0
+    return session.query(session.query(sql_type).filter_by(**kwargs).exists()).scalar()
 
 
 def delete_object(session: Session, sql_type: Type[Persisted], **kwargs) -> Persisted:
@@ -147,16 +290,187 @@ def get_objects(session: Session, sql_type: Type[Persisted], **kwargs) -> list:
     return session.query(sql_type).filter_by(**kwargs).all()
 
 
+def get_values(session: Session, column, distinct=False, limit: int = None, offset: int = None, **kwargs) -> list:
+    # Only column, e.g. Airport.name, instead of whole objects. Sorted if distinct, else in primary key order
+    query = session.query(column).filter_by(**kwargs)
+    query = query.distinct().order_by(column) if distinct else query.order_by(*inspect(column.class_).primary_key)
+    return [value for value, in query.offset(offset).limit(limit)]
+
+
+def get_page(session: Session, column, prefix: str = '', after=None, limit: int = PAGE_SIZE, **kwargs) -> list:
+    # Keyset pagination: a page starts after the last value of the one before, so with an index on column every
+    # page, and the prefix search, costs the same
+    query = session.query(column).filter_by(**kwargs)
+    if prefix:
+        # A range instead of LIKE, which can't use the index with every collation
+        query = query.filter(column >= prefix, column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    if after is not None:
+        query = query.filter(column > after)
+    return [value for value, in query.distinct().order_by(column).limit(limit)]
+
+
+def get_values_by_id(session: Session, column, ids: Iterable = None, **kwargs) -> dict:
+    # The value of each row by primary key, only for ids if given
+    primary_key = inspect(column.class_).primary_key[0]
+    query = session.query(primary_key, column).filter_by(**kwargs)
+    if ids is not None:
+        query = query.filter(primary_key.in_(list(ids)))
+    return dict(query)
+
+
+def get_reviews_with_operators(session: Session, review_ids: Iterable[int] = None,
+                               operator_ids: Iterable[int] = None) -> list:
+    # One joined query instead of one operator query per review
+    query = session.query(Review.review_id, Review.review, Operator.name.label('operator_name'),
+                          Operator.rate_my_pilot_score).join(Review.operator)
+    if review_ids is not None or operator_ids is not None:
+        query = query.filter(or_(Review.review_id.in_(list(review_ids or [])),
+                                 Review.operator_id.in_(list(operator_ids or []))))
+    return query.all()
+
+
 def create_object(session: Session, sql_type: Type[Persisted], **kwargs) -> Persisted:
+    # Duplicates are left to the unique constraints instead of being queried first
     new_object = sql_type(**kwargs)
     session.add(new_object)
-    session.commit()
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        raise
     return new_object
 
 
+def parse_daily_forecasts(record: dict) -> List[dict]:
+    # From an OpenWeather onecall response in metric units. Dates are local to the location
+    offset = datetime.timedelta(seconds=record.get('timezone_offset', 0))
+
+    def get_date(timestamp: int) -> datetime.date:
+        return (datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc) + offset).date()
+
+    # Daily forecasts have no visibility, so a day gets the lowest of the current and hourly ones (48 hours) on it
+    visibilities: Dict[datetime.date, int] = {}  # Unit: meter
+    for forecast in [record.get('current', {})] + record.get('hourly', []):
+        if forecast.get('visibility') is not None:
+            day = get_date(forecast['dt'])
+            visibilities[day] = min(forecast['visibility'], visibilities.get(day, forecast['visibility']))
+    forecasts = []
+    for forecast in record['daily']:
+        day = get_date(forecast['dt'])
+        visibility = forecast.get('visibility', visibilities.get(day))
+        forecasts.append({
+            'date': day,
+            'temperature': (forecast['temp']['max'] + forecast['temp']['min']) / 2,
+            'visibility': round(visibility / 1000) if visibility is not None else None,
+            'precipitation_probability': forecast['pop'],
+            'wind_speed': forecast['wind_speed'] * 3.6,  # meter/second to kilometer/hour
+            'weather_description': forecast['weather'][0]['description'],
+        })
+    return forecasts
+
+
+def ingest_forecasts(session: Session, records: Iterable[Tuple[Dict[str, int], dict]],
+                     batch_size: int = BATCH_SIZE) -> int:
+    # records are ({'airport_id': id} or {'city_id': id}, onecall response) pairs. One transaction per batch
+    stored = 0
+    batch = []
+    for owner, record in records:
+        for forecast in parse_daily_forecasts(record):
+            batch.append({'airport_id': owner.get('airport_id'), 'city_id': owner.get('city_id'), **forecast})
+            if len(batch) >= batch_size:
+                stored += upsert_forecasts(session, batch)
+                batch = []
+    if batch:
+        stored += upsert_forecasts(session, batch)
+    return stored
+
+
+def upsert_forecasts(session: Session, rows: List[dict]) -> int:
+    # Updates the forecasts stored for the same (airport_id, city_id, date) and bulk inserts the rest
+    rows = list({(row['airport_id'], row['city_id'], row['date']): row for row in rows}.values())  # Last one wins
+    airport_ids = {row['airport_id'] for row in rows if row['airport_id'] is not None}
+    city_ids = {row['city_id'] for row in rows if row['city_id'] is not None}
+    try:
+        existing = {(airport_id, city_id, date): forecast_id for forecast_id, airport_id, city_id, date in
+                    session.query(Forecast.forecast_id, Forecast.airport_id, Forecast.city_id, Forecast.date)
+                    .filter(or_(Forecast.airport_id.in_(airport_ids), Forecast.city_id.in_(city_ids)),
+                            Forecast.date.in_({row['date'] for row in rows}))}
+        updates, inserts = [], []
+        for row in rows:
+            forecast_id = existing.get((row['airport_id'], row['city_id'], row['date']))
+            if forecast_id is not None:
+                updates.append({'forecast_id': forecast_id, **row})
+            else:
+                inserts.append(row)
+        session.bulk_update_mappings(Forecast, updates)
+        session.bulk_insert_mappings(Forecast, inserts)
+        session.commit()
+    except SQLAlchemyError:
+        session.rollback()
+        raise
+    record_bulk_changes(session, [Forecast])  # Bulk mappings skip the flush hooks
+    return len(rows)
+
+
+def get_ids(session: Session, sql_type: Type[Persisted], key: Sequence[str], values: Iterable[tuple]) -> dict:
+    # The primary key of each stored natural key, e.g. of airports by ('ICAO_code',), in one query
+    values = set(values)
+    if not values:
+        return {}
+    columns = [getattr(sql_type, name) for name in key]
+    query = session.query(inspect(sql_type).primary_key[0], *columns)
+    for index, column in enumerate(columns):
+        query = query.filter(column.in_({value[index] for value in values}))
+    return {tuple(row[1:]): row[0] for row in query if tuple(row[1:]) in values}
+
+
+def upsert_rows(session: Session, sql_type: Type[Persisted], key: Sequence[str], rows: List[dict]) -> int:
+    # Updates the rows whose natural key is stored and bulk inserts the rest, so storing rows again changes nothing
+    rows = list({tuple(row[name] for name in key): row for row in rows}.values())  # Last one wins
+    primary_key = inspect(sql_type).primary_key[0].key
+    try:
+        existing = get_ids(session, sql_type, key, (tuple(row[name] for name in key) for row in rows))
+        updates, inserts = [], []
+        for row in rows:
+            found = existing.get(tuple(row[name] for name in key))
+            if found is not None:
+                updates.append({primary_key: found, **row})
+            else:
+                inserts.append(row)
+        session.bulk_update_mappings(sql_type, updates)
+        session.bulk_insert_mappings(sql_type, inserts)
+        session.commit()
+    except SQLAlchemyError:
+        session.rollback()
+        raise
+    record_bulk_changes(session, [sql_type])
+    return len(rows)
+
+
+def add_links(session: Session, link_type: Type[Persisted], rows: List[dict]) -> int:
+    # Only inserts the links that aren't stored yet
+    key = [column.key for column in inspect(link_type).primary_key]
+    links = {tuple(row[name] for name in key) for row in rows}
+    try:
+        new_links = links - set(get_ids(session, link_type, key, links))
+        session.bulk_insert_mappings(link_type, [dict(zip(key, link)) for link in new_links])
+        session.commit()
+    except SQLAlchemyError:
+        session.rollback()
+        raise
+    record_bulk_changes(session, [link_type])
+    return len(new_links)
+
+
 def handle_error(e, session) -> str:
     traceback.print_exc()
-    if isinstance(e, StatementError):
+    if isinstance(e, DBAPIError) and e.connection_invalidated:
+        session.rollback()  # The pool replaces the connection on the next query
+        return 'The connection to the database was lost. Please try again.'
+    elif isinstance(e, IntegrityError):
+        session.rollback()
+        return 'That is already in the database. Please try again'
+    elif isinstance(e, StatementError):
         session.rollback()
         return 'ICAO codes are only 4 characters long. Please chose a shorter ICAO code'
     elif isinstance(e, SQLAlchemyError) or isinstance(e, DataError):
@@ -170,6 +484,77 @@ def handle_error(e, session) -> str:
         return f'error: {e}'
 
 
+class DuplicateRowsError(SQLAlchemyError):
+    def __init__(self, table: str, columns: List[str], duplicates: list):
+        values = ', '.join(str(tuple(duplicate)) for duplicate in duplicates)
+        super().__init__(f'{table} has rows sharing their {", ".join(columns)}: {values}. Merge or rename them, then '
+                         f'upgrade the schema again')
+        self.table = table
+        self.duplicates = duplicates
+
+
+def _remove_duplicates(connection, index: Index):
+    # Forecasts stored twice are reduced to the latest one; other duplicates are for the user to merge
+    table = index.table
+    columns = list(index.columns)
+    not_null = [column.isnot(None) for column in columns]  # Rows with a NULL in the index never conflict
+    duplicates = connection.execute(select(*columns).where(*not_null).group_by(*columns)
+                                    .having(func.count() > 1).limit(10)).all()
+    if not duplicates:
+        return
+    if table is not Forecast.__table__:
+        raise DuplicateRowsError(table.name, [column.name for column in columns], duplicates)
+    latest = select(func.max(table.c.forecast_id).label('forecast_id')).where(*not_null).group_by(*columns).subquery()
+    connection.execute(delete(table).where(*not_null, table.c.forecast_id.not_in(select(latest.c.forecast_id))))
+
+
+def upgrade_schema(engine) -> List[str]:
+    # Adds what a database made by an older installer lacks, so it needn't be dropped and reinstalled
+    Persisted.metadata.create_all(engine)  # Missing tables are made with their indexes
+    inspector = inspect(engine)
+    created = []
+    for table in Persisted.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                with engine.begin() as connection:
+                    if index.unique:
+                        _remove_duplicates(connection, index)
+                    index.create(connection)
+                created.append(index.name)
+    return created
+
+
+def release_connection(session: Session):
+    # Ends a transaction without unsaved changes, so its connection goes back to the pool instead of idling
+    if session.in_transaction() and not (session.new or session.dirty or session.deleted or
+                                         session.info.get('uncommitted_flush')):
+        try:
+            session.commit()
+        except SQLAlchemyError:  # The connection was already lost; the pool replaces it on the next query
+            session.rollback()
+
+
+def operation(function):
+    # For UI handlers, whose first argument is the session or has it as session
+    function = profiled(function)
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            session = _get_handler_session(args)
+            if session is not None:
+                release_connection(session)
+    return wrapper
+
+
+def _get_handler_session(args: tuple) -> Optional[Session]:
+    session = getattr(args[0], 'session', args[0]) if args else None
+    return session if isinstance(session, Session) else None
+
+
 class Database(object):
     @staticmethod
     def construct_mysql_url(authority, port, database, username, password):
@@ -179,13 +564,47 @@ class Database(object):
     def construct_in_memory_url():
         return 'sqlite:///'
 
-    def __init__(self, url):
-        self.engine = create_engine(url)
+    def __init__(self, url, profile_queries: bool = PROFILE_QUERIES, pool_size: int = POOL_SIZE,
+                 max_overflow: int = POOL_MAX_OVERFLOW, pool_recycle: int = POOL_RECYCLE, pool_pre_ping: bool = True):
+        options = {'pool_recycle': pool_recycle, 'pool_pre_ping': pool_pre_ping}
+        if make_url(url).get_backend_name() != 'sqlite':
+            options.update(pool_size=pool_size, max_overflow=max_overflow)
+        self.engine = create_engine(url, **options)
         self.Session = sessionmaker()
         self.Session.configure(bind=self.engine)
+        self.profiler = QueryProfiler(self.engine)
+        if profile_queries:
+            self.profiler.enable(dump_at_exit=True)
 
     def ensure_tables_exist(self):
         Persisted.metadata.create_all(self.engine)
 
+    def upgrade_schema(self) -> List[str]:
+        return upgrade_schema(self.engine)
+
     def create_session(self):
         return self.Session()
+
+    @contextmanager
+    def session_scope(self):
+        session = self.create_session()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+
+_databases: Dict[str, Database] = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(url: str, **kwargs) -> Database:
+    # One Database per url, so connecting again reuses its engine and pooled connections
+    with _databases_lock:
+        if url not in _databases:
+            _databases[url] = Database(url, **kwargs)
+        return _databases[url]
@@ -0,0 +1,168 @@
+import argparse
+import datetime
+import random
+from math import cos, radians
+from typing import Dict, Iterator, List
+
+from database import Database, Operator, Review, BATCH_SIZE, get_values_by_id, record_bulk_changes
+from installer import read_official_airports, load_airports, load_airplanes, load_cities, load_operators, \
+    load_forecasts, chunked, OFFICIAL_AIRPORTS
+
+AIRPLANES = [  # Name, range in kilometers
+    ('Cessna 172', 1289), ('ATR 72-600', 1528), ('Dash 8 Q400', 2040), ('Embraer 135', 3100),
+    ('Beechcraft King Air 350', 3345), ('Pilatus PC-12', 3417), ('Bombardier CRJ700LR', 3700),
+    ('Embraer 175', 3735), ('Boeing 737-800', 5436), ('Airbus A220-300', 6297),
+]
+REGIONS = ['Nebraska', 'Iowa', 'Kansas', 'Missouri', 'Colorado', 'Texas', 'Florida', 'Michigan', 'Ontario', 'Bavaria',
+           'Queensland', 'Hokkaido']
+WEATHER = [  # Description, precipitation probability
+    ('clear sky', 0.0), ('few clouds', 0.1), ('scattered clouds', 0.2), ('broken clouds', 0.3),
+    ('overcast clouds', 0.4), ('light rain', 0.6), ('moderate rain', 0.7), ('thunderstorm', 0.85), ('snow', 0.9),
+]
+CITY_DISTANCE = 50  # Unit: kilometer. Cities are placed at most about this far from their airport
+
+
+class DatasetGenerator(object):
+    """
+    Generates rows shaped like the apps' data at any scale. Each table is drawn from its own random number generator
+    seeded from seed, so the same seed always gives the same rows, and the size of one table doesn't change the rows
+    of another. Rows are generated as they are consumed, so memory doesn't grow with the size of the dataset.
+    """
+
+    def __init__(self, seed: int = 0, start_date: datetime.date = None, airports_file=OFFICIAL_AIRPORTS):
+        """
+        :param start_date: first day of forecasts, today by default
+        :param airports_file: official airports to draw airports from, in the format of airports.csv
+        """
+        self.seed = seed
+        self.start_date = start_date or datetime.date.today()
+        self.airports_file = airports_file
+
+    def get_random(self, table: str) -> random.Random:
+        return random.Random(f'{self.seed}:{table}')
+
+    def airports(self, count: int, invalid_fraction: float = 0) -> List[dict]:
+        """
+        :returns: count airports drawn from the official airports, or all of them if there are fewer
+        """
+        generator = self.get_random('airports')
+        official = list(read_official_airports(self.airports_file))
+        airports = generator.sample(official, min(count, len(official)))
+        for airport in airports:
+            airport['valid'] = generator.random() >= invalid_fraction
+        return airports
+
+    def airplanes(self, count: int) -> Iterator[dict]:
+        """
+        Real airplanes first, then variants of them with ranges within 10% of the original.
+        """
+        generator = self.get_random('airplanes')
+        for index in range(count):
+            name, airplane_range = AIRPLANES[index % len(AIRPLANES)]
+            if index >= len(AIRPLANES):
+                name = f'{name} #{index // len(AIRPLANES) + 1}'
+                airplane_range = round(airplane_range * generator.uniform(0.9, 1.1))
+            yield {'name': name, 'range': airplane_range}
+
+    def cities(self, count: int, airports: List[dict], invalid_fraction: float = 0) -> Iterator[dict]:
+        """
+        Each city is placed near a random airport, which serves it.
+        """
+        generator = self.get_random('cities')
+        for index in range(count):
+            airport = generator.choice(airports)
+            offset = CITY_DISTANCE / 111  # Unit: degree of latitude
+            latitude = max(-90.0, min(90.0, float(airport['latitude']) + generator.uniform(-offset, offset)))
+            longitude = float(airport['longitude']) + generator.uniform(-offset, offset) / \
+                max(cos(radians(latitude)), 0.1)
+            yield {'name': f'City {index:06}', 'geographic_identity': generator.choice(REGIONS),
+                   'latitude': latitude, 'longitude': (longitude + 180) % 360 - 180,
+                   'airports': [airport['ICAO_code']], 'valid': generator.random() >= invalid_fraction}
+
+    def operators(self, count: int, airports_per_operator: int, airports: List[dict],
+                  airplane_names: List[str]) -> Iterator[dict]:
+        generator = self.get_random('operators')
+        codes = [airport['ICAO_code'] for airport in airports]
+        for index in range(count):
+            yield {'name': f'Operator {index:06}', 'rate_my_pilot_score': round(generator.uniform(1, 5), 1),
+                   'airplane': generator.choice(airplane_names),
+                   'airports': generator.sample(codes, min(airports_per_operator, len(codes)))}
+
+    def forecasts(self, days: int, airports: List[dict], city_count: int = 0) -> Iterator[dict]:
+        """
+        Daily forecasts for each airport and each of the first city_count cities, colder towards the poles. Some days
+        are bad enough to ground flights.
+        """
+        generator = self.get_random('forecasts')
+        owners = [({'ICAO_code': airport['ICAO_code']}, float(airport['latitude'])) for airport in airports]
+        cities = (({'city': city['name'], 'geographic_identity': city['geographic_identity']}, city['latitude'])
+                  for city in self.cities(city_count, airports))
+        for owners_of_kind in [owners, cities]:
+            for owner, latitude in owners_of_kind:
+                for day in range(days):
+                    description, precipitation = generator.choice(WEATHER)
+                    yield {**owner, 'date': self.start_date + datetime.timedelta(days=day),
+                           'temperature': round(generator.gauss(30 - abs(latitude) * 0.6, 8), 1),
+                           'visibility': generator.choice([16] * 8 + [10, 8, 4, 1]),
+                           'precipitation_probability': precipitation,
+                           'wind_speed': round(generator.uniform(0, 60), 2), 'weather_description': description}
+
+    def reviews(self, count: int, operator_ids: List[int]) -> Iterator[dict]:
+        generator = self.get_random('reviews')
+        for _ in range(count):
+            yield {'operator_id': generator.choice(operator_ids), 'review': round(generator.uniform(1, 5), 1)}
+
+
+def generate(session, cities: int = 100, airports: int = 500, operators: int = 50, airports_per_operator: int = 10,
+             airplanes: int = 10, forecast_days: int = 8, reviews: int = 500, seed: int = 0,
+             invalid_fraction: float = 0.05, start_date: datetime.date = None,
+             chunk_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """
+    Loads a generated dataset with the installer's loaders, so generating again with the same seed updates the same
+    rows. Reviews have no natural key, so they are added again.
+
+    :param invalid_fraction: share of the airports and cities left for validation
+    :returns: the number of rows stored, by table
+    """
+    generator = DatasetGenerator(seed, start_date)
+    drawn_airports = generator.airports(airports, invalid_fraction)
+    airplane_names = [airplane['name'] for airplane in generator.airplanes(airplanes)]
+    counts = {
+        'airports': load_airports(session, drawn_airports, chunk_size),
+        'airplanes': load_airplanes(session, generator.airplanes(airplanes), chunk_size),
+        'cities': load_cities(session, generator.cities(cities, drawn_airports, invalid_fraction), chunk_size),
+        'operators': load_operators(session, generator.operators(operators, airports_per_operator, drawn_airports,
+                                                                 airplane_names), chunk_size),
+        'forecasts': load_forecasts(session, generator.forecasts(forecast_days, drawn_airports, cities), chunk_size),
+        'reviews': 0,
+    }
+    operator_ids = sorted(get_values_by_id(session, Operator.name))
+    if operator_ids:
+        for chunk in chunked(generator.reviews(reviews, operator_ids), chunk_size):
+            session.bulk_insert_mappings(Review, chunk)
+            session.commit()
+            counts['reviews'] += len(chunk)
+        record_bulk_changes(session, [Review])
+    return counts
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Generates a dataset for load testing into a database.')
+    parser.add_argument('url', help='database URL, e.g. sqlite:///load_test.db or mysql+mysqlconnector://...')
+    parser.add_argument('--seed', type=int, default=0)
+    for name, default in [('cities', 100), ('airports', 500), ('operators', 50), ('airports-per-operator', 10),
+                          ('airplanes', 10), ('forecast-days', 8), ('reviews', 500)]:
+        parser.add_argument(f'--{name}', type=int, default=default)
+    parser.add_argument('--invalid-fraction', type=float, default=0.05)
+    arguments = parser.parse_args(arguments)
+    database = Database(arguments.url)
+    database.upgrade_schema()
+    counts = generate(database.create_session(), arguments.cities, arguments.airports, arguments.operators,
+                      arguments.airports_per_operator, arguments.airplanes, arguments.forecast_days, arguments.reviews,
+                      arguments.seed, arguments.invalid_fraction)
+    for table, count in counts.items():
+        print(f'{count} {table} stored.')
+
+
+if __name__ == '__main__':
+    main()
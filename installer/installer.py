@@ -1,88 +1,236 @@
+import argparse
+import csv
+import datetime
 import json
-from datetime import date
+import os
+from itertools import islice
 from sys import stderr
+from typing import Iterable, Iterator, List
 
 from sqlalchemy.exc import SQLAlchemyError
 
-from database import Database, City, Forecast, Operator, OperatorAirport, Airport, Airplane
+from database import Database, City, Forecast, Operator, OperatorAirport, Airport, AirportCities, Airplane, \
+    BATCH_SIZE, get_ids, upsert_rows, add_links, upsert_forecasts
 
-from travel_planner_app import csv_handler
+OFFICIAL_AIRPORTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'travel_planner_app',
+                                 'airports.csv')
+
+STARTER_AIRPORTS = [
+    {'ICAO_code': 'KLNK', 'name': 'Lincoln Airport', 'latitude': 40.85, 'longitude': -96.76},
+    {'ICAO_code': 'KOMA', 'name': 'Eppley Airfield', 'latitude': 41.30, 'longitude': -95.89},
+    {'ICAO_code': 'KMCI', 'name': 'Kansas City International Airport', 'latitude': 39.30, 'longitude': -94.71},
+    {'ICAO_code': 'KTPA', 'name': 'Tampa International Airport', 'latitude': 27.98, 'longitude': -82.53},
+    {'ICAO_code': 'KDTW', 'name': 'Detroit Metro Airport', 'latitude': 42.22, 'longitude': -83.36},
+]
+STARTER_CITIES = [
+    {'name': 'Lincoln', 'geographic_identity': 'Nebraska', 'latitude': 40.8, 'longitude': -96.7,
+     'airports': ['KLNK', 'KOMA']},
+    {'name': 'Bellevue', 'geographic_identity': 'Nebraska', 'latitude': 41.2, 'longitude': -95.9,
+     'airports': ['KOMA']},
+]
+STARTER_FORECASTS = [
+    {'ICAO_code': 'KLNK', 'date': '2022-04-18', 'temperature': 11, 'visibility': 15, 'precipitation_probability': 0.0,
+     'wind_speed': 7.61, 'weather_description': 'clear sky'},
+    {'ICAO_code': 'KLNK', 'date': '2022-04-19', 'temperature': 17, 'visibility': 16, 'precipitation_probability': 0.1,
+     'wind_speed': 4.52, 'weather_description': 'clear sky'},
+    {'ICAO_code': 'KOMA', 'date': '2022-04-18', 'temperature': 14, 'visibility': 10, 'precipitation_probability': 0.0,
+     'wind_speed': 8.05, 'weather_description': 'broken clouds'},
+    {'ICAO_code': 'KOMA', 'date': '2022-04-19', 'temperature': 5, 'visibility': 11, 'precipitation_probability': 0.3,
+     'wind_speed': 10.21, 'weather_description': 'overcast clouds'},
+]
+STARTER_AIRPLANES = [
+    {'name': 'Embraer 135', 'range': 3100},  # Unit: kilometer
+    {'name': 'Bombardier CRJ700LR', 'range': 3700},
+]
+STARTER_OPERATORS = [
+    {'name': 'Joey Airways', 'rate_my_pilot_score': 4.5, 'airplane': 'Embraer 135', 'airports': ['KMCI', 'KTPA']},
+    {'name': 'Flightee', 'rate_my_pilot_score': 5.0, 'airplane': 'Embraer 135', 'airports': ['KTPA', 'KDTW']},
+    {'name': 'Walter Airlines', 'rate_my_pilot_score': 3.8, 'airplane': 'Bombardier CRJ700LR',
+     'airports': ['KLNK', 'KTPA', 'KDTW']},
+]
+
+
+def read_records(path) -> Iterator[dict]:
+    """
+    Streams the records of a CSV file with a header row, or of a JSONL file with one JSON object per line.
+    """
+    with open(path, newline='') as file:
+        if path.endswith('.jsonl'):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from csv.DictReader(file)
+
+
+def read_official_airports(csv_file=OFFICIAL_AIRPORTS) -> Iterator[dict]:
+    """
+    Streams the airports of a file in the format of airports.csv as airport records.
+    """
+    for record in read_records(csv_file):
+        yield {'ICAO_code': record['ICAO'], 'name': record['Name'], 'latitude': record['Latitude'],
+               'longitude': record['Longitude']}
+
+
+def chunked(records: Iterable[dict], chunk_size: int) -> Iterator[List[dict]]:
+    records = iter(records)
+    chunk = list(islice(records, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(records, chunk_size))
+
+
+def _number(value):
+    return float(value) if value not in (None, '') else None
+
+
+def _flag(value) -> bool:
+    """
+    :returns: a JSONL boolean or a CSV cell like 'false' as a boolean, True if missing
+    """
+    return value if isinstance(value, bool) else str(value).strip().lower() not in ('false', 'no', '0')
+
+
+def _codes(value) -> List[str]:
+    """
+    :returns: the ICAO codes of a JSONL list or of a CSV cell like 'KLNK;KOMA'
+    """
+    codes = value if isinstance(value, list) else (value or '').split(';')
+    return [code.strip().upper() for code in codes if code.strip()]
+
+
+def load_airports(session, records: Iterable[dict], chunk_size: int = BATCH_SIZE) -> int:
+    """
+    Inserts or updates airports by ICAO code, a chunk at a time.
+
+    :param records: ICAO_code, name, latitude, longitude and optionally valid, True by default, of each airport
+    :returns: the number of airports stored
+    """
+    stored = 0
+    for chunk in chunked(records, chunk_size):
+        stored += upsert_rows(session, Airport, ['ICAO_code'], [
+            {'ICAO_code': record['ICAO_code'].strip().upper(), 'name': record['name'],
+             'latitude': float(record['latitude']), 'longitude': float(record['longitude']),
+             'valid': _flag(record.get('valid', True))} for record in chunk])
+    return stored
+
+
+def load_airplanes(session, records: Iterable[dict], chunk_size: int = BATCH_SIZE) -> int:
+    """
+    Inserts or updates airplanes by name, a chunk at a time.
+
+    :param records: name and range of each airplane
+    """
+    stored = 0
+    for chunk in chunked(records, chunk_size):
+        stored += upsert_rows(session, Airplane, ['name'], [{'name': record['name'], 'range': float(record['range'])}
+                                                            for record in chunk])
+    return stored
+
+
+def load_cities(session, records: Iterable[dict], chunk_size: int = BATCH_SIZE) -> int:
+    """
+    Inserts or updates cities by name and geographic identity, a chunk at a time, and links each to the airports
+    listed for it that are stored.
+
+    :param records: name, geographic_identity, latitude, longitude, airports, the ICAO codes, and optionally valid,
+        True by default, of each city
+    """
+    stored = 0
+    key = ['name', 'geographic_identity']
+    for chunk in chunked(records, chunk_size):
+        stored += upsert_rows(session, City, key, [
+            {'name': record['name'], 'geographic_identity': record['geographic_identity'],
+             'latitude': float(record['latitude']), 'longitude': float(record['longitude']),
+             'valid': _flag(record.get('valid', True))} for record in chunk])
+        city_ids = get_ids(session, City, key, ((record['name'], record['geographic_identity']) for record in chunk))
+        airport_ids = get_ids(session, Airport, ['ICAO_code'],
+                              ((code,) for record in chunk for code in _codes(record.get('airports'))))
+        add_links(session, AirportCities, [
+            {'airport_id': airport_ids[(code,)], 'city_id': city_ids[(record['name'], record['geographic_identity'])]}
+            for record in chunk for code in _codes(record.get('airports')) if (code,) in airport_ids])
+    return stored
+
+
+def load_operators(session, records: Iterable[dict], chunk_size: int = BATCH_SIZE) -> int:
+    """
+    Inserts or updates operators by name, a chunk at a time, with the airplane named for each, and links each to the
+    airports listed for it that are stored.
+
+    :param records: name, rate_my_pilot_score, airplane, the airplane's name, and airports, the ICAO codes, of each
+        operator
+    """
+    stored = 0
+    for chunk in chunked(records, chunk_size):
+        airplane_ids = get_ids(session, Airplane, ['name'], ((record.get('airplane'),) for record in chunk))
+        stored += upsert_rows(session, Operator, ['name'], [
+            {'name': record['name'], 'rate_my_pilot_score': float(record['rate_my_pilot_score']),
+             'airplane_id': airplane_ids.get((record.get('airplane'),))} for record in chunk])
+        operator_ids = get_ids(session, Operator, ['name'], ((record['name'],) for record in chunk))
+        airport_ids = get_ids(session, Airport, ['ICAO_code'],
+                              ((code,) for record in chunk for code in _codes(record.get('airports'))))
+        add_links(session, OperatorAirport, [
+            {'operator_id': operator_ids[(record['name'],)], 'airport_id': airport_ids[(code,)]}
+            for record in chunk for code in _codes(record.get('airports')) if (code,) in airport_ids])
+    return stored
+
+
+def load_forecasts(session, records: Iterable[dict], chunk_size: int = BATCH_SIZE) -> int:
+    """
+    Inserts or updates forecasts by airport or city and date, a chunk at a time. Forecasts for locations that aren't
+    stored are skipped.
+
+    :param records: ICAO_code, or city and geographic_identity, date (YYYY-MM-DD), temperature, visibility,
+        precipitation_probability, wind_speed and weather_description of each forecast
+    :returns: the number of forecasts stored
+    """
+    stored = 0
+    for chunk in chunked(records, chunk_size):
+        airport_ids = get_ids(session, Airport, ['ICAO_code'],
+                              ((record['ICAO_code'].upper(),) for record in chunk if record.get('ICAO_code')))
+        city_ids = get_ids(session, City, ['name', 'geographic_identity'],
+                           ((record['city'], record['geographic_identity']) for record in chunk
+                            if not record.get('ICAO_code')))
+        rows = []
+        for record in chunk:
+            if record.get('ICAO_code'):
+                owner = {'airport_id': airport_ids.get((record['ICAO_code'].upper(),)), 'city_id': None}
+            else:
+                owner = {'airport_id': None, 'city_id': city_ids.get((record['city'], record['geographic_identity']))}
+            if owner['airport_id'] is None and owner['city_id'] is None:
+                continue
+            visibility = _number(record.get('visibility'))
+            rows.append({**owner, 'date': datetime.date.fromisoformat(str(record['date'])),
+                         'temperature': _number(record.get('temperature')),
+                         'visibility': int(visibility) if visibility is not None else None,
+                         'precipitation_probability': _number(record.get('precipitation_probability')),
+                         'wind_speed': _number(record.get('wind_speed')),
+                         'weather_description': record.get('weather_description')})
+        if rows:
+            stored += upsert_forecasts(session, rows)
+    return stored
 
 
 def add_starter_data(session):
-    lincoln = City(name='Lincoln', geographic_identity='Nebraska', latitude=40.8, longitude=-96.7, valid=True)
-    bellevue = City(name='Bellevue', geographic_identity='Nebraska', latitude=41.2, longitude=-95.9, valid=True)
-
-    lincoln_airport = Airport(name='Lincoln Airport', ICAO_code='KLNK', latitude=40.85, longitude=-96.76,
-                              cities=[lincoln], valid=True)
-
-    eppley_airfield = Airport(name='Eppley Airfield', ICAO_code='KOMA', latitude=41.30, longitude=-95.89,
-                              cities=[lincoln, bellevue], valid=True)
-
-    lincoln_first_forecast = Forecast(date=date(2022, 4, 18), temperature=11, visibility=15,
-                                      precipitation_probability=0.0,
-                                      wind_speed=7.61,
-                                      weather_description='clear sky',
-                                      airport=lincoln_airport)
-
-    lincoln_second_forecast = Forecast(date=date(2022, 4, 19), temperature=17, visibility=16,
-                                       precipitation_probability=0.1,
-                                       wind_speed=4.52,
-                                       weather_description='clear sky',
-                                       airport=lincoln_airport)
-
-    eppley_first_forecast = Forecast(date=date(2022, 4, 18), temperature=14, visibility=10,
-                                     precipitation_probability=0.0,
-                                     wind_speed=8.05,
-                                     weather_description='broken clouds',
-                                     airport=eppley_airfield)
-
-    eppley_second_forecast = Forecast(date=date(2022, 4, 19), temperature=5, visibility=11,
-                                      precipitation_probability=0.3,
-                                      wind_speed=10.21,
-                                      weather_description='overcast clouds',
-                                      airport=eppley_airfield)
-
-    kansas_airport = Airport(name='Kansas City International Airport', ICAO_code='KMCI', latitude=39.30,
-                             longitude=-94.71, valid=True)
-    tampa_airport = Airport(name='Tampa International Airport', ICAO_code='KTPA', latitude=27.98, longitude=-82.53,
-                            valid=True)
-    detroit_airport = Airport(name='Detroit Metro Airport', ICAO_code='KDTW', latitude=42.22, longitude=-83.36,
-                              valid=True)
-
-    joey_airways = Operator(name='Joey Airways', rate_my_pilot_score=4.5, airports=[kansas_airport, tampa_airport])
-    flightee = Operator(name='Flightee', rate_my_pilot_score=5.0, airports=[tampa_airport, detroit_airport])
-    walter_airlines = Operator(name='Walter Airlines', rate_my_pilot_score=3.8,
-                               airports=[lincoln_airport, tampa_airport, detroit_airport])
-
-    embraer_airplane = Airplane(name='Embraer 135', range=3100,
-                                operators=[joey_airways, flightee])  # range in kilometers
-    bombardier_airplane = Airplane(name='Bombardier CRJ700LR', range=3700, operators=[walter_airlines])
-
-    session.add(lincoln)
-    session.add(bellevue)
-
-    session.add(lincoln_airport)
-    session.add(eppley_airfield)
-
-    session.add(lincoln_first_forecast)
-    session.add(lincoln_second_forecast)
-    session.add(eppley_first_forecast)
-    session.add(eppley_second_forecast)
-
-    session.add(kansas_airport)
-    session.add(tampa_airport)
-    session.add(detroit_airport)
-
-    session.add(joey_airways)
-    session.add(flightee)
-    session.add(walter_airlines)
-
-    session.add(embraer_airplane)
-    session.add(bombardier_airplane)
+    load_airports(session, STARTER_AIRPORTS)
+    load_cities(session, STARTER_CITIES)
+    load_forecasts(session, STARTER_FORECASTS)
+    load_airplanes(session, STARTER_AIRPLANES)
+    load_operators(session, STARTER_OPERATORS)
+
+
+def parse_arguments(arguments=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Creates or upgrades the tables, then loads the official airports, '
+                                                 'the starter data and any given files. Can be run again at any time.')
+    parser.add_argument('--airports', default=OFFICIAL_AIRPORTS, help='CSV file in the format of airports.csv')
+    for name in ['airplanes', 'cities', 'operators', 'forecasts']:
+        parser.add_argument(f'--{name}', help=f'CSV or JSONL file of {name} to load')
+    parser.add_argument('--chunk-size', type=int, default=BATCH_SIZE, help='rows stored per transaction')
+    return parser.parse_args(arguments)
 
 
 def main():
+    arguments = parse_arguments()
     try:
         with open('../credentials.json') as file:
             data = json.loads(file.read())
@@ -92,11 +240,17 @@ def main():
                                            str(data['Database Password']))
 
         airport_database = Database(url)
-        airport_database.ensure_tables_exist()
-        print('Tables created.')
+        created = airport_database.upgrade_schema()
+        print(f'Tables created. Indexes added: {", ".join(created) or "none"}')
         session = airport_database.create_session()
+        print(f'{load_airports(session, read_official_airports(arguments.airports), arguments.chunk_size)} '
+              f'official airports loaded.')
         add_starter_data(session)
-        session.commit()
+        for name, load in [('airplanes', load_airplanes), ('cities', load_cities), ('operators', load_operators),
+                           ('forecasts', load_forecasts)]:
+            path = getattr(arguments, name)
+            if path is not None:
+                print(f'{load(session, read_records(path), arguments.chunk_size)} {name} loaded.')
         print('Records created.')
     except SQLAlchemyError as exception:
         print('Database setup failed!', file=stderr)
@@ -0,0 +1,162 @@
+import atexit
+import functools
+import logging
+import re
+import sys
+import threading
+from collections import defaultdict, Counter
+from contextlib import contextmanager
+from timeit import default_timer
+from typing import Dict, List, Set, Tuple
+
+from sqlalchemy import event
+
+SLOW_QUERY_SECONDS = 0.1
+REPEATED_QUERY_COUNT = 10  # Runs of one statement shape in one operation that suggest an N+1 query
+
+logger = logging.getLogger(__name__)
+
+
+class OperationStats(object):
+    def __init__(self):
+        self.calls = 0
+        self.statements = 0
+        self.seconds = 0.0
+        self.most_statements = 0  # In a single call
+        self.repeated: Dict[str, int] = {}  # Shape -> most runs in a single call, if REPEATED_QUERY_COUNT or more
+
+
+class _OperationCall(object):
+    def __init__(self, name: str):
+        self.name = name
+        self.shapes: Dict['QueryProfiler', Counter] = defaultdict(Counter)
+        self.seconds: Dict['QueryProfiler', float] = defaultdict(float)
+
+
+NO_OPERATION = '(no operation)'
+_enabled_profilers: Set['QueryProfiler'] = set()
+_operation_calls = threading.local()
+
+
+def get_statement_shape(statement: str) -> str:
+    # Parameter lists, which grow with IN, are reduced to (...), so statements differing only in them match
+    statement = re.sub(r'\s+', ' ', statement).strip()
+    return re.sub(r'\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*\)', '(...)', statement)
+
+
+class QueryProfiler(object):
+    # Counts and times statements by operation, logging slow ones and likely N+1 queries. Only listens while enabled
+
+    def __init__(self, engine, slow_seconds: float = SLOW_QUERY_SECONDS, repeated_count: int = REPEATED_QUERY_COUNT):
+        self.engine = engine
+        self.slow_seconds = slow_seconds
+        self.repeated_count = repeated_count
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.operations: Dict[str, OperationStats] = defaultdict(OperationStats)
+        self.slow_statements: List[Tuple[str, str, float]] = []  # Operation, statement, seconds
+
+    def enable(self, dump_at_exit: bool = False):
+        if not self.enabled:
+            event.listen(self.engine, 'before_cursor_execute', self._before_execute)
+            event.listen(self.engine, 'after_cursor_execute', self._after_execute)
+            _enabled_profilers.add(self)
+            self.enabled = True
+        if dump_at_exit:
+            atexit.unregister(self.dump)
+            atexit.register(self.dump)
+
+    def disable(self):
+        if self.enabled:
+            event.remove(self.engine, 'before_cursor_execute', self._before_execute)
+            event.remove(self.engine, 'after_cursor_execute', self._after_execute)
+            _enabled_profilers.discard(self)
+            self.enabled = False
+        atexit.unregister(self.dump)
+
+    def reset(self):
+        with self.lock:
+            self.operations.clear()
+            self.slow_statements.clear()
+
+    @staticmethod
+    def _before_execute(connection, _cursor, _statement, _parameters, _context, _executemany):
+        connection.info.setdefault('query_started', []).append(default_timer())
+
+    def _after_execute(self, connection, _cursor, statement, _parameters, _context, _executemany):
+        seconds = default_timer() - connection.info['query_started'].pop()
+        calls = getattr(_operation_calls, 'calls', None)
+        if calls:  # Statements count towards the innermost operation only
+            call = calls[-1]
+            call.shapes[self][get_statement_shape(statement)] += 1
+            call.seconds[self] += seconds
+            name = call.name
+        else:
+            name = NO_OPERATION
+            with self.lock:
+                stats = self.operations[name]
+                stats.statements += 1
+                stats.seconds += seconds
+        if seconds >= self.slow_seconds:
+            logger.warning('Slow query in %s took %.3f s: %s', name, seconds, statement)
+            with self.lock:
+                self.slow_statements.append((name, statement, seconds))
+
+    def _record_call(self, name: str, shapes: Counter, seconds: float):
+        statements = sum(shapes.values())
+        repeated = {shape: count for shape, count in shapes.items() if count >= self.repeated_count}
+        with self.lock:
+            stats = self.operations[name]
+            stats.calls += 1
+            stats.statements += statements
+            stats.seconds += seconds
+            stats.most_statements = max(stats.most_statements, statements)
+            for shape, count in repeated.items():
+                stats.repeated[shape] = max(stats.repeated.get(shape, 0), count)
+        for shape, count in repeated.items():
+            logger.warning('Possible N+1 query in %s, run %d times: %s', name, count, shape)
+
+    def summary(self) -> str:
+        with self.lock:
+            operations = sorted(self.operations.items(), key=lambda item: item[1].seconds, reverse=True)
+            slow_count = len(self.slow_statements)
+        lines = [f'{"Operation":<50} {"Calls":>6} {"Statements":>10} {"Most":>6} {"Seconds":>9}']
+        for name, stats in operations:
+            lines.append(f'{name[:50]:<50} {stats.calls:>6} {stats.statements:>10} {stats.most_statements:>6} '
+                         f'{stats.seconds:>9.3f}')
+            for shape, count in sorted(stats.repeated.items(), key=lambda item: item[1], reverse=True):
+                lines.append(f'    repeated {count} times: {shape[:200]}')
+        lines.append(f'{slow_count} statements took {self.slow_seconds} s or more')
+        return '\n'.join(lines)
+
+    def dump(self, file=None):
+        print(self.summary(), file=file or sys.stderr)
+
+
+@contextmanager
+def profile_operation(name: str):
+    # Statements count towards the innermost operation
+    if not _enabled_profilers:
+        yield
+        return
+    calls = _operation_calls.__dict__.setdefault('calls', [])
+    call = _OperationCall(name)
+    calls.append(call)
+    try:
+        yield
+    finally:
+        calls.pop()
+        for profiler, shapes in call.shapes.items():
+            profiler._record_call(name, shapes, call.seconds[profiler])
+
+
+def profiled(function):
+    name = function.__qualname__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if not _enabled_profilers:
+            return function(*args, **kwargs)
+        with profile_operation(name):
+            return function(*args, **kwargs)
+    return wrapper
@@ -4,12 +4,11 @@ from sys import stderr
 from kivy.uix.spinner import Spinner
 from kivy.uix.textinput import TextInput
 from kivy.uix.widget import Widget
-from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from typing import List
 
-from database import Operator, Airplane, Airport, get_exists, create_object, handle_error, get_object, \
-    get_objects, Review
-from tracker_app import TrackerApp, ListHolder
+from database import Operator, Airplane, Airport, create_object, handle_error, get_object, Review, operation
+from tracker_app import TrackerApp, RecycleListHolder
 
 
 class OperatorApp(TrackerApp):
@@ -18,6 +17,7 @@ class OperatorApp(TrackerApp):
         pass
 
     @staticmethod
+    @operation
     def add_review(session, name: str, score: str) -> str:
         """
         Adds a review to an operator. Used instead of create_object to find operator by name and do error handling
@@ -33,6 +33,7 @@ class OperatorApp(TrackerApp):
             return handle_error(e, session)
 
     @staticmethod
+    @operation
     def new_operator_clicked(session, selected: str, name: str, score: str, airplane_name: str,
                              selected_airports: List[str], spinner: Spinner) -> str:
         """
@@ -49,11 +50,7 @@ class OperatorApp(TrackerApp):
         :returns: Confirmation or error message to be sent to create_popup
         """
         try:
-            if selected == 'Create New' and get_exists(session, Operator, name=name):
-                return f'Operator {name} already exist. Please edit their entry instead of adding a new one'
-            elif selected != 'Create New' and name != selected and get_exists(session, Operator, name=name):
-                return f'Operator {name} already exist. You cannot have two operators with the same name'
-            elif len(selected_airports) <= 0:
+            if len(selected_airports) <= 0:
                 return 'Please select airports for the operator.'
             elif airplane_name == '':
                 return 'Please select an airplane for the operator.'
@@ -62,13 +59,15 @@ class OperatorApp(TrackerApp):
             else:
                 operator = OperatorApp.get_operator_with_populated_fields(session, name, score, selected)
                 operator.airplane = get_object(session, Airplane, name=airplane_name)
-                operator.airports = []
-                for airport in get_objects(session, Airport):
-                    if airport.ICAO_code in selected_airports:
-                        operator.airports.append(airport)
+                operator.airports = session.query(Airport).filter(Airport.ICAO_code.in_(selected_airports)).all()
                 session.commit()
                 out = f'Operator {"Added" if selected == "Create New" else "Edited"}!'
                 return out + OperatorApp.populate_spinner(session, Operator, spinner, True)
+        except IntegrityError:  # Operator names are unique
+            session.rollback()
+            if selected == 'Create New':
+                return f'Operator {name} already exist. Please edit their entry instead of adding a new one'
+            return f'Operator {name} already exist. You cannot have two operators with the same name'
         except Exception as e:
             return handle_error(e, session)
 
@@ -92,10 +91,13 @@ class OperatorApp(TrackerApp):
         return operator
 
     @staticmethod
-    def on_operator_spinner_clicked(session, selected_operator: str, operator_grid: Widget, airports_list: ListHolder,
+    @operation
+    def on_operator_spinner_clicked(session, selected_operator: str, operator_grid: Widget,
+                                    airports_list: RecycleListHolder,
                                     operator_name: TextInput,
                                     operator_score: TextInput,
-                                    airplane_spinner: Spinner) -> str:
+                                    airplane_spinner: Spinner,
+                                    airport_prefix: str = '') -> str:
         """
         Repopulates fields provided with information about the newly specified operator
 
@@ -106,6 +108,7 @@ class OperatorApp(TrackerApp):
         :param operator_name: 
         :param operator_score: 
         :param airplane_spinner: 
+        :param airport_prefix: start of the ICAO codes to list
         :returns: error message to be sent to create_popup
         """
         try:
@@ -114,18 +117,29 @@ class OperatorApp(TrackerApp):
             operator_name.text = ''
             operator_score.text = ''
             airplane_spinner.text = ''
-            airports = get_objects(session, Airport)
-            airport_codes = [element.ICAO_code for element in airports]
-            airports_list.populate_list(airport_codes)
+            airports_list.populate_list([])
             if selected_operator != 'Create New':
                 operator = get_object(session, Operator, name=selected_operator)
                 operator_name.text = operator.name
                 operator_score.text = str(operator.rate_my_pilot_score)
                 airplane_spinner.text = operator.airplane.name
                 for airport in operator.airports:
-                    for airport_element in airports_list.children:
-                        if airport_element.text == airport.ICAO_code:
-                            airport_element.on_pressed()
+                    airports_list.on_pressed(airport.ICAO_code)
+            return OperatorApp.search_airports(session, airports_list, airport_prefix)
+        except Exception as e:
+            return handle_error(e, session)
+
+    @staticmethod
+    @operation
+    def search_airports(session, airports_list: RecycleListHolder, prefix: str) -> str:
+        """
+        Lists the ICAO codes starting with prefix a page at a time, keeping the airports already selected.
+
+        :returns: error message to be sent to create_popup
+        """
+        try:
+            airports_list.populate_pages(OperatorApp.make_pager(session, Airport.ICAO_code, prefix.upper()))
+            return ""
         except Exception as e:
             return handle_error(e, session)
 
@@ -0,0 +1 @@
+../installer/profiling.py
\ No newline at end of file
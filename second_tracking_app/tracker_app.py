@@ -1,17 +1,23 @@
 import json
 import os
 from abc import ABC, abstractmethod
+from typing import Callable, Dict, Hashable, Iterable, Tuple
 
+from kivy.app import App
 from kivy.clock import Clock
 from kivy.core.window import Window
 from kivy.lang import Builder
 from kivy.modules import inspector
-from kivy.properties import ListProperty
+from kivy.properties import ListProperty, NumericProperty, ObjectProperty, StringProperty
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
 from kivy.uix.screenmanager import ScreenManager, Screen
+from kivy.uix.spinner import Spinner
 from kivymd.app import MDApp
 from kivymd.uix.button import MDFlatButton
 from kivymd.uix.dialog import MDDialog
 from kivymd.uix.list import OneLineListItem, MDList, TwoLineListItem
+from sqlalchemy.exc import IntegrityError
 
 import database
 from database import Database
@@ -23,14 +29,6 @@ class ListHolder(MDList):
 
     selected_elements = ListProperty()
 
-    def populate_two_line_list(self, elements):
-        self.selected_elements.clear()
-        self.clear_widgets()
-        for element in elements:
-            item = TwoListItem(text=str(element), secondary_text=elements[element][0])
-            item.id = elements[element][1]
-            self.add_widget(item)
-
     def populate_list(self, elements):
         self.selected_elements.clear()
         self.clear_widgets()
@@ -42,32 +40,228 @@ class ListHolder(MDList):
         return self.children.__repr__()
 
 
-class TwoListItem(TwoLineListItem):
+class ListItem(OneLineListItem):
 
     def on_pressed(self):
-        if len(self.parent.selected_elements) == 0:
+        if not self.bg_color or self.bg_color != [.9, .9, .9, 1]:
             self.bg_color = [.9, .9, .9, 1]
-            self.parent.selected_elements.append(self)
-        elif len(self.parent.selected_elements) == 1:
-            if not self.bg_color or self.bg_color != [.9, .9, .9, 1]:
-                pass
-            else:
-                self.bg_color = 'gray'
-                self.parent.selected_elements.remove(self)
+            self.parent.selected_elements.append(self.text)
+        else:
+            self.bg_color = 'gray'
+            self.parent.selected_elements.remove(self.text)
 
     def __repr__(self):
         return self.text
 
 
-class ListItem(OneLineListItem):
+class Pager(object):
+    # Each page is fetched as the values after the last value of the page before, e.g. with database.get_page
+
+    def __init__(self, fetch_page: Callable[[object, int], list], page_size: int = database.PAGE_SIZE,
+                 handle_error: Callable[[Exception], str] = None):
+        self.fetch_page = fetch_page
+        self.page_size = page_size
+        self.handle_error = handle_error
+        self.last = None
+        self.has_more = True
+
+    def next_page(self) -> list:
+        if not self.has_more:
+            return []
+        page = self.fetch_page(self.last, self.page_size + 1)  # One more to know whether there is another page
+        self.has_more = len(page) > self.page_size
+        page = page[:self.page_size]
+        if page:
+            self.last = page[-1]
+        return page
+
+    def next_page_or_report(self) -> list:
+        # For event handlers, which have no caller to return an error message to
+        try:
+            return self.next_page()
+        except Exception as e:
+            self.has_more = False
+            App.get_running_app().create_popup(self.handle_error(e) if self.handle_error else f'error: {e}')
+            return []
+
+
+class SearchSpinner(Spinner):
+    # For catalogs too big to load whole, like the airports. Choosing MORE adds the next page
+    MORE = 'More...'
+    prefix = StringProperty('')
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.pager = None
+        self.pinned = []  # Values shown before the pages, like 'Create New'
+        self.loaded = []
+
+    def search(self, pager: Pager, pinned: Iterable[str] = ()):
+        self.pager = pager
+        self.pinned = list(pinned)
+        self.loaded = []
+        self.show_page(pager.next_page())
+
+    def show_page(self, page: list):
+        self.loaded.extend(str(value) for value in page)
+        values = self.pinned + self.loaded + ([SearchSpinner.MORE] if self.pager.has_more else [])
+        if self.values != values:
+            self.values = values
+
+    def _on_dropdown_select(self, instance, data, *largs):
+        if data != SearchSpinner.MORE or self.pager is None:
+            return super()._on_dropdown_select(instance, data, *largs)
+        self.show_page(self.pager.next_page_or_report())
+        Clock.schedule_once(lambda _time: setattr(self, 'is_open', True))  # Choosing closes the dropdown
+
+
+class RecycleListHolder(RecycleView):
+    # Only the visible rows are widgets, reused as the list scrolls. Given a Pager, it loads a page at a time
+    selected_elements = ListProperty()
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.rows = {}  # Element -> index in data
+        self.pager = None
+
+    def populate_list(self, elements):
+        self.selected_elements.clear()
+        self.pager = None
+        self.data = []
+        self.rows = {}
+        self.append_elements(elements)
+
+    def populate_pages(self, pager: Pager):
+        # Unlike populate_list, the selection is kept while the selected elements aren't shown
+        page = pager.next_page()
+        self.pager = pager
+        self.data = []
+        self.rows = {}
+        self.append_elements(page)
+        self.scroll_y = 1
+
+    def append_elements(self, elements):
+        selected = set(self.selected_elements)
+        rows = [{'text': element, 'selected': element in selected} for element in elements]
+        self.rows.update((row['text'], len(self.data) + index) for index, row in enumerate(rows))
+        self.data.extend(rows)
+
+    def on_scroll_y(self, _instance, scroll_y):
+        if scroll_y <= 0 and self.pager is not None and self.pager.has_more:
+            self.append_elements(self.pager.next_page_or_report())
+
+    def on_pressed(self, element):
+        if element in self.selected_elements:
+            self.selected_elements.remove(element)
+        else:
+            self.selected_elements.append(element)
+        if element in self.rows:
+            row = self.data[self.rows[element]]
+            row['selected'] = element in self.selected_elements
+            self.refresh_from_data()
+
+    def __repr__(self):
+        return [row['text'] for row in self.data].__repr__()
+
+
+class RecycleListItem(RecycleDataViewBehavior, OneLineListItem):
+    holder = ObjectProperty(None, allownone=True)
+    index = NumericProperty(0)
+
+    def refresh_view_attrs(self, holder, index, data):
+        self.holder = holder
+        self.index = index
+        self.bg_color = [.9, .9, .9, 1] if data['selected'] else 'gray'
+        return super().refresh_view_attrs(holder, index, {'text': data['text']})
 
     def on_pressed(self):
-        if not self.bg_color or self.bg_color != [.9, .9, .9, 1]:
-            self.bg_color = [.9, .9, .9, 1]
-            self.parent.selected_elements.append(self.text)
+        if self.holder is not None:
+            self.holder.on_pressed(self.text)
+
+    def __repr__(self):
+        return self.text
+
+
+class TwoLineRow(object):
+    # Rows have no widget of their own, so this is what selected_elements holds
+
+    def __init__(self, key: Hashable, text: str, secondary_text: str, element_id):
+        self.key = key
+        self.text = text
+        self.secondary_text = secondary_text
+        self.id = element_id  # Primary key of the element shown
+
+    def __repr__(self):
+        return self.text
+
+
+class RecycleTwoLineListHolder(RecycleView):
+    # Only the visible rows are widgets. Each KivyMD label binds to the theme on creation, which gets slower with
+    # every label bound, so a widget per row took minutes for a thousand rows
+    selected_elements = ListProperty()
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.items: Dict[Hashable, TwoLineRow] = {}
+        self.version = None  # Change version of the database when the list was last updated
+
+    def populate_two_line_list(self, elements):
+        self.selected_elements.clear()
+        self.items = {}
+        self.version = None
+        self.update_two_line_list({element_id: (str(text), secondary_text, element_id)
+                                   for text, (secondary_text, element_id) in elements.items()})
+
+    def update_two_line_list(self, elements: Dict[Hashable, Tuple[str, str, object]],
+                             removed: Iterable[Hashable] = None):
+        # Keyed diff: only rows whose key is in elements or removed change, so the rest keep their selection. If removed
+        # is None, elements is the whole list
+        if removed is None:
+            removed = [key for key in self.items if key not in elements]
+        for key in removed:
+            row = self.items.pop(key, None)
+            if row is not None and row in self.selected_elements:
+                self.selected_elements.remove(row)
+        for key, (text, secondary_text, element_id) in elements.items():
+            row = self.items.get(key)
+            if row is None:
+                self.items[key] = TwoLineRow(key, text, secondary_text, element_id)
+            else:
+                row.text, row.secondary_text, row.id = text, secondary_text, element_id
+        self.show_rows()
+
+    def show_rows(self):
+        selected = {row.key for row in self.selected_elements}
+        self.data = [{'text': row.text, 'secondary_text': row.secondary_text, 'key': row.key,
+                      'selected': row.key in selected} for row in self.items.values()]
+
+    def on_pressed(self, key: Hashable):
+        row = self.items.get(key)
+        if row is None:
+            return
+        if not self.selected_elements:
+            self.selected_elements.append(row)
+        elif self.selected_elements[0] is row:
+            self.selected_elements.remove(row)
         else:
-            self.bg_color = 'gray'
-            self.parent.selected_elements.remove(self.text)
+            return
+        self.show_rows()
+
+
+class RecycleTwoListItem(RecycleDataViewBehavior, TwoLineListItem):
+    holder = ObjectProperty(None, allownone=True)
+    key = ObjectProperty(None, allownone=True)
+
+    def refresh_view_attrs(self, holder, index, data):
+        self.holder = holder
+        self.key = data['key']
+        self.bg_color = [.9, .9, .9, 1] if data['selected'] else 'gray'
+        return super().refresh_view_attrs(holder, index, {'text': data['text'],
+                                                          'secondary_text': data['secondary_text']})
+
+    def on_pressed(self):
+        if self.holder is not None:
+            self.holder.on_pressed(self.key)
 
     def __repr__(self):
         return self.text
@@ -88,9 +282,13 @@ class TrackerApp(MDApp, ABC):
             data = json.loads(file.read())
 
         url = Database.construct_mysql_url(str(data['Database Authority']), str(data['Database Port']), str(data['Database Name']), str(data['Database Username']), str(data['Database Password']))
-        self.operator_database = Database(url)
+        self.operator_database = database.get_database(url)
         self.session = self.operator_database.create_session()
 
+    def on_stop(self):
+        if self.session is not None:
+            self.session.close()
+
     @abstractmethod
     def after_build(self, _time):
         pass
@@ -106,23 +304,53 @@ class TrackerApp(MDApp, ABC):
         return screen_manager
 
     @staticmethod
+    @database.operation
     def populate_spinner(session, sql_type, spinner, editable=False) -> str:
+        # Only the names changed since the last call on spinner are queried, until the last full query is
+        # SHARED_DATA_MAX_AGE old
+        if isinstance(spinner, SearchSpinner):
+            return TrackerApp.search_spinner(session, sql_type.name, spinner, spinner.prefix, editable)
+        try:
+            source, since, labels = getattr(spinner, 'change_state', (None, None, None))  # From the last full query
+            version = database.get_change_version(session)
+            changed = database.get_changed_ids(session, sql_type, since, database.SHARED_DATA_MAX_AGE) \
+                if source == (session.get_bind(), sql_type) else None
+            if sql_type == database.Forecast:
+                if changed is None or changed:
+                    labels = dict(enumerate(database.get_values(session, database.Forecast.date, distinct=True)))
+            elif changed is None:
+                labels = database.get_values_by_id(session, sql_type.name)
+            elif changed:
+                labels = {key: value for key, value in labels.items() if key not in changed}
+                labels.update(database.get_values_by_id(session, sql_type.name, changed))
+            if changed is not None:
+                version = version._replace(taken_at=since.taken_at)  # The data is as old as its last full query
+            spinner.change_state = ((session.get_bind(), sql_type), version, labels)
+            object_list = ['Create New'] if editable else []
+            object_list.extend(dict.fromkeys(str(labels[key]) for key in sorted(labels)))
+            if spinner.values != object_list:
+                spinner.values = object_list
+            return ""
+        except Exception as e:
+            return database.handle_error(e, session)
+
+    @staticmethod
+    def make_pager(session, column, prefix: str = '', **kwargs) -> Pager:
+        return Pager(lambda after, limit: database.get_page(session, column, prefix, after, limit, **kwargs),
+                     handle_error=lambda e: database.handle_error(e, session))
+
+    @staticmethod
+    @database.operation
+    def search_spinner(session, column, spinner: SearchSpinner, prefix: str = '', editable=False, **kwargs) -> str:
         try:
-            objects = session.query(sql_type).all()
-            object_list = []
-            if editable:
-                object_list.append('Create New')
-            for element in objects:
-                if sql_type == database.Forecast and str(element.date) not in object_list:
-                    object_list.append(str(element.date))
-                elif sql_type != database.Forecast:
-                    object_list.append(element.name)
-            spinner.values = object_list
+            spinner.prefix = prefix
+            spinner.search(TrackerApp.make_pager(session, column, prefix, **kwargs), ['Create New'] if editable else [])
             return ""
         except Exception as e:
             return database.handle_error(e, session)
 
     @staticmethod
+    @database.operation
     def create_object(session, sql_type: database.Persisted, unique_checks: dict, other_values: dict,
                       show_confirmation_message=True):
         other_values.update(unique_checks)
@@ -130,11 +358,10 @@ class TrackerApp(MDApp, ABC):
             if other_values[key] == '':
                 return 'Please fill out all fields'
         try:
-            if database.get_exists(session, sql_type, **unique_checks):
-                return f'{sql_type.__name__} already added! Please try again'
-            else:
-                database.create_object(session, sql_type, **other_values)
-                return f'{sql_type.__name__} added!' if show_confirmation_message else ''
+            database.create_object(session, sql_type, **other_values)
+            return f'{sql_type.__name__} added!' if show_confirmation_message else ''
+        except IntegrityError:  # unique_checks are the natural key, so its unique constraint catches duplicates
+            return f'{sql_type.__name__} already added! Please try again'
         except Exception as e:
             return database.handle_error(e, session)
 
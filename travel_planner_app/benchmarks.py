@@ -0,0 +1,225 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import tracemalloc
+from timeit import default_timer
+from typing import Iterable, Tuple
+
+import sqlalchemy
+from kivy.uix.spinner import Spinner
+
+import csv_handler
+import database
+import generator
+import itineraries
+import validation
+from main import TravelApp
+from tracker_app import ListHolder, SearchSpinner
+
+SCALES = (1000, 10000, 100000)
+
+
+def time_call(function, *args, repeat: int = 3) -> float:
+    """
+    :returns: the fastest of repeat calls, in seconds
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = default_timer()
+        function(*args)
+        best = min(best, default_timer() - start)
+    return best
+
+
+def benchmark_distances(csv_file: str = 'airports.csv', source_count: int = 100) -> dict:
+    """
+    Compares the distance matrix for source_count airports to every airport in csv_file against the per-pair
+    great-circle loop it replaced, with the scalar haversine distance alongside.
+    """
+    locations = [(float(airport['latitude']), float(airport['longitude']))
+                 for airport in csv_handler.store_airports(csv_file)]
+    sources = locations[:source_count]
+
+    def baseline():
+        # Like the original itinerary search, which skipped pairs of the same airport. acos fails on some of them
+        return [[database.get_great_circle_distance(source, destination) for destination in locations
+                 if destination != source] for source in sources]
+
+    def scalar():
+        return [[database.get_haversine_distance(source, destination) for destination in locations]
+                for source in sources]
+
+    def vectorized():
+        return database.get_distance_matrix(sources, locations)
+
+    results = {'pairs': len(sources) * len(locations),
+               'baseline_seconds': time_call(baseline),
+               'scalar_seconds': time_call(scalar),
+               'vectorized_seconds': time_call(vectorized)}
+    results['speedup'] = results['baseline_seconds'] / results['vectorized_seconds']
+    return results
+
+
+def measure_startup(load) -> Tuple[float, int]:
+    """
+    :returns: seconds taken by load and the peak memory it allocated, in bytes
+    """
+    tracemalloc.start()
+    start = default_timer()
+    result = load()
+    seconds = default_timer() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    return seconds, peak
+
+
+def benchmark_airport_loading(csv_file: str = 'airports.csv') -> dict:
+    """
+    Compares parsing csv_file into dictionaries, as the planner did at startup, with loading the airport cache.
+    """
+    csv_handler.build_airport_cache(csv_file)
+
+    def from_cache():
+        reference = csv_handler.AirportReference(csv_file)
+        reference.get('KLNK')
+        return reference
+
+    csv_seconds, csv_bytes = measure_startup(lambda: csv_handler.store_airports(csv_file))
+    cache_seconds, cache_bytes = measure_startup(from_cache)
+    return {'airports': len(csv_handler.AirportReference(csv_file)),
+            'cache_file_bytes': os.path.getsize(csv_handler.get_cache_file(csv_file)),
+            'csv_seconds': csv_seconds, 'csv_peak_bytes': csv_bytes,
+            'cache_seconds': cache_seconds, 'cache_peak_bytes': cache_bytes}
+
+
+def time_once(function, *args) -> float:
+    """
+    :returns: seconds taken by a single call, for calls whose first run differs from later ones
+    """
+    start = default_timer()
+    function(*args)
+    return default_timer() - start
+
+
+def get_dataset_sizes(scale: int) -> dict:
+    """
+    Sizes of a generated dataset with about scale forecasts, a tenth as many cities, airports and reviews and a
+    hundredth as many operators. Airports are capped at the number of official airports.
+    """
+    return {'cities': scale // 10, 'airports': scale // 10, 'operators': max(scale // 100, 1),
+            'airports_per_operator': 10, 'airplanes': 10, 'forecast_days': 5, 'reviews': scale // 10}
+
+
+def make_onecall_record(start: datetime.date, days: int = 8) -> dict:
+    """
+    :returns: an OpenWeather onecall response with daily forecasts from start on, as refresh_forecasts receives
+    """
+    timestamp = (start - datetime.date(1970, 1, 1)).days * 86400 + 43200
+    return {'timezone_offset': 0,
+            'daily': [{'dt': timestamp + 86400 * day, 'temp': {'max': 20, 'min': 10}, 'pop': 0.1, 'wind_speed': 2.5,
+                       'visibility': 10000, 'weather': [{'main': 'Clear', 'description': 'clear sky'}]}
+                      for day in range(days)]}
+
+
+def benchmark_hot_paths(scale: int, app: TravelApp, seed: int = 0, csv_file: str = 'airports.csv') -> dict:
+    """
+    Times the database, list, itinerary, validation and forecast hot paths against an in-memory SQLite database
+    holding a generated dataset of the given scale.
+    Paths with caches or incremental updates are timed both cold, on the first call, and warm, on a later call with
+    nothing changed.
+
+    :param app: a built TravelApp, for the screens the lists are shown on
+    """
+    results = {'scale': scale}
+    benchmark_database = database.Database(database.Database.construct_in_memory_url())
+    benchmark_database.ensure_tables_exist()
+    session = benchmark_database.create_session()
+    today = datetime.date.today()
+    start = default_timer()
+    results['rows'] = generator.generate(session, seed=seed, start_date=today, **get_dataset_sizes(scale))
+    results['generate_seconds'] = default_timer() - start
+    for screen, list_id in [('validate_locations', 'validate_locations_list'),
+                            ('update_ratings', 'update_rating_list')]:
+        app.root.get_screen(screen).ids[list_id].populate_two_line_list({})  # Rows of the last scale aren't reused
+    locations = random.Random(seed).sample(
+        [(airport.latitude, airport.longitude) for airport in session.query(database.Airport.latitude,
+                                                                            database.Airport.longitude)], 10)
+
+    def nearby():
+        for latitude, longitude in locations:
+            database.get_nearby(session, latitude, longitude, database.Airport)
+
+    results['get_nearby_cold_seconds'] = time_once(nearby) / len(locations)
+    results['get_nearby_seconds'] = time_call(nearby) / len(locations)
+
+    names = iter(range(10 ** 9))
+
+    def create_city():
+        database.create_object(session, database.City, name=f'Benchmark {next(names)}',
+                               geographic_identity='Benchmark', latitude=0, longitude=0)
+
+    results['create_object_seconds'] = time_call(create_city)
+    results['create_duplicate_seconds'] = time_call(
+        TravelApp.create_object, session, database.City, {'name': 'Benchmark 0', 'geographic_identity': 'Benchmark'},
+        {'latitude': 0, 'longitude': 0}, False)
+    results['get_exists_seconds'] = time_call(lambda: database.get_exists(session, database.City, name='Benchmark 0'))
+
+    for name, sql_type, spinner in [('operator', database.Operator, Spinner()),
+                                    ('airport', database.Airport, SearchSpinner())]:  # As on the app's screens
+        results[f'populate_{name}_spinner_cold_seconds'] = time_once(TravelApp.populate_spinner, session, sql_type,
+                                                                     spinner)
+        results[f'populate_{name}_spinner_seconds'] = time_call(TravelApp.populate_spinner, session, sql_type, spinner)
+
+    for name, populate in [('populate_invalid_locations', TravelApp.populate_invalid_locations),
+                           ('populate_unvalidated_ratings', TravelApp.populate_unvalidated_ratings)]:
+        results[f'{name}_cold_seconds'] = time_once(populate, session, app.root)
+        results[f'{name}_seconds'] = time_call(populate, session, app.root)
+
+    city = session.query(database.City).filter_by(valid=True).first()
+    for greedy, name in [(True, 'greedy'), (False, 'scenic')]:
+        results[f'generate_itinerary_{name}_cold_seconds'] = time_once(
+            itineraries.generate_itinerary, session, city, 0, ListHolder(), greedy)
+        results[f'generate_itinerary_{name}_seconds'] = time_call(
+            itineraries.generate_itinerary, session, city, 0, ListHolder(), greedy)
+
+    reference = csv_handler.AirportReference(csv_file)
+    results['check_airports_seconds'] = time_call(validation.check_airports, session, reference)
+
+    record = make_onecall_record(today)
+    owners = [{'airport_id': airport_id} for airport_id, in session.query(database.Airport.airport_id)]
+    results['ingest_forecasts_rows'] = len(owners) * len(record['daily'])
+    results['ingest_forecasts_seconds'] = time_call(
+        lambda: database.ingest_forecasts(session, ((owner, record) for owner in owners)))
+    session.close()
+    return results
+
+
+def run(scales: Iterable[int] = SCALES, seed: int = 0) -> dict:
+    """
+    :returns: the environment and the results of every benchmark, ready to be written as JSON
+    """
+    app = TravelApp()
+    app.root = app.build()
+    return {'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(), 'sqlalchemy': sqlalchemy.__version__,
+            'platform': platform.platform(),
+            'distances': benchmark_distances(), 'airport_loading': benchmark_airport_loading(),
+            'hot_paths': [benchmark_hot_paths(scale, app, seed) for scale in scales]}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the travel planner and writes the results as JSON.')
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES, help='dataset sizes, in forecast rows')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file to write, standard output by default')
+    arguments = parser.parse_args()
+    results = json.dumps(run(arguments.scales, arguments.seed), indent=2)
+    if arguments.output is None:
+        print(results)
+    else:
+        with open(arguments.output, 'w') as file:
+            file.write(results)
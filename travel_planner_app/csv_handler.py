@@ -1,4 +1,11 @@
 import csv
+import mmap
+import os
+import struct
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional
+
+import numpy
 
 
 def store_airports(csv_file):
@@ -17,7 +24,191 @@ def store_airports(csv_file):
     return airport_list
 
 
+CACHE_MAGIC = b'APRT'
+CACHE_VERSION = 1
+CACHE_HEADER = struct.Struct('<4sHqqII')  # magic, version, source mtime, source size, airports, strings
+
+
+def get_cache_file(csv_file) -> str:
+    return os.path.splitext(csv_file)[0] + '.cache'
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) // 8 * 8
+
+
+def _get_cache_layout(airport_count: int, string_count: int) -> List[tuple]:
+    """
+    :returns: (name, dtype, count, offset) of each column in the cache file
+    """
+    columns = [('codes', 'S4', airport_count), ('latitudes', '<f8', airport_count),
+               ('longitudes', '<f8', airport_count), ('names', '<i4', airport_count),
+               ('countries', '<i4', airport_count), ('string_offsets', '<i8', string_count + 1)]
+    layout = []
+    offset = CACHE_HEADER.size
+    for name, dtype, count in columns:
+        offset = _align(offset)
+        layout.append((name, dtype, count, offset))
+        offset += numpy.dtype(dtype).itemsize * count
+    layout.append(('strings', 'u1', None, offset))
+    return layout
+
+
+def read_airport_columns(csv_file) -> Dict[str, numpy.ndarray]:
+    """
+    Parses csv_file into the columns of the airport cache: fixed-width ICAO codes, latitude and longitude arrays and
+    indexes into a string table holding each distinct name and country once.
+    """
+    airports = store_airports(csv_file)
+    strings: Dict[str, int] = {}
+    names = [strings.setdefault(airport['airport_name'], len(strings)) for airport in airports]
+    countries = [strings.setdefault(airport['country_name'], len(strings)) for airport in airports]
+    encoded = [string.encode('utf-8') for string in strings]
+    return {
+        'codes': numpy.array([airport['ICAO_code'].encode('utf-8') for airport in airports], dtype='S4'),
+        'latitudes': numpy.array([float(airport['latitude']) for airport in airports], dtype='<f8'),
+        'longitudes': numpy.array([float(airport['longitude']) for airport in airports], dtype='<f8'),
+        'names': numpy.array(names, dtype='<i4'),
+        'countries': numpy.array(countries, dtype='<i4'),
+        'string_offsets': numpy.cumsum([0] + [len(string) for string in encoded], dtype='<i8'),
+        'strings': numpy.frombuffer(b''.join(encoded), dtype='u1'),
+    }
+
+
+def build_airport_cache(csv_file, cache_file=None) -> str:
+    """
+    Writes the columns from read_airport_columns to a file that load_airport_cache can memory-map.
+
+    :returns: the path of the cache file
+    """
+    cache_file = cache_file or get_cache_file(csv_file)
+    source = os.stat(csv_file)
+    columns = read_airport_columns(csv_file)
+    airport_count, string_count = len(columns['codes']), len(columns['string_offsets']) - 1
+    temporary_file = f'{cache_file}.{os.getpid()}.tmp'
+    with open(temporary_file, 'wb') as file:
+        file.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, source.st_mtime_ns, source.st_size, airport_count,
+                                     string_count))
+        for name, _dtype, _count, offset in _get_cache_layout(airport_count, string_count):
+            file.write(bytes(offset - file.tell()))
+            file.write(columns[name].tobytes())
+    os.replace(temporary_file, cache_file)  # Readers never see a half written cache
+    return cache_file
+
+
+def load_airport_cache(csv_file, cache_file=None) -> Optional[Dict[str, numpy.ndarray]]:
+    """
+    Memory-maps the cache written by build_airport_cache.
+
+    :returns: the cache's columns, or None if it is missing or older than csv_file
+    """
+    cache_file = cache_file or get_cache_file(csv_file)
+    try:
+        source = os.stat(csv_file)
+        with open(cache_file, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    if len(mapped) < CACHE_HEADER.size:
+        return None
+    magic, version, mtime, size, airport_count, string_count = CACHE_HEADER.unpack_from(mapped)
+    if (magic, version, mtime, size) != (CACHE_MAGIC, CACHE_VERSION, source.st_mtime_ns, source.st_size):
+        return None
+    return {name: numpy.frombuffer(mapped, dtype, count if count is not None else -1, offset)
+            for name, dtype, count, offset in _get_cache_layout(airport_count, string_count)}
+
+
+class AirportReference(object):
+    """
+    The official airports in csv_file, indexed by ICAO code, name and country.
+    Nothing is read until the first lookup. Airports are then memory-mapped from the cache next to csv_file, which is
+    rebuilt whenever csv_file changes. Each secondary index is only built when it is first used.
+    """
+
+    def __init__(self, csv_file, cache_file=None):
+        self.csv_file = csv_file
+        self.cache_file = cache_file or get_cache_file(csv_file)
+        self._columns: Optional[Dict[str, numpy.ndarray]] = None
+        self._by_code: Optional[Dict[str, int]] = None  # ICAO code -> row
+        self._names: Optional[List[tuple]] = None  # Sorted (lowercase name, row) pairs
+        self._by_country: Optional[Dict[str, List[int]]] = None
+
+    def _load(self):
+        columns = load_airport_cache(self.csv_file, self.cache_file)
+        if columns is None:
+            try:
+                build_airport_cache(self.csv_file, self.cache_file)
+                columns = load_airport_cache(self.csv_file, self.cache_file)
+            except OSError:
+                pass
+        self._columns = columns if columns is not None else read_airport_columns(self.csv_file)  # Read-only folder
+        self._by_code = {code.decode('utf-8'): row for row, code in enumerate(self._columns['codes'].tolist())}
+
+    @property
+    def by_code(self) -> Dict[str, int]:
+        if self._by_code is None:
+            self._load()
+        return self._by_code
+
+    @property
+    def columns(self) -> Dict[str, numpy.ndarray]:
+        if self._columns is None:
+            self._load()
+        return self._columns
+
+    def _get_string(self, index: int) -> str:
+        offsets = self.columns['string_offsets']
+        return self.columns['strings'][offsets[index]:offsets[index + 1]].tobytes().decode('utf-8')
+
+    def _get_row(self, row: int) -> dict:
+        return {
+            'ICAO_code': self.columns['codes'][row].decode('utf-8'),
+            'airport_name': self._get_string(self.columns['names'][row]),
+            'country_name': self._get_string(self.columns['countries'][row]),
+            'latitude': float(self.columns['latitudes'][row]),
+            'longitude': float(self.columns['longitudes'][row]),
+        }
+
+    def get(self, icao_code: str) -> Optional[dict]:
+        row = self.by_code.get(icao_code)
+        return self._get_row(row) if row is not None else None
+
+    def get_many(self, icao_codes: Iterable[str]) -> Dict[str, Optional[dict]]:
+        return {icao_code: self.get(icao_code) for icao_code in icao_codes}
+
+    def get_by_name_prefix(self, prefix: str, limit: int = None) -> List[dict]:
+        """
+        :returns: airports whose name starts with prefix, ignoring case, in alphabetical order
+        """
+        if self._names is None:
+            self._names = sorted((self._get_string(name).lower(), row) for row, name in
+                                 enumerate(self.columns['names'].tolist()))
+        prefix = prefix.lower()
+        found = []
+        index = bisect_left(self._names, (prefix,))
+        while index < len(self._names) and self._names[index][0].startswith(prefix) and \
+                (limit is None or len(found) < limit):
+            found.append(self._get_row(self._names[index][1]))
+            index += 1
+        return found
+
+    def get_by_country(self, country_name: str) -> List[dict]:
+        if self._by_country is None:
+            self._by_country = {}
+            for row, country in enumerate(self.columns['countries'].tolist()):
+                self._by_country.setdefault(self._get_string(country), []).append(row)
+        return [self._get_row(row) for row in self._by_country.get(country_name, [])]
+
+    def __contains__(self, icao_code):
+        return icao_code in self.by_code
+
+    def __len__(self):
+        return len(self.by_code)
+
+
 def check_airport(airport_list, validate):
+    if isinstance(airport_list, AirportReference):
+        return airport_list.get(validate)
     for airport in airport_list:
         if validate == airport["ICAO_code"]:
             return airport
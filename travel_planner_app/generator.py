@@ -0,0 +1 @@
+../installer/generator.py
\ No newline at end of file
@@ -0,0 +1 @@
+../installer/installer.py
\ No newline at end of file
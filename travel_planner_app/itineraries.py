@@ -1,40 +1,24 @@
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
 from math import inf
-from typing import Set
+from typing import Set, Iterable, Iterator, List, Tuple, Callable, Optional
+
+from kivy.clock import Clock
 
 from database import *
+from routing import get_route_graph, get_feasibility_table, get_next_cities, get_routing_snapshot, plan_itinerary, \
+    plan_itineraries
 from tracker_app import ListHolder
 
 
 def get_possible_next_cities(session, city: City, date: datetime.date, day_into_journey: int) -> Set[City]:
-    cities = set()
-    for airport in city.airports:
-        try:
-            forecast: Forecast = get_object(session, Forecast, date=date, airport=airport)
-            if forecast.temperature <= 45 and forecast.visibility >= 5 and forecast.weather_description not in \
-                    ['Thunderstorm', 'Tornado']:
-                for operator in airport.operators:
-                    if operator.airplane.range <= 4000:
-                        for destination in operator.airports:
-                            for origin in city.airports:
-                                if origin != destination:
-                                    distance = get_great_circle_distance(destination.location, origin.location)
-                                    if distance < operator.airplane.range:
-                                        if day_into_journey < 16:
-                                            cities.update(destination.cities)
-                                        else:
-                                            for destination_city in destination.cities:
-                                                if destination_city.name == 'Lincoln' and \
-                                                        destination_city.geographic_identity == 'Nebraska':
-                                                    cities.add(destination_city)
-        except NoResultFound:
-            pass
-
-    cities.discard(city)  # Don't just wander back to the same city
-    return cities
-
-
-def chose_city(possible_cities: Set[City], current_city: City) -> City:
+    city_ids = get_next_cities(get_route_graph(session), city.city_id, date, day_into_journey,
+                               get_feasibility_table(session, date).can_take_off)
+    return set(session.query(City).filter(City.city_id.in_(city_ids)).all()) if city_ids else set()
+
+
+def chose_city(possible_cities: Iterable[City], current_city: City) -> City:
     furthest = -inf
     furthest_distance = -inf
     furthest_city = None
@@ -48,24 +32,29 @@ def chose_city(possible_cities: Set[City], current_city: City) -> City:
 
 def generate_itinerary(session: Session, current_city: City, days_into_journey: int, output_itinerary: ListHolder,
                        greedy: bool):
-    cities = [current_city]
-    have_done_first = False  # Setting up do while
-    date = datetime.date.today()
-    while not have_done_first or (cities[-1] != cities[0] and days_into_journey < 17):
-        inner_cities = get_possible_next_cities(session, cities[-1], date, days_into_journey)
-        if len(inner_cities) > 0:
-            city = chose_city(inner_cities, cities[-1])
-            if city:
-                cities.append(city)
-            else:
-                break
-        else:
-            break
-        days_into_journey += 1
-        date += datetime.timedelta(days=1)
-        have_done_first = True
-    cities = [f'{city.name}, {city.geographic_identity}' for city in cities]
-    output_itinerary.populate_list(cities)
+    """
+    Fills output_itinerary with the fastest way back to Lincoln if greedy, otherwise with a wander that ends back at
+    current_city.
+    """
+    snapshot = get_routing_snapshot(session, datetime.date.today())
+    city_ids = plan_itinerary(snapshot, current_city.city_id, days_into_journey, greedy, chose_city)
+    output_itinerary.populate_list([str(snapshot.graph.cities[city_id]) for city_id in city_ids])
+
+
+def generate_itineraries(session: Session, city_ids: Iterable[int] = None, days_into_journey: int = 0,
+                         max_workers: int = None) -> Iterator[Tuple[int, bool, List[str]]]:
+    """
+    Plans both itineraries from many cities at once, e.g. every valid city, spread across a process pool.
+
+    :param city_ids: the start cities, or None for every valid city
+    :returns: (start city id, greedy, itinerary) as itineraries are finished
+    """
+    if city_ids is None:
+        city_ids = [city_id for city_id, in session.query(City.city_id).filter_by(valid=True)]
+    snapshot = get_routing_snapshot(session, datetime.date.today())
+    for city_id, greedy, itinerary in plan_itineraries(snapshot, city_ids, days_into_journey, chose_city,
+                                                        max_workers=max_workers):
+        yield city_id, greedy, [str(snapshot.graph.cities[stop]) for stop in itinerary]
 
 
 def request_itinerary(session, current_city: str, days_into_journey: int, lincoln_or_bust: ListHolder,
@@ -74,3 +63,65 @@ def request_itinerary(session, current_city: str, days_into_journey: int, lincol
     current_city = get_object(session, City, name=city[0], geographic_identity=city[1])
     generate_itinerary(session, current_city, days_into_journey, lincoln_or_bust, True)
     generate_itinerary(session, current_city, days_into_journey, the_scenic_route, False)
+
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='itineraries')
+
+
+class ItineraryRequest(object):
+    """
+    Plans both itineraries from a city on a background thread with its own session so the window stays responsive,
+    then fills the itinerary lists from the Kivy main thread.
+    A cancelled request stops searching as soon as it can and never touches the lists.
+    """
+
+    def __init__(self, create_session: Callable[[], Session], current_city: str, days_into_journey: int,
+                 lincoln_or_bust: ListHolder, the_scenic_route: ListHolder,
+                 on_finished: Callable[[Optional[str]], None] = None):
+        """
+        :param create_session: opens the session the background thread queries with
+        :param on_finished: called on the main thread with an error message, or None if the itineraries were planned
+        """
+        self.create_session = create_session
+        self.current_city = current_city
+        self.days_into_journey = days_into_journey
+        self.lincoln_or_bust = lincoln_or_bust
+        self.the_scenic_route = the_scenic_route
+        self.on_finished = on_finished
+        self.cancelled = threading.Event()
+        self.future: Optional[Future] = None
+
+    def start(self) -> 'ItineraryRequest':
+        self.future = _executor.submit(self._plan)
+        return self
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def _plan(self):
+        session = self.create_session()
+        itineraries, error = None, None
+        try:
+            name, geographic_identity = self.current_city.split(', ')
+            city = get_object(session, City, name=name, geographic_identity=geographic_identity)
+            snapshot = get_routing_snapshot(session, datetime.date.today())
+            itineraries = [[str(snapshot.graph.cities[city_id]) for city_id in
+                            plan_itinerary(snapshot, city.city_id, self.days_into_journey, greedy, chose_city,
+                                           self.cancelled.is_set)]
+                           for greedy in (True, False)]
+        except Exception as e:
+            error = handle_error(e, session)
+        finally:
+            session.close()
+        Clock.schedule_once(lambda _time: self._publish(itineraries, error))
+
+    def _publish(self, itineraries: Optional[List[List[str]]], error: Optional[str]):
+        if self.cancelled.is_set():
+            return
+        if itineraries is not None:
+            self.lincoln_or_bust.populate_list(itineraries[0])
+            self.the_scenic_route.populate_list(itineraries[1])
+        if self.on_finished is not None:
+            self.on_finished(error)
@@ -1,8 +1,7 @@
+import threading
 import traceback
-from datetime import datetime
 from json import dumps
-from math import inf
-from typing import Iterator, List
+from typing import Dict, List, Set
 
 from kivy.clock import Clock
 from kivy.core.window import Window
@@ -11,15 +10,30 @@ from kivy.uix.label import Label
 
 import csv_handler
 import database
+import validation
 from database import Database
-from itineraries import request_itinerary
-from rest import RESTConnection
-from tracker_app import TrackerApp, ListHolder, TwoListItem
+from itineraries import request_itinerary, ItineraryRequest
+from pipeline import Stage, StagePipeline, SkippedStage
+from rest import RESTConnection, RESTFetcher, ResponseCache
+from tracker_app import TrackerApp, ListHolder, RecycleTwoLineListHolder, TwoLineRow
 
 lincoln_latitude = '40.8'
 lincoln_longitude = '-96.7'
 UNITS = 'metric'
-airport_list = csv_handler.store_airports('airports.csv')
+airport_reference = csv_handler.AirportReference('airports.csv')
+DAY = 24 * 60 * 60  # Unit: second
+response_cache = ResponseCache({'onecall': 60 * 60, 'direct': 3 * DAY, 'reverse': 3 * DAY},
+                               path='responses.sqlite')
+LOADING_MESSAGES = {
+    'database': 'Logged into sql_database',
+    'invalid_locations': 'Populated invalidated locations',
+    'reviews': 'Populated unvalidated reviews',
+    'weather': 'Superfluous open weather connection may have been created',  # TODO figure out how to check if it worked
+}
+
+
+class LoadingError(Exception):
+    pass  # A loading stage failed, with a message fit for the user
 
 
 class TravelApp(TrackerApp):
@@ -29,6 +43,8 @@ class TravelApp(TrackerApp):
         super().__init__(**kwargs)
         self.records = []
         self.user_api = None
+        self.itinerary_request = None
+        self.ambiguities: Dict[tuple, validation.Ambiguity] = {}  # What validate all left to the user, by list key
 
     def after_build(self, _time):
         self.root.current = 'credentials'
@@ -36,19 +52,7 @@ class TravelApp(TrackerApp):
     def create_session(self):
         pass  # overrides the startup session creation
 
-    def validate_ratings_clicked(self):
-        reviews = database.get_objects(self.session, database.Review)
-        to_validate_reviews = {}
-        for review in reviews:
-            current_rating = database.get_object(self.session, database.Operator,
-                                                 operator_id=review.operator_id).rate_my_pilot_score
-            to_validate_reviews[f'New rating: {review.review}'] = [f'Current Average Rating: {current_rating}',
-                                                                   review.review_id]
-        self.root.get_screen('update_ratings').ids.update_rating_list.populate_two_line_list(
-            to_validate_reviews)
-        self.root.transition.direction = 'left'
-        self.root.current = 'update_ratings'
-
+    @database.operation
     def accept_rating_clicked(self):
         try:
             if len(self.root.get_screen('update_ratings').ids.update_rating_list.selected_elements) > 0:
@@ -60,11 +64,8 @@ class TravelApp(TrackerApp):
                 new_score = review.review
                 operator.rate_my_pilot_score = (current_score + new_score) / 2
                 database.delete_object(self.session, database.Review, review_id=review_id)
-                selected_item = self.root.get_screen('update_ratings').ids.update_rating_list.selected_elements[0]
-                selected_item.parent.selected_elements.clear()
-                selected_item.parent.remove_widget(selected_item)
-                self.root.get_screen('main_menu').to_update -= 1
                 self.session.commit()
+                self.refresh_unvalidated_ratings()
                 self.create_popup('Operator\'s rating updated successfully')
             else:
                 self.create_popup('Please select an item')
@@ -72,19 +73,84 @@ class TravelApp(TrackerApp):
             traceback.print_exc()
             self.create_popup(f'Database connection failed!\nCause: {exception}')
 
+    @database.operation
     def validate_location_clicked(self):
         if len(self.root.get_screen('validate_locations').ids.validate_locations_list.selected_elements) > 0:
             item_selected = self.root.get_screen('validate_locations').ids.validate_locations_list.selected_elements[0]
-            item_type = item_selected.secondary_text
+            item_type, _ = item_selected.key
             item_name = item_selected.text
-            if 'Airport' in item_type:
+            ambiguity = self.ambiguities.get(item_selected.key)
+            if ambiguity is not None and ambiguity.official_name is not None:
+                self.resolve_ambiguity(ambiguity)
+            elif item_type == database.Airport.__name__:
                 self.call_csv_by_identifier(item_selected)
-            elif 'City' in item_type:
+            elif item_type == database.City.__name__:
                 self.call_geocoding_api_by_name(item_name)
 
+    def resolve_ambiguity(self, ambiguity: validation.Ambiguity):
+        element = self.session.get(ambiguity.sql_type, ambiguity.element_id)
+        new_name = ambiguity.official_name if ambiguity.sql_type is database.Airport else None
+        self.create_choice_popup(
+            f'{ambiguity.reason}. The official {ambiguity.official_name} is at longitude: '
+            f'{ambiguity.official_longitude} and latitude: {ambiguity.official_latitude}. '
+            f'Do you want to use this data or keep your data?',
+            lambda _obj: self.keep_my_data_clicked(element),
+            lambda _obj: self.use_official_data_clicked(element, ambiguity.official_latitude,
+                                                        ambiguity.official_longitude, new_name))
+
+    def validate_all_clicked(self):
+        # On a background thread, so the window stays responsive while the cities are geocoded
+        self.root.get_screen('validate_locations').ids.validate_all.disabled = True
+        threading.Thread(target=self.validate_all_in_background, daemon=True).start()
+
+    def validate_all_in_background(self):
+        session = self.operator_database.create_session()
+        try:
+            with database.profile_operation('TravelApp.validate_all_in_background'):
+                connection = RESTConnection('api.openweathermap.org', 443, '/geo/1.0', cache=response_cache)
+                with RESTFetcher(connection) as fetcher:
+                    validated, ambiguities = validation.validate_all(session, airport_reference, fetcher,
+                                                                     self.user_api)
+            message = f'{validated} locations validated. {len(ambiguities)} need to be validated by hand.'
+        except Exception as exception:
+            ambiguities = None
+            message = database.handle_error(exception, session)
+        finally:
+            session.close()
+        Clock.schedule_once(lambda _time: self.on_validated_all(message, ambiguities))
+
+    def on_validated_all(self, message: str, ambiguities: List[validation.Ambiguity] = None):
+        self.root.get_screen('validate_locations').ids.validate_all.disabled = False
+        if ambiguities is not None:
+            described = set(self.ambiguities)
+            self.ambiguities = {(ambiguity.sql_type.__name__, ambiguity.element_id): ambiguity
+                                for ambiguity in ambiguities}
+            described.update(self.ambiguities)
+        else:
+            described = set()
+        self.refresh_invalid_locations()
+        # The rows of the ambiguous locations didn't change in the database, so refreshing leaves their second line
+        locations_list: RecycleTwoLineListHolder = self.root.get_screen('validate_locations').ids.validate_locations_list
+        locations_list.update_two_line_list(self.describe_ambiguities(
+            {key: (row.text, f'Type: {key[0]}', row.id) for key, row in locations_list.items.items()
+             if key in described}), [])
+        self.create_popup(message)
+
+    def describe_ambiguities(self, invalids_dict: dict) -> dict:
+        # The official data, or why there is none, as the second line of the rows validate all couldn't settle
+        for key, (name, type_text, element_id) in invalids_dict.items():
+            ambiguity = self.ambiguities.get(key)
+            if ambiguity is None:
+                continue
+            if ambiguity.official_name is not None:
+                type_text = f'Official: {ambiguity.official_name} ' \
+                            f'({ambiguity.official_latitude:.4f}, {ambiguity.official_longitude:.4f})'
+            else:
+                type_text = ambiguity.reason
+            invalids_dict[key] = (name, type_text, element_id)
+        return invalids_dict
+
     def validate_locations(self, records):
-        distances = []
-        selected_item = self.root.get_screen('validate_locations').ids.validate_locations_list.selected_elements[0]
         city_name = self.root.get_screen('validate_locations').ids.validate_locations_list.selected_elements[0].text
         invalid_city = database.get_object(self.session, database.City, name=city_name)
         latitude = invalid_city.latitude
@@ -97,20 +163,12 @@ class TravelApp(TrackerApp):
                     updating_city = database.get_object(self.session, database.City, name=city_name)
                     updating_city.valid = 1
                     self.session.commit()
-                    selected_item.parent.selected_elements.clear()
-                    selected_item.parent.remove_widget(selected_item)
-                    self.root.get_screen('main_menu').to_validate -= 1
+                    self.refresh_invalid_locations()
                     return self.create_popup('City was successfully validated.')
-                distance = database.get_great_circle_distance((latitude, longitude), (real_latitude, real_longitude))
-                distances.append(distance)
-            shortest_distance = inf
-            shortest_distance_index = inf
-            if len(distances) != 0:
-                for i in range(len(distances)):
-                    if distances[i] < shortest_distance:
-                        shortest_distance = distances[i]
-                        shortest_distance_index = i
-                closest_city = records[shortest_distance_index]
+            if len(records) != 0:
+                distances = database.get_distance_matrix([(latitude, longitude)],
+                                                         [(record['lat'], record['lon']) for record in records])[0]
+                closest_city = records[int(distances.argmin())]
                 closest_city_latitude = closest_city['lat']
                 closest_city_longitude = closest_city['lon']
                 self.create_choice_popup(
@@ -121,28 +179,22 @@ class TravelApp(TrackerApp):
 
 
             else:
-                selected_item.parent.selected_elements.clear()
-                selected_item.parent.remove_widget(selected_item)
                 self.create_popup('No city with such name found. City could not be validated and will be deleted.')
                 database.delete_object(self.session, database.City, city_id=invalid_city.city_id)
-                self.root.get_screen('main_menu').to_validate -= 1
                 self.session.commit()
+                self.refresh_invalid_locations()
         except Exception as e:
             traceback.print_exc()
             print(e)
 
-    def remove_item_widget(self):
-        selected_item = self.root.get_screen('validate_locations').ids.validate_locations_list.selected_elements[0]
-        selected_item.parent.selected_elements.clear()
-        selected_item.parent.remove_widget(selected_item)
-
+    @database.operation
     def keep_my_data_clicked(self, element):
         element.valid = True
         self.session.commit()
-        self.remove_item_widget()
-        self.root.get_screen('main_menu').to_validate -= 1
+        self.refresh_invalid_locations()
         self.close_popup(None)
 
+    @database.operation
     def use_official_data_clicked(self, element, new_latitude, new_longitude, new_name=None):
         element.latitude = new_latitude
         element.longitude = new_longitude
@@ -150,23 +202,36 @@ class TravelApp(TrackerApp):
             element.name = new_name
         element.valid = True
         self.session.commit()
-        self.remove_item_widget()
-        self.root.get_screen('main_menu').to_validate -= 1
+        self.refresh_invalid_locations()
         self.close_popup(None)
 
     def post_init_create_session(self, authority: str, port: str, database_name: str, username: str,
                                  password: str):
+        try:
+            self.connect_to_database(authority, port, database_name, username, password)
+        except LoadingError as error:
+            self.create_popup(str(error))
+
+    def connect_to_database(self, authority: str, port: str, database_name: str, username: str, password: str):
         if password == '':
-            self.create_popup('Please enter the password.')
-        else:
+            raise LoadingError('Please enter the password.')
+        try:
+            url = Database.construct_mysql_url(authority, port, database_name, username, password)
+            self.operator_database = database.get_database(url)
+            if self.session is not None:
+                self.session.close()
+            self.session = self.operator_database.create_session()
+            _connection = self.session.connection()  # raises error if connection is not made
+        except Exception as exception:
+            traceback.print_exc()
+            raise LoadingError(f'Database connection failed!\nCause: {exception}') from exception
+
+    def query_in_own_session(self, query):
+        with self.operator_database.session_scope() as session:
             try:
-                url = Database.construct_mysql_url(authority, port, database_name, username, password)
-                self.operator_database = Database(url)
-                self.session = self.operator_database.create_session()
-                _connection = self.session.connection()  # raises error if connection is not made
+                return query(session)
             except Exception as exception:
-                traceback.print_exc()
-                self.create_popup(f'Database connection failed!\nCause: {exception}')
+                raise LoadingError(database.handle_error(exception, session)) from exception
 
     def on_records_loaded(self, _, response):
         print(dumps(response, indent=4, sort_keys=True))
@@ -183,7 +248,7 @@ class TravelApp(TrackerApp):
             return 'Please enter the API key.'
         else:
             try:
-                connection = RESTConnection(authority, port, '/data/2.5')
+                connection = RESTConnection(authority, port, '/data/2.5', cache=response_cache)
                 connection.send_request(
                     'onecall',
                     {
@@ -207,69 +272,146 @@ class TravelApp(TrackerApp):
                         open_weather_port: str, api_key: str):
         self.root.transition.direction = 'left'
         self.root.current = 'loading'
+        self.load(authority, port, database_name, username, password, open_weather_authority, open_weather_port,
+                  api_key)
+
+    def connect_to_weather(self, authority: str, port: str, api_key: str):
+        message = self.connect_to_weather_api(authority, port, api_key, lincoln_latitude, lincoln_longitude)
+        if message is not None:
+            raise LoadingError(message)
+
+    def load(self, authority: str, port: str, database_name: str, username: str, password: str,
+             open_weather_authority: str, open_weather_port: str, api_key: str) -> StagePipeline:
+        # Loads on background threads, querying both lists at once, while the loading screen shows each stage
         loading_text: Label = self.root.get_screen('loading').ids.loading
-        iterator = self._on_loading_screen(authority, port, database_name, username, password, open_weather_authority,
-                                           open_weather_port, api_key)
+        show_results = {
+            'invalid_locations': lambda result: self.show_invalid_locations(self.root, result[1], result[0]),
+            'reviews': lambda result: self.show_unvalidated_ratings(self.root, result[1], result[0]),
+        }
+
+        def show_progress(name, result, exception):
+            if exception is None:
+                if name in show_results:
+                    show_results[name](result)
+                loading_text.text += f'{LOADING_MESSAGES[name]}\n'
+            elif not isinstance(exception, SkippedStage):
+                self.create_popup(str(exception) if isinstance(exception, LoadingError) else
+                                  f'{LOADING_MESSAGES[name]} failed!\nCause: {exception}')
+
+        def leave_loading_screen(errors):
+            self.root.transition.direction = 'right' if errors else 'left'
+            self.root.current = 'credentials' if errors else 'main_menu'
+
+        stages = [
+            Stage('database', lambda: self.connect_to_database(authority, port, database_name, username, password)),
+            Stage('invalid_locations', lambda: self.query_in_own_session(
+                lambda session: (database.get_change_version(session), self.get_invalid_locations(session))),
+                  ('database',)),
+            Stage('reviews', lambda: self.query_in_own_session(
+                lambda session: (database.get_change_version(session), self.get_unvalidated_ratings(session))),
+                  ('database',)),
+            Stage('weather', lambda: self.connect_to_weather(open_weather_authority, open_weather_port, api_key)),
+        ]
+        return StagePipeline(
+            stages,
+            lambda *progress: Clock.schedule_once(lambda _time: show_progress(*progress)),
+            lambda errors: Clock.schedule_once(lambda _time: leave_loading_screen(errors))).start()
 
-        def use_loading_screen(_time):
-            try:
-                message = iterator.__next__()
-                loading_text.text += f'{message}\n'
-                if self.dialog and self.dialog.text != '':
-                    self.root.transition.direction = 'right'
-                    self.root.current = 'credentials'
-                    return
-                else:
-                    Clock.schedule_once(use_loading_screen)
-            except StopIteration:
-                self.root.transition.direction = 'left'
-                self.root.current = 'main_menu'
+    @staticmethod
+    def get_invalid_locations(session, changed: Dict[type, Set[int]] = None) -> dict:
+        # Only the cities and airports with the primary keys in changed, if given
+        invalids_dict: dict = {}
+        for sql_type in [database.City, database.Airport]:
+            if changed is not None and not changed[sql_type]:
+                continue
+            names = database.get_values_by_id(session, sql_type.name,
+                                              changed[sql_type] if changed is not None else None, valid=False)
+            for element_id, name in names.items():
+                invalids_dict[sql_type.__name__, element_id] = (name, f'Type: {sql_type.__name__}', element_id)
+        return invalids_dict
 
-        Clock.schedule_once(use_loading_screen, 1)
+    @staticmethod
+    def show_invalid_locations(manager, invalids_dict: dict, version: int = None):
+        locations_list: RecycleTwoLineListHolder = manager.get_screen('validate_locations').ids.validate_locations_list
+        locations_list.update_two_line_list(invalids_dict)
+        locations_list.version = version
+        manager.get_screen('main_menu').to_validate = len(locations_list.items)
 
     @staticmethod
+    @database.operation
     def populate_invalid_locations(session, manager) -> str:
         try:
-            invalids: List[database.Persisted] = []
-            invalids.extend(database.get_objects(session, database.City, valid=False))
-            invalids.extend(database.get_objects(session, database.Airport, valid=False))
-            invalids_dict: dict = {}
-            for element in invalids:
-                invalids_dict[element.name] = [f'Type: {element.__class__.__name__}',
-                                               element.__getattribute__(f'{element.__class__.__name__.lower()}_id')]
-            manager.get_screen('validate_locations').ids.validate_locations_list.populate_two_line_list(invalids_dict)
-            manager.get_screen('main_menu').to_validate = len(invalids_dict)
+            version = database.get_change_version(session)
+            TravelApp.show_invalid_locations(manager, TravelApp.get_invalid_locations(session), version)
         except Exception as e:
             return database.handle_error(e, session)
 
     @staticmethod
+    def get_unvalidated_ratings(session, changed: Dict[type, Set[int]] = None) -> dict:
+        # Only the reviews, or reviews of operators, with the primary keys in changed, if given
+        reviews = database.get_reviews_with_operators(session, changed[database.Review],
+                                                      changed[database.Operator]) \
+            if changed is not None else database.get_reviews_with_operators(session)
+        return {review.review_id: (str(review.review), f'Name: {review.operator_name}', review.review_id)
+                for review in reviews}
+
+    @staticmethod
+    def show_unvalidated_ratings(manager, invalids_dict: dict, version: int = None):
+        ratings_list: RecycleTwoLineListHolder = manager.get_screen('update_ratings').ids.update_rating_list
+        ratings_list.update_two_line_list(invalids_dict)
+        ratings_list.version = version
+        manager.get_screen('main_menu').to_update = len(ratings_list.items)
+
+    @staticmethod
+    @database.operation
     def populate_unvalidated_ratings(session, manager):
         try:
-            invalids = database.get_objects(session, database.Review)
-            invalids_dict: dict = {}
-            for element in invalids:
-                operator = database.get_object(session, database.Operator, operator_id=element.operator_id)
-                invalids_dict[element.review] = [f'Name: {operator.name}',
-                                                 element.__getattribute__(f'{element.__class__.__name__.lower()}_id')]
-            manager.get_screen('update_ratings').ids.update_rating_list.populate_two_line_list(invalids_dict)
-            manager.get_screen('main_menu').to_update = len(invalids_dict)
+            version = database.get_change_version(session)
+            TravelApp.show_unvalidated_ratings(manager, TravelApp.get_unvalidated_ratings(session), version)
         except Exception as e:
             return database.handle_error(e, session)
 
-    def _on_loading_screen(self, authority: str, port: str, database_name: str, username: str, password: str,
-                           open_weather_authority: str,
-                           open_weather_port: str, api_key: str) -> Iterator[str]:
-        self.create_popup(self.post_init_create_session(authority, port, database_name, username, password))
-        yield 'Logged into sql_database'
-        self.create_popup(self.populate_invalid_locations(self.session, self.root))
-        yield 'Populated invalidated locations'
-        self.create_popup(self.populate_unvalidated_ratings(self.session, self.root))
-        yield 'Populated unvalidated reviews'
-        self.create_popup(
-            self.connect_to_weather_api(open_weather_authority, open_weather_port, api_key, lincoln_latitude,
-                                        lincoln_longitude))
-        yield 'Superfluous open weather connection may have been created'  # TODO figure out how to check if it worked
-
+    @staticmethod
+    def refresh_two_line_list(session, list_holder: RecycleTwoLineListHolder, sql_types: List[type], get_rows,
+                              get_keys) -> bool:
+        # Only queries the rows of sql_types changed since list_holder was last updated. get_rows gets the changed
+        # primary keys, or None for every row, and get_keys the list keys of the rows get_rows queried
+        version = database.get_change_version(session)
+        changed = None
+        if list_holder.version is not None:
+            changed = {sql_type: database.get_changed_ids(session, sql_type, list_holder.version,
+                                                          database.SHARED_DATA_MAX_AGE)
+                       for sql_type in sql_types}
+            if any(ids is None for ids in changed.values()):
+                changed = None
+        if changed is None:
+            list_holder.update_two_line_list(get_rows(session, None))
+        elif any(changed.values()):
+            rows = get_rows(session, changed)
+            list_holder.update_two_line_list(rows, [key for key in get_keys(changed) if key not in rows])
+        if changed is not None:
+            version = version._replace(taken_at=list_holder.version.taken_at)  # The rows are as old as the full query
+        list_holder.version = version
+        return changed is None or any(changed.values())
+
+    @database.operation
+    def refresh_invalid_locations(self):
+        locations_list: RecycleTwoLineListHolder = self.root.get_screen('validate_locations').ids.validate_locations_list
+        self.refresh_two_line_list(self.session, locations_list, [database.City, database.Airport],
+                                   lambda session, changed: self.describe_ambiguities(
+                                       self.get_invalid_locations(session, changed)),
+                                   lambda changed: [(sql_type.__name__, element_id) for sql_type, element_ids in
+                                                    changed.items() for element_id in element_ids])
+        self.root.get_screen('main_menu').to_validate = len(locations_list.items)
+
+    @database.operation
+    def refresh_unvalidated_ratings(self):
+        ratings_list: RecycleTwoLineListHolder = self.root.get_screen('update_ratings').ids.update_rating_list
+        self.refresh_two_line_list(self.session, ratings_list, [database.Review, database.Operator],
+                                   self.get_unvalidated_ratings, lambda changed: changed[database.Review])
+        self.root.get_screen('main_menu').to_update = len(ratings_list.items)
+
+    @database.operation
     def reject_rating_clicked(self):
         try:
             if len(self.root.get_screen('update_ratings').ids.update_rating_list.selected_elements) > 0:
@@ -277,10 +419,7 @@ class TravelApp(TrackerApp):
                 database.delete_object(self.session, database.Review,
                                        review_id=review_id)
                 self.session.commit()
-                selected_item = self.root.get_screen('update_ratings').ids.update_rating_list.selected_elements[0]
-                selected_item.parent.selected_elements.clear()
-                selected_item.parent.remove_widget(selected_item)
-                self.root.get_screen('main_menu').to_update -= 1
+                self.refresh_unvalidated_ratings()
                 self.create_popup('Operator\'s rating rejected successfully')
 
             else:
@@ -291,7 +430,7 @@ class TravelApp(TrackerApp):
 
     def call_geocoding_api_by_name(self, city_name):
         self.records = []
-        connection = RESTConnection('api.openweathermap.org', 443, '/geo/1.0')
+        connection = RESTConnection('api.openweathermap.org', 443, '/geo/1.0', cache=response_cache)
         connection.send_request(
             'direct',
             {
@@ -313,7 +452,7 @@ class TravelApp(TrackerApp):
         return self.records
 
     def call_geocoding_api_by_location(self, latitude, longitude):
-        connection = RESTConnection('api.openweathermap.org', 443, '/geo/1.0')
+        connection = RESTConnection('api.openweathermap.org', 443, '/geo/1.0', cache=response_cache)
         connection.send_request(
             'reverse',
             {
@@ -327,9 +466,9 @@ class TravelApp(TrackerApp):
             self.on_records_not_loaded
         )
 
-    def call_csv_by_identifier(self, selected_airport: TwoListItem):
+    def call_csv_by_identifier(self, selected_airport: TwoLineRow):
         airport = database.get_object(self.session, database.Airport, airport_id=selected_airport.id)
-        validated_airport = csv_handler.check_airport(airport_list, airport.ICAO_code)
+        validated_airport = csv_handler.check_airport(airport_reference, airport.ICAO_code)
         if validated_airport is not None:
             self.create_choice_popup(
                 f'An airport with the same ICAO code {airport.ICAO_code} '
@@ -345,9 +484,7 @@ class TravelApp(TrackerApp):
                 f'Airport with ICAO code {airport.ICAO_code} not found. Airport removed from the database.')
             self.session.delete(airport)
             self.session.commit()
-            selected_airport.parent.selected_elements.clear()
-            selected_airport.parent.remove_widget(selected_airport)
-            self.root.get_screen('main_menu').to_validate -= 1
+            self.refresh_invalid_locations()
 
     def advance_calendar(self):
         screen = self.root.get_screen('itineraries')
@@ -366,7 +503,21 @@ class TravelApp(TrackerApp):
                 itinerary.children[screen.days_into_journey - 1].on_pressed()
                 other_itinerary.children[screen.days_into_journey - 1].on_pressed()
 
+    def request_itinerary_in_background(self, current_city: str, days_into_journey: int, lincoln_or_bust: ListHolder,
+                                        the_scenic_route: ListHolder):
+        # Replaces any request still being planned
+        self.cancel_itinerary_request()
+        self.itinerary_request = ItineraryRequest(self.operator_database.create_session, current_city,
+                                                  days_into_journey, lincoln_or_bust, the_scenic_route,
+                                                  self.create_popup).start()
+
+    def cancel_itinerary_request(self):
+        if self.itinerary_request is not None:
+            self.itinerary_request.cancel()
+            self.itinerary_request = None
+
     @staticmethod
+    @database.operation
     def request_itinerary(session, current_city: str, days_into_journey: int, lincoln_or_bust: ListHolder,
                           the_scenic_route: ListHolder) -> str:
         try:
@@ -374,30 +525,35 @@ class TravelApp(TrackerApp):
         except Exception as e:
             database.handle_error(e, session)
 
-    # itinerary
-    # unsure if data will be added to database
-    def format_forecast_record(self, record, session, airport_name, city_name):
-        airport = database.get_object(session, database.Airport, name=airport_name)
-        city = database.get_object(session, database.City, name=city_name)
-        for forecast in record['daily']:
-            forecast_date = datetime.fromtimestamp(forecast['dt']).strftime('%m/%d/%Y')
-            forecast_temperature = (forecast['temp']['max'] + forecast['temp']['min']) / 2
-            forecast_precipitation = forecast['pop']
-            forecast_wind = forecast['wind_speed']
-            forecast_description = forecast['weather'][0]['description']
-
-            if city == '':
-                database.create_object(self.session, database.Forecast,
-                                       airport_id=airport, date=forecast_date, temperature=forecast_temperature,
-                                       precipitation_probability=forecast_precipitation,
-                                       wind_speed=forecast_wind,
-                                       weather_description=forecast_description)
-            else:
-                database.create_object(self.session, database.Forecast,
-                                       city_id=city, date=forecast_date, temperature=forecast_temperature,
-                                       precipitation_probability=forecast_precipitation,
-                                       wind_speed=forecast_wind,
-                                       weather_description=forecast_description)
+    @staticmethod
+    @database.operation
+    def refresh_forecasts(session, fetcher: RESTFetcher, api_key: str) -> int:
+        # Stores the forecasts as the concurrent onecall responses arrive
+        airports = {}
+        for airport_id, latitude, longitude in session.query(database.Airport.airport_id, database.Airport.latitude,
+                                                             database.Airport.longitude):
+            airports.setdefault((latitude, longitude), []).append(airport_id)
+        parameter_list = [{'appid': api_key, 'lat': latitude, 'lon': longitude, 'units': UNITS,
+                           'exclude': 'current,minutely,hourly,alerts'} for latitude, longitude in airports]
+
+        def records():
+            for parameters, response in fetcher.fetch_all('onecall', parameter_list):
+                if isinstance(response, Exception):
+                    Logger.error(f'TravelApp: forecast for {parameters["lat"]}, {parameters["lon"]} failed: {response}')
+                else:
+                    for airport_id in airports[parameters['lat'], parameters['lon']]:
+                        yield {'airport_id': airport_id}, response
+
+        return database.ingest_forecasts(session, records())
+
+    @staticmethod
+    def format_forecast_record(record, session, airport_name, city_name) -> int:
+        # For the named city, or the named airport if city_name is empty
+        if city_name == '':
+            owner = {'airport_id': database.get_object(session, database.Airport, name=airport_name).airport_id}
+        else:
+            owner = {'city_id': database.get_object(session, database.City, name=city_name).city_id}
+        return database.ingest_forecasts(session, [(owner, record)])
 
 
 if __name__ == '__main__':
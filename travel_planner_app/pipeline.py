@@ -0,0 +1,99 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, Dict, Iterable, NamedTuple, Optional, Tuple
+
+
+class Stage(NamedTuple):
+    name: str
+    run: Callable[[], object]
+    dependencies: Tuple[str, ...] = ()
+
+
+class SkippedStage(Exception):
+    def __init__(self, name: str, dependency: str):
+        super().__init__(f'{name} was skipped because {dependency} failed')
+        self.dependency = dependency
+
+
+class StagePipeline(object):
+    """
+    Runs stages on background threads as soon as every stage they depend on has succeeded, so independent stages run
+    at the same time. Stages depending on a failed stage are skipped.
+    Callbacks are made from the worker threads; UI code should pass them on with Clock.schedule_once.
+    """
+
+    def __init__(self, stages: Iterable[Stage], on_stage_finished: Callable[[str, object, Optional[Exception]], None],
+                 on_finished: Callable[[Dict[str, Exception]], None] = None, max_workers: int = 4):
+        """
+        :param on_stage_finished: called with the name of each stage as it ends, its result and the exception it
+            raised, if any
+        :param on_finished: called once every stage has ended, with the exceptions of the stages that failed or were
+            skipped
+        """
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in self.stages.values():
+            for dependency in stage.dependencies:
+                if dependency not in self.stages:
+                    raise ValueError(f'{stage.name} depends on unknown stage {dependency}')
+        self.on_stage_finished = on_stage_finished
+        self.on_finished = on_finished
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='pipeline')
+        self.lock = threading.Lock()
+        self.started = set()
+        self.succeeded = set()
+        self.ended = set()  # Stages whose on_stage_finished call has returned
+        self.reported = False
+        self.errors: Dict[str, Exception] = {}
+
+    def start(self) -> 'StagePipeline':
+        self._advance()
+        return self
+
+    def _advance(self):
+        """
+        Starts every stage that has become ready, skips every stage that can no longer run and reports the end of the
+        pipeline once every stage has ended and been reported.
+        """
+        ready, skipped = [], []
+        with self.lock:
+            changed = True
+            while changed:
+                changed = False
+                for name, stage in self.stages.items():
+                    if name in self.started:
+                        continue
+                    failed = [dependency for dependency in stage.dependencies if dependency in self.errors]
+                    if failed:
+                        self.started.add(name)
+                        self.errors[name] = SkippedStage(name, failed[0])
+                        skipped.append(name)
+                        changed = True
+                    elif all(dependency in self.succeeded for dependency in stage.dependencies):
+                        self.started.add(name)
+                        ready.append(stage)
+        for name in skipped:
+            self.on_stage_finished(name, None, self.errors[name])
+            with self.lock:
+                self.ended.add(name)
+        for stage in ready:
+            self.executor.submit(stage.run).add_done_callback(
+                lambda future, name=stage.name: self._on_stage_done(name, future))
+        with self.lock:  # Stages ending on other threads meanwhile may have finished the pipeline too; report it once
+            report = len(self.ended) == len(self.stages) and not self.reported
+            self.reported = self.reported or report
+        if report:
+            self.executor.shutdown(wait=False)
+            if self.on_finished is not None:
+                self.on_finished(dict(self.errors))
+
+    def _on_stage_done(self, name: str, future: Future):
+        exception = future.exception()
+        with self.lock:
+            if exception is None:
+                self.succeeded.add(name)
+            else:
+                self.errors[name] = exception
+        self.on_stage_finished(name, future.result() if exception is None else None, exception)
+        with self.lock:
+            self.ended.add(name)
+        self._advance()
@@ -1,15 +1,125 @@
 import base64
 import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from queue import LifoQueue, Empty
+from typing import Dict, Iterable, Iterator, Optional, Tuple, Union
 
 from kivy.network.urlrequest import UrlRequest
 from urllib.parse import quote
 
 
+class RESTError(Exception):
+    def __init__(self, status, body):
+        super().__init__(f'HTTP {status}: {body}')
+        self.status = status
+        self.body = body
+
+
+class ResponseCache:
+    """
+    Least recently used cache of decoded GET responses, keyed on the resource and its normalized parameters so that
+    the API key and formatting differences like '40.8' and 40.80 don't matter.
+    Each resource has its own time to live, and entries can also be kept in a SQLite file to survive restarts.
+    """
+    IGNORED_PARAMETERS = {'appid'}
+
+    def __init__(self, times_to_live: Dict[str, float], default_time_to_live=3600, maximum_size=16 * 1024 * 1024,
+                 path=None):
+        """
+        :param times_to_live: seconds responses stay fresh, by resource
+        :param maximum_size: bytes of JSON kept in memory before the least recently used responses are dropped
+        :param path: SQLite file to back the cache with, or None to only cache in memory
+        """
+        self.times_to_live = times_to_live
+        self.default_time_to_live = default_time_to_live
+        self.maximum_size = maximum_size
+        self.path = path
+        self.size = 0
+        self.entries = OrderedDict()  # key -> (expiry time, size, response)
+        self.lock = threading.Lock()
+        self._database = None
+
+    @staticmethod
+    def _normalize(value) -> str:
+        try:
+            return f'{float(value):.4f}'
+        except (TypeError, ValueError):
+            return str(value).strip().lower()
+
+    def make_key(self, root_path, resource, get_parameters) -> str:
+        parameters = sorted((str(key), self._normalize(value)) for key, value in (get_parameters or {}).items()
+                            if key not in ResponseCache.IGNORED_PARAMETERS)
+        return json.dumps([f'{root_path}/{resource}', parameters])
+
+    @property
+    def database(self) -> Optional[sqlite3.Connection]:
+        if self._database is None and self.path is not None:
+            self._database = sqlite3.connect(self.path, check_same_thread=False)
+            self._database.execute('CREATE TABLE IF NOT EXISTS responses '
+                                   '(key TEXT PRIMARY KEY, expiry REAL, body TEXT)')
+            self._database.execute('DELETE FROM responses WHERE expiry <= ?', (time.time(),))
+            self._database.commit()
+        return self._database
+
+    def _remember(self, key, expiry, body: str, response):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[1]
+        self.entries[key] = (expiry, len(body), response)
+        self.size += len(body)
+        while self.size > self.maximum_size and self.entries:
+            self.size -= self.entries.popitem(last=False)[1][1]
+
+    def get(self, key):
+        """
+        :returns: the fresh response stored under key, or None
+        """
+        with self.lock:
+            now = time.time()
+            if key in self.entries:
+                expiry, size, response = self.entries[key]
+                if expiry > now:
+                    self.entries.move_to_end(key)
+                    return response
+                del self.entries[key]
+                self.size -= size
+            if self.database is not None:
+                row = self.database.execute('SELECT expiry, body FROM responses WHERE key = ? AND expiry > ?',
+                                            (key, now)).fetchone()
+                if row is not None:
+                    response = json.loads(row[1])
+                    self._remember(key, row[0], row[1], response)
+                    return response
+            return None
+
+    def put(self, key, resource, response):
+        body = json.dumps(response)
+        expiry = time.time() + self.times_to_live.get(resource, self.default_time_to_live)
+        with self.lock:
+            self._remember(key, expiry, body, response)
+            if self.database is not None:
+                self.database.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)', (key, expiry, body))
+                self.database.commit()
+
+    def close(self):
+        with self.lock:
+            if self._database is not None:
+                self._database.close()
+                self._database = None
+
+
 class RESTConnection:
-    def __init__(self, authority, port, root_path, username=None, password=None):
+    def __init__(self, authority, port, root_path, username=None, password=None, scheme='https',
+                 cache: ResponseCache = None):
         self.authority = authority
         self.port = port
         self.root_path = root_path
+        self.scheme = scheme
+        self.cache = cache
         self.headers = {
             'Content-type': 'application/json',
         }
@@ -17,10 +127,13 @@ class RESTConnection:
             credentials = base64.standard_b64encode(f'{username}:{password}'.encode('UTF8')).decode('UTF8')
             self.headers['Authorization'] = f'Basic {credentials}'
 
-    def construct_url(self, resource, get_parameters=None):
+    def construct_path(self, resource, get_parameters=None):
         parameter_string = '&'.join(f'{quote(str(key))}={quote(str(value))}' for key, value in get_parameters.items()) \
             if get_parameters is not None else ''
-        return f'https://{self.authority}:{self.port}{self.root_path}/{resource}?{parameter_string}'
+        return f'{self.root_path}/{resource}?{parameter_string}'
+
+    def construct_url(self, resource, get_parameters=None):
+        return f'{self.scheme}://{self.authority}:{self.port}{self.construct_path(resource, get_parameters)}'
 
     def send_request_by_url(self, url, post_parameters, on_success, on_failure, on_error):
         UrlRequest(url, req_headers=self.headers,
@@ -28,6 +141,102 @@ class RESTConnection:
                    on_success=on_success, on_failure=on_failure, on_error=on_error)
 
     def send_request(self, resource, get_parameters, post_parameters, on_success, on_failure, on_error):
+        if self.cache is not None and post_parameters is None:
+            key = self.cache.make_key(self.root_path, resource, get_parameters)
+            response = self.cache.get(key)
+            if response is not None:
+                on_success(None, response)
+                return
+
+            def cache_response(request, result, on_cached=on_success):
+                self.cache.put(key, resource, result)
+                on_cached(request, result)
+
+            on_success = cache_response
         url = self.construct_url(resource, get_parameters)
         print(url)
         self.send_request_by_url(url, post_parameters, on_success, on_failure, on_error)
+
+
+class RESTFetcher:
+    """
+    Headless counterpart to RESTConnection.send_request for fetching many resources at once.
+    Requests run on at most max_workers threads, each reusing a keep-alive connection from a shared pool instead of
+    opening a new connection per request, and none of it needs the Kivy event loop.
+    """
+
+    def __init__(self, connection: RESTConnection, max_workers=8, timeout=30):
+        self.connection = connection
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.pool = LifoQueue()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def _open_connection(self) -> HTTPConnection:
+        connection_type = HTTPSConnection if self.connection.scheme == 'https' else HTTPConnection
+        return connection_type(self.connection.authority, int(self.connection.port), timeout=self.timeout)
+
+    def _request(self, http_connection: HTTPConnection, path: str, post_parameters) -> Tuple[int, bytes]:
+        body = json.dumps(post_parameters) if post_parameters is not None else None
+        http_connection.request('GET' if body is None else 'POST', path, body=body, headers=self.connection.headers)
+        response = http_connection.getresponse()
+        return response.status, response.read()
+
+    def fetch(self, resource, get_parameters, post_parameters=None):
+        """
+        Sends one request on a pooled connection, retrying once on a fresh connection if the pooled one was closed by
+        the server.
+
+        :returns: the decoded JSON response
+        :raises RESTError: if the server responds with an error status
+        """
+        cache = self.connection.cache if post_parameters is None else None
+        if cache is not None:
+            key = cache.make_key(self.connection.root_path, resource, get_parameters)
+            response = cache.get(key)
+            if response is not None:
+                return response
+        path = self.connection.construct_path(resource, get_parameters)
+        try:
+            http_connection = self.pool.get_nowait()
+        except Empty:
+            http_connection = self._open_connection()
+        try:
+            try:
+                status, body = self._request(http_connection, path, post_parameters)
+            except (HTTPException, ConnectionError):
+                http_connection.close()
+                status, body = self._request(http_connection, path, post_parameters)
+        except Exception:
+            http_connection.close()
+            raise
+        self.pool.put(http_connection)
+        if status >= 400:
+            raise RESTError(status, body.decode('utf-8', 'replace'))
+        response = json.loads(body)
+        if cache is not None:
+            cache.put(key, resource, response)
+        return response
+
+    def fetch_all(self, resource, parameter_list: Iterable[dict]) -> Iterator[Tuple[dict, Union[dict, Exception]]]:
+        """
+        Fetches resource once for each set of GET parameters, at most max_workers at a time.
+
+        :returns: (parameters, response) pairs in the order the responses arrive. Failed requests give the exception
+            in place of the response
+        """
+        futures = {self.executor.submit(self.fetch, resource, parameters): parameters for parameters in parameter_list}
+        for future in as_completed(futures):
+            exception = future.exception()
+            yield futures[future], exception if exception is not None else future.result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        while not self.pool.empty():
+            self.pool.get_nowait().close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exception_info):
+        self.close()
@@ -0,0 +1,293 @@
+import datetime
+import heapq
+import os
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from timeit import default_timer
+from typing import Dict, Set, NamedTuple, Callable, List, Optional, Iterable, Iterator, Tuple
+
+import numpy
+
+from database import *
+
+MAXIMUM_RANGE = 4000  # Unit: kilometer. Herbie won't board anything that flies further
+HORIZON = 17  # Days a journey can last
+RETURN_DAY = 16  # Days into the journey after which the only flights allowed are to Lincoln
+TIME_LIMIT = 5  # Unit: second
+MAXIMUM_TEMPERATURE = 45  # Unit: Celsius
+MINIMUM_VISIBILITY = 5  # Unit: kilometer
+GROUNDING_WEATHER = ['Thunderstorm', 'Tornado']
+
+
+class CityNode(NamedTuple):
+    city_id: int
+    name: str
+    geographic_identity: str
+    latitude: float
+    longitude: float
+
+    def is_lincoln(self) -> bool:
+        return self.name == 'Lincoln' and self.geographic_identity == 'Nebraska'
+
+    def __str__(self):
+        return f'{self.name}, {self.geographic_identity}'
+
+
+class RouteGraph(object):
+    # The cities that can be flown to from each city, by departure airport. Only plain ids, so sessions can share it
+
+    def __init__(self, cities: Dict[int, CityNode], routes: Dict[int, Dict[int, Set[int]]], maximum_range: float):
+        self.cities = cities
+        self.routes = routes
+        self.maximum_range = maximum_range
+        self._flights_to_lincoln: Optional[Dict[int, int]] = None
+
+    @staticmethod
+    def build(session: Session, maximum_range: float = MAXIMUM_RANGE) -> 'RouteGraph':
+        cities = {row.city_id: CityNode(*row) for row in
+                  session.query(City.city_id, City.name, City.geographic_identity, City.latitude, City.longitude)}
+        locations = {airport_id: (latitude, longitude) for airport_id, latitude, longitude in
+                     session.query(Airport.airport_id, Airport.latitude, Airport.longitude)}
+        city_airports = defaultdict(list)
+        airport_cities = defaultdict(list)
+        for airport_id, city_id in session.query(AirportCities.airport_id, AirportCities.city_id):
+            city_airports[city_id].append(airport_id)
+            airport_cities[airport_id].append(city_id)
+        operator_airports = defaultdict(list)
+        airport_operators = defaultdict(list)
+        for operator_id, airport_id in session.query(OperatorAirport.operator_id, OperatorAirport.airport_id):
+            operator_airports[operator_id].append(airport_id)
+            airport_operators[airport_id].append(operator_id)
+        ranges = dict(session.query(Operator.operator_id, Airplane.range).join(Operator.airplane)
+                      .filter(Airplane.range <= maximum_range))
+
+        routes = {}
+        for city_id, origins in city_airports.items():
+            candidates = list({destination for departure in origins for operator_id in airport_operators[departure]
+                               if operator_id in ranges for destination in operator_airports[operator_id]})
+            distances = get_distance_matrix([locations[origin] for origin in origins],
+                                            [locations[candidate] for candidate in candidates])
+            distances[numpy.equal.outer(origins, candidates)] = numpy.inf  # An airport can't be its own destination
+            closest = dict(zip(candidates, distances.min(axis=0, initial=numpy.inf)))
+            departures = {}
+            for departure in origins:
+                destinations = set()
+                for operator_id in airport_operators[departure]:
+                    if operator_id in ranges:
+                        for destination in operator_airports[operator_id]:
+                            if closest[destination] < ranges[operator_id]:
+                                destinations.update(airport_cities[destination])
+                departures[departure] = destinations
+            routes[city_id] = departures
+        return RouteGraph(cities, routes, maximum_range)
+
+    def get_departures(self, city_id: int) -> Dict[int, Set[int]]:
+        return self.routes.get(city_id, {})
+
+    def get_lincolns(self) -> Set[int]:
+        return {city_id for city_id, city in self.cities.items() if city.is_lincoln()}
+
+    def get_flights_to_lincoln(self) -> Dict[int, int]:
+        # The fewest flights from each city to Lincoln, whatever the weather. Cities that never reach it are left out
+        if self._flights_to_lincoln is None:
+            arrivals = defaultdict(set)
+            for city_id, departures in self.routes.items():
+                for destinations in departures.values():
+                    for destination in destinations:
+                        arrivals[destination].add(city_id)
+            flights = {city_id: 0 for city_id in self.get_lincolns()}
+            queue = deque(flights)
+            while queue:
+                city_id = queue.popleft()
+                for origin in arrivals[city_id]:
+                    if origin not in flights:
+                        flights[origin] = flights[city_id] + 1
+                        queue.append(origin)
+            self._flights_to_lincoln = flights
+        return self._flights_to_lincoln
+
+
+FlightCheck = Callable[[int, datetime.date], bool]  # Whether planes can take off from an airport on a date
+
+
+class FeasibilityTable(object):
+    # Airport by day bitmap of whether planes can take off. Days without a forecast, or with one missing a
+    # temperature, are grounded. Visibility is only forecast for two days, so missing visibility doesn't ground
+
+    def __init__(self, start_date: datetime.date, rows: Dict[int, int], flyable: numpy.ndarray):
+        self.start_date = start_date
+        self.rows = rows
+        self.flyable = flyable
+
+    @staticmethod
+    def build(session: Session, start_date: datetime.date, days: int = HORIZON + 1) -> 'FeasibilityTable':
+        forecasts = session.query(Forecast.airport_id, Forecast.date, Forecast.temperature, Forecast.visibility,
+                                  Forecast.weather_description) \
+            .filter(Forecast.date >= start_date, Forecast.date < start_date + datetime.timedelta(days=days)).all()
+        rows = {}
+        for forecast in forecasts:
+            rows.setdefault(forecast.airport_id, len(rows))
+        forecasted = numpy.zeros((len(rows), days), dtype=bool)
+        grounded = numpy.zeros((len(rows), days), dtype=bool)
+        if forecasts:
+            airport_rows = numpy.array([rows[forecast.airport_id] for forecast in forecasts])
+            day_columns = numpy.array([(forecast.date - start_date).days for forecast in forecasts])
+            temperatures = numpy.array([forecast.temperature for forecast in forecasts], dtype=float)
+            visibilities = numpy.array([forecast.visibility for forecast in forecasts], dtype=float)
+            weather = numpy.array([forecast.weather_description in GROUNDING_WEATHER for forecast in forecasts])
+            with numpy.errstate(invalid='ignore'):  # Missing values are NaN, which fails both comparisons
+                allowed = (temperatures <= MAXIMUM_TEMPERATURE) & ~weather \
+                          & ((visibilities >= MINIMUM_VISIBILITY) | numpy.isnan(visibilities))
+            forecasted[airport_rows, day_columns] = True
+            grounded[airport_rows[~allowed], day_columns[~allowed]] = True
+        return FeasibilityTable(start_date, rows, forecasted & ~grounded)
+
+    def can_take_off(self, airport_id: int, date: datetime.date) -> bool:
+        row = self.rows.get(airport_id)
+        day = (date - self.start_date).days
+        return row is not None and 0 <= day < self.flyable.shape[1] and bool(self.flyable[row, day])
+
+
+def get_next_cities(graph: RouteGraph, city_id: int, date: datetime.date, day_into_journey: int,
+                    can_take_off: FlightCheck) -> Set[int]:
+    city_ids = set()
+    for airport_id, destinations in graph.get_departures(city_id).items():
+        if can_take_off(airport_id, date):
+            if day_into_journey < RETURN_DAY:
+                city_ids.update(destinations)
+            else:
+                city_ids.update(destination for destination in destinations if graph.cities[destination].is_lincoln())
+    city_ids.discard(city_id)  # Don't just wander back to the same city
+    return city_ids
+
+
+def find_route_home(graph: RouteGraph, start_city_id: int, start_date: datetime.date, days_into_journey: int,
+                    can_take_off: FlightCheck, time_limit: float = TIME_LIMIT,
+                    should_stop: Callable[[], bool] = None) -> Optional[List[int]]:
+    # A* over (city, day). The fewest flights to Lincoln never overestimates the days left, so the first itinerary
+    # found is the shortest; ties go to the city closest to Lincoln
+    deadline = default_timer() + time_limit
+    flights_to_lincoln = graph.get_flights_to_lincoln()
+    lincolns = [graph.cities[city_id] for city_id in flights_to_lincoln if flights_to_lincoln[city_id] == 0]
+    if start_city_id not in graph.cities or len(lincolns) == 0:
+        return None
+    lincoln_locations = [(city.latitude, city.longitude) for city in lincolns]
+    distances_to_lincoln = {}
+
+    def get_distance_to_lincoln(city_id: int) -> float:
+        if city_id not in distances_to_lincoln:
+            city = graph.cities[city_id]
+            distances_to_lincoln[city_id] = get_distance_matrix([(city.latitude, city.longitude)],
+                                                                lincoln_locations).min()
+        return distances_to_lincoln[city_id]
+
+    last_arrival = max(HORIZON, days_into_journey + 1)
+    previous = {}
+    visited = set()
+    queue = [(0, 0, start_city_id, days_into_journey)]
+    while queue:
+        if default_timer() > deadline or (should_stop is not None and should_stop()):
+            return None
+        _estimate, _distance, city_id, day = heapq.heappop(queue)
+        if (city_id, day) in visited:
+            continue
+        visited.add((city_id, day))
+        if day > days_into_journey and graph.cities[city_id].is_lincoln():
+            route = [city_id]
+            while (city_id, day) in previous:
+                city_id, day = previous[city_id, day]
+                route.append(city_id)
+            return route[::-1]
+        if day >= HORIZON and day > days_into_journey:
+            continue
+        date = start_date + datetime.timedelta(days=day - days_into_journey)
+        for next_city_id in get_next_cities(graph, city_id, date, day, can_take_off):
+            state = (next_city_id, day + 1)
+            if state not in visited and state not in previous and next_city_id in flights_to_lincoln and \
+                    day + 1 + flights_to_lincoln[next_city_id] <= last_arrival:
+                previous[state] = (city_id, day)
+                heapq.heappush(queue, (day + 1 - days_into_journey + flights_to_lincoln[next_city_id],
+                                       get_distance_to_lincoln(next_city_id), next_city_id, day + 1))
+    return None
+
+
+def plan_scenic_route(graph: RouteGraph, start_city_id: int, start_date: datetime.date, days_into_journey: int,
+                      can_take_off: FlightCheck, chose_city: Callable, should_stop: Callable[[], bool] = None) \
+        -> List[int]:
+    # Until the journey is back where it started or runs out of days, or should_stop returns True
+    city_ids = [start_city_id]
+    date = start_date
+    while (len(city_ids) == 1 or (city_ids[-1] != city_ids[0] and days_into_journey < HORIZON)) and \
+            (should_stop is None or not should_stop()):
+        next_city_ids = get_next_cities(graph, city_ids[-1], date, days_into_journey, can_take_off)
+        city = chose_city([graph.cities[city_id] for city_id in sorted(next_city_ids)], graph.cities[city_ids[-1]])
+        if city is None:
+            break
+        city_ids.append(city.city_id)
+        days_into_journey += 1
+        date += datetime.timedelta(days=1)
+    return city_ids
+
+
+def get_route_graph(session: Session, maximum_range: float = MAXIMUM_RANGE) -> RouteGraph:
+    return get_derived_data(session, (RouteGraph, maximum_range),
+                            lambda inner_session: RouteGraph.build(inner_session, maximum_range),
+                            (Airport, City, AirportCities, Operator, OperatorAirport, Airplane), SHARED_DATA_MAX_AGE)
+
+
+def get_feasibility_table(session: Session, start_date: datetime.date) -> FeasibilityTable:
+    # Only the latest table is kept, as start_date moves on with the calendar
+    return get_derived_data(session, FeasibilityTable,
+                            lambda inner_session: FeasibilityTable.build(inner_session, start_date), (Forecast,),
+                            SHARED_DATA_MAX_AGE, lambda table: table.start_date == start_date)
+
+
+class RoutingSnapshot(NamedTuple):
+    # Everything itinerary search reads, as plain data for the worker processes
+    graph: RouteGraph
+    table: FeasibilityTable
+
+
+def get_routing_snapshot(session: Session, start_date: datetime.date) -> RoutingSnapshot:
+    graph = get_route_graph(session)
+    graph.get_flights_to_lincoln()  # Computed once here rather than once per worker
+    return RoutingSnapshot(graph, get_feasibility_table(session, start_date))
+
+
+def plan_itinerary(snapshot: RoutingSnapshot, city_id: int, days_into_journey: int, greedy: bool,
+                   chose_city: Callable, should_stop: Callable[[], bool] = None) -> List[int]:
+    if greedy:
+        return find_route_home(snapshot.graph, city_id, snapshot.table.start_date, days_into_journey,
+                               snapshot.table.can_take_off, should_stop=should_stop) or [city_id]
+    return plan_scenic_route(snapshot.graph, city_id, snapshot.table.start_date, days_into_journey,
+                             snapshot.table.can_take_off, chose_city, should_stop)
+
+
+_worker_snapshot: Optional[RoutingSnapshot] = None
+
+
+def _initialize_worker(snapshot: RoutingSnapshot):
+    global _worker_snapshot
+    _worker_snapshot = snapshot
+
+
+def _plan_itineraries(jobs: List[Tuple[int, bool]], days_into_journey: int, chose_city: Callable) \
+        -> List[Tuple[int, bool, List[int]]]:
+    return [(city_id, greedy, plan_itinerary(_worker_snapshot, city_id, days_into_journey, greedy, chose_city))
+            for city_id, greedy in jobs]
+
+
+def plan_itineraries(snapshot: RoutingSnapshot, city_ids: Iterable[int], days_into_journey: int,
+                     chose_city: Callable, strategies: Iterable[bool] = (True, False), max_workers: int = None,
+                     chunk_size: int = None) -> Iterator[Tuple[int, bool, List[int]]]:
+    # The snapshot is sent to each worker once, and jobs in chunks. chose_city must be a module level function so it
+    # can be sent to the workers
+    jobs = [(city_id, greedy) for city_id in city_ids for greedy in strategies]
+    max_workers = max_workers or os.cpu_count() or 1
+    chunk_size = chunk_size or max(1, len(jobs) // (max_workers * 4))
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_initialize_worker,
+                             initargs=(snapshot,)) as executor:
+        futures = [executor.submit(_plan_itineraries, jobs[start:start + chunk_size], days_into_journey, chose_city)
+                   for start in range(0, len(jobs), chunk_size)]
+        for future in as_completed(futures):
+            yield from future.result()
@@ -0,0 +1,102 @@
+from typing import List, NamedTuple, Optional, Tuple
+
+import database
+from csv_handler import AirportReference
+from rest import RESTFetcher
+
+TOLERANCE = 100  # Unit: kilometer. Locations closer than this to the official data are accepted as they are
+
+
+class Ambiguity(NamedTuple):
+    """
+    A location batch validation could not settle on its own, with the closest official data if any was found.
+    """
+    sql_type: type
+    element_id: int
+    name: str
+    reason: str
+    official_name: Optional[str] = None
+    official_latitude: Optional[float] = None
+    official_longitude: Optional[float] = None
+
+
+def check_airports(session, reference: AirportReference, tolerance: float = TOLERANCE) \
+        -> Tuple[List[int], List[Ambiguity]]:
+    """
+    Compares every unvalidated airport with the airport with the same ICAO code in the reference.
+
+    :returns: ids of the airports within tolerance of the reference, and the rest as ambiguities
+    """
+    airports = session.query(database.Airport.airport_id, database.Airport.name, database.Airport.ICAO_code,
+                             database.Airport.latitude, database.Airport.longitude).filter_by(valid=False).all()
+    official_airports = reference.get_many({airport.ICAO_code for airport in airports})
+    accepted, ambiguities = [], []
+    for airport in airports:
+        official = official_airports[airport.ICAO_code]
+        if official is None:
+            ambiguities.append(Ambiguity(database.Airport, airport.airport_id, airport.name,
+                                         f'No airport with ICAO code {airport.ICAO_code} exists'))
+        elif database.get_haversine_distance((airport.latitude, airport.longitude),
+                                             (official['latitude'], official['longitude'])) <= tolerance:
+            accepted.append(airport.airport_id)
+        else:
+            ambiguities.append(Ambiguity(database.Airport, airport.airport_id, airport.name,
+                                         f'{airport.ICAO_code} is officially somewhere else', official['airport_name'],
+                                         official['latitude'], official['longitude']))
+    return accepted, ambiguities
+
+
+def check_cities(session, fetcher: RESTFetcher, api_key: str, tolerance: float = TOLERANCE) \
+        -> Tuple[List[int], List[Ambiguity]]:
+    """
+    Geocodes the names of every unvalidated city concurrently and compares each city with the closest result.
+
+    :param fetcher: fetcher for the OpenWeather geocoding API
+    :returns: ids of the cities within tolerance of a geocoding result, and the rest as ambiguities
+    """
+    cities = session.query(database.City.city_id, database.City.name, database.City.latitude,
+                           database.City.longitude).filter_by(valid=False).all()
+    parameter_list = [{'appid': api_key, 'q': name, 'limit': 20} for name in {city.name for city in cities}]
+    responses = {parameters['q']: response for parameters, response in fetcher.fetch_all('direct', parameter_list)}
+    accepted, ambiguities = [], []
+    for city in cities:
+        records = responses[city.name]
+        if isinstance(records, Exception):
+            ambiguities.append(Ambiguity(database.City, city.city_id, city.name, f'Geocoding failed: {records}'))
+        elif len(records) == 0:
+            ambiguities.append(Ambiguity(database.City, city.city_id, city.name, f'No city named {city.name} exists'))
+        else:
+            distances = database.get_distance_matrix([(city.latitude, city.longitude)],
+                                                     [(record['lat'], record['lon']) for record in records])[0]
+            closest = int(distances.argmin())
+            if distances[closest] <= tolerance:
+                accepted.append(city.city_id)
+            else:
+                ambiguities.append(Ambiguity(database.City, city.city_id, city.name,
+                                             f'The closest {city.name} is {distances[closest]:.0f} km away',
+                                             records[closest]['name'], records[closest]['lat'],
+                                             records[closest]['lon']))
+    return accepted, ambiguities
+
+
+def validate_all(session, reference: AirportReference, fetcher: RESTFetcher, api_key: str,
+                 tolerance: float = TOLERANCE) -> Tuple[int, List[Ambiguity]]:
+    """
+    Validates every unvalidated airport and city that matches the official data within tolerance, in a single
+    transaction.
+
+    :returns: the number of locations validated and the ambiguities left for the user to settle
+    """
+    try:
+        accepted_airports, airport_ambiguities = check_airports(session, reference, tolerance)
+        accepted_cities, city_ambiguities = check_cities(session, fetcher, api_key, tolerance)
+        for sql_type, primary_key, accepted in [(database.Airport, database.Airport.airport_id, accepted_airports),
+                                                (database.City, database.City.city_id, accepted_cities)]:
+            for start in range(0, len(accepted), database.BATCH_SIZE):
+                session.query(sql_type).filter(primary_key.in_(accepted[start:start + database.BATCH_SIZE])) \
+                    .update({sql_type.valid: True}, synchronize_session=False)
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    return len(accepted_airports) + len(accepted_cities), airport_ambiguities + city_ambiguities